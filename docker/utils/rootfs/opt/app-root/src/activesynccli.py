@@ -9,8 +9,42 @@ activesynccli.py
     --verbose
     list --folder INBOX
 
+    With --state FILE the folder hierarchy and sync keys of the device are kept
+    between runs, so a repeat `sync` only needs incremental requests.
+
+activesynccli.py --host apps.kolabnow.com --password Secret
+    load --accounts accounts.csv --devices 200 --duration 300 --think 2
+    --mix FolderSync=1,Sync=6,Ping=2,Search=1 --heartbeat 60
+
+    Simulate many devices at once, see LoadTest.
+
+activesynccli.py --host apps.kolabnow.com --password Secret
+    ping_load --accounts accounts.csv --devices 5000 --rate 100 --heartbeat 300
+    --notify-interval 30
+
+    Hold a Ping long-poll per device on one event loop, see PingLoadTest.
+
+activesynccli.py --host apps.kolabnow.com --user user@kolab.org --password Secret
+    sync_benchmark INBOX --window-sizes 25,100,512 --filter-types 0,5
+    --body-preferences 1:5120,2:51200,4 --json results.json
+
+    Time a full initial sync for every combination, see SyncBenchmark.
+
+activesynccli.py --host apps.kolabnow.com --password Secret --trace trace.gz --stats
+    load --accounts accounts.csv --devices 50 --duration 600
+
+activesynccli.py --host test.kolab.org --password Secret --stats
+    replay trace.gz --speed 2
+
+    Record every request (command, sizes, encode, network and decode time,
+    HTTP status), then send the same commands again later, see TraceReplay.
+
 # Dependencies
 
+    Requests are built as element trees and encoded by aswbxml.py, which decodes
+    the responses as well. The libwbxml binding is only needed to compare the
+    speed of the two with aswbxml.py --benchmark:
+
     dnf install libwbxml-devel
     pip install --global-option=build_ext --global-option="-I/usr/include/libwbxml-1.0/wbxml/" git+https://github.com/Apheleia-IT/python-wbxml#egg=wbxml
 
@@ -18,13 +52,28 @@ activesynccli.py
 
 import argparse
 import base64
-import http.client
+import collections
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import threading
 import urllib.parse
 import struct
-import xml.etree.ElementTree as ET
-import ssl
 import time
-import wbxml
+import uuid
+
+from kolabutils import LazyModule, percentile, percentiles, raise_open_files_limit
+
+
+ET = LazyModule('xml.etree.ElementTree')
+asyncio = LazyModule('asyncio')
+aswbxml = LazyModule('aswbxml')
+http = LazyModule('http')
+ssl = LazyModule('ssl')
 
 
 # def track_memory_usage():
@@ -63,9 +112,9 @@ def http_request(url, method, params=None, headers=None, body=None):
     parsed_url = urllib.parse.urlparse(url)
     # print("Connecting to ", parsed_url.netloc)
     if url.startswith('https://'):
-        conn = http.client.HTTPSConnection(parsed_url.netloc, 443, context = ssl._create_unverified_context())
+        conn = http.client.HTTPSConnection(parsed_url.hostname, parsed_url.port or 443, context = ssl._create_unverified_context())
     else:
-        conn = http.client.HTTPConnection(parsed_url.netloc, 80)
+        conn = http.client.HTTPConnection(parsed_url.hostname, parsed_url.port or 80)
 
     if params is None:
         params = {}
@@ -109,6 +158,20 @@ def basic_auth_headers(username, password):
     }
 
 
+def element(page, name, *content):
+    """
+        An element of a request in the namespace of an ActiveSync code page, e.g.
+        element("airsync", "SyncKey", 0). The content are child elements and the text.
+    """
+    node = ET.Element(f"{{{aswbxml.NAMESPACE}{page}}}{name}")
+    for child in content:
+        if isinstance(child, ET.Element):
+            node.append(child)
+        elif child is not None:
+            node.text = str(child)
+    return node
+
+
 def try_get(name, url, verbose, headers = None, body = None):
     response = http_request(
         url,
@@ -128,6 +191,143 @@ def try_get(name, url, verbose, headers = None, body = None):
     return success
 
 
+class StatusError(Exception):
+    def __init__(self, command, status):
+        super().__init__(f'{command} failed with status code {status}')
+        self.status = status
+
+
+class SyncState:
+    """
+        The folder hierarchy, folder sync key and per-collection sync keys of a
+        device, kept in a JSON file between runs and keyed by host, user and deviceid.
+    """
+
+    def __init__(self, path, host, user, deviceid):
+        self.path = path
+        self.key = f"{host}/{user}/{deviceid}"
+
+        self.states = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.states = json.load(f)
+
+        state = self.states.get(self.key, {})
+        self.folder_sync_key = state.get('folder_sync_key', 0)
+        self.folders = state.get('folders', {})
+        self.sync_keys = state.get('sync_keys', {})
+
+    def reset(self):
+        self.folder_sync_key = 0
+        self.folders = {}
+        self.sync_keys = {}
+        self.save()
+
+    def save(self):
+        self.states[self.key] = {
+            'folder_sync_key': self.folder_sync_key,
+            'folders': self.folders,
+            'sync_keys': self.sync_keys,
+        }
+        # Never leave a truncated file behind
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.states, f, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def save_sync_key(self, collection_id, sync_key):
+        self.sync_keys[collection_id] = sync_key
+        self.save()
+
+
+class Recorder:
+    """
+        Per-command statistics of the requests of all devices, with a histogram of
+        the round-trip times in power of two millisecond buckets, and optionally a
+        trace file with one compact JSON line per request, see TraceReplay.
+
+        A round-trip is split into encode (XML to WBXML), network (sending the
+        request until the response headers) and decode (reading and decoding the
+        response body, which is streamed, so it includes its transfer).
+    """
+
+    def __init__(self, path = None):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.histograms = collections.defaultdict(collections.Counter)
+        self.totals = collections.defaultdict(collections.Counter)
+        self.trace = None
+        if path is not None:
+            if path.endswith('.gz'):
+                import gzip  # pylint: disable=import-outside-toplevel
+                self.trace = gzip.open(path, 'wt', encoding='utf-8')
+            else:
+                self.trace = open(path, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+
+    @staticmethod
+    def arguments(command, request):
+        """
+            What TraceReplay needs to send the command again, without keeping the request.
+        """
+        arguments = {}
+        for node in request.iter():
+            name = node.tag.rpartition('}')[2]
+            if name in ('CollectionId', 'Id'):
+                arguments.setdefault('collections', []).append(node.text)
+            elif name == 'ClientId' and command == 'Sync':
+                arguments['adds'] = arguments.get('adds', 0) + 1
+            elif name == 'HeartbeatInterval':
+                arguments['heartbeat'] = int(node.text)
+            elif name == 'FreeText':
+                arguments['query'] = node.text
+        return arguments
+
+    def add(self, record):
+        duration = record['enc'] + record['net'] + record['dec']
+        bucket = max(0, math.ceil(math.log2(max(duration * 1000, 1))))
+        with self.lock:
+            self.histograms[record['cmd']][bucket] += 1
+            totals = self.totals[record['cmd']]
+            totals['count'] += 1
+            totals['errors'] += record['status'] != 200
+            totals['req'] += record['req']
+            totals['resp'] += record['resp'] or 0
+            totals['enc'] += record['enc']
+            totals['net'] += record['net']
+            totals['dec'] += record['dec']
+            if self.trace is not None:
+                self.trace.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+
+    def percentile(self, command, quantile):
+        """
+            The upper bound in ms of the bucket with the quantile.
+        """
+        histogram = self.histograms[command]
+        needed = max(math.ceil(quantile * sum(histogram.values())), 1)
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= needed:
+                return 2 ** bucket
+        return None
+
+    def report(self):
+        print(f"{'Command':<12} {'count':>7} {'errors':>7} {'request':>9} {'response':>10} {'encode':>9} {'network':>9} {'decode':>9} {'p50':>8} {'p90':>8} {'p99':>8}")
+        for command, totals in sorted(self.totals.items()):
+            count = totals['count']
+            print(
+                f"{command:<12} {count:>7} {totals['errors']:>7} {totals['req'] / count:>8.0f}B {totals['resp'] / count:>9.0f}B"
+                f" {totals['enc'] / count * 1000:>7.1f}ms {totals['net'] / count * 1000:>7.1f}ms {totals['dec'] / count * 1000:>7.1f}ms"
+                + "".join(f" {self.percentile(command, quantile):>6}ms" for quantile in (0.5, 0.9, 0.99))
+            )
+        print()
+        for command, histogram in sorted(self.histograms.items()):
+            print(f"{command}: " + ", ".join(f"<={2 ** bucket}ms {histogram[bucket]}" for bucket in sorted(histogram)))
+
+
 class ActiveSync:
     def __init__(self, options):
         self.host = options.host
@@ -165,27 +365,62 @@ class ActiveSync:
         else:
             self.poll = False
 
+        if hasattr(options, 'batch') and options.batch:
+            self.batch = int(options.batch)
+        else:
+            self.batch = 100
+
         if hasattr(options, 'profile') and options.profile:
             self.profile = options.profile
         else:
             self.profile = False
 
+        # Only report errors, for the load mode
+        if hasattr(options, 'quiet') and options.quiet:
+            self.quiet = options.quiet
+        else:
+            self.quiet = False
 
-    def send_request(self, command, request, extra_args = None):
-        body = wbxml.xml_to_wbxml(request)
+        if hasattr(options, 'state') and options.state:
+            self.state = SyncState(options.state, self.host, self.username, self.deviceid)
+            if not self.folder_sync_key:
+                self.folder_sync_key = self.state.folder_sync_key
+        else:
+            self.state = None
 
-        headers = {
+        # One keep-alive connection per device session, see send_request()
+        self.connection = None
+        self.headers = {
             "Host": self.host,
-            **basic_auth_headers(self.username, self.password)
+            **basic_auth_headers(self.username, self.password),
+            "Content-Type": "application/vnd.ms-sync.wbxml",
+            'MS-ASProtocolVersion': "14.0",
         }
-
-        headers.update(
-            {
-                "Content-Type": "application/vnd.ms-sync.wbxml",
-                'MS-ASProtocolVersion': "14.0",
-            }
-        )
-
+        self.round_trips = 0
+        self.handshakes = 0
+        self.last_status = None
+        # Seconds from sending the last request to its response headers
+        self.server_time = 0
+        # The request that still waits for decoded(), see Recorder
+        self.recorder = getattr(options, 'recorder', None)
+        self.pending = None
+        # Changes and response bytes of the last Sync
+        self.last_changes = 0
+        self.last_bytes = 0
+
+        # Options of the Sync requests, see SyncBenchmark
+        self.window_size = 512
+        self.filter_type = 0
+        # BodyPreference Type and TruncationSize, None for whole bodies
+        self.body_preference = (4, None)
+
+
+    def connect(self):
+        parsed_url = urllib.parse.urlparse(f"https://{self.host}")
+        self.connection = http.client.HTTPSConnection(parsed_url.hostname, parsed_url.port or 443, context = ssl._create_unverified_context())
+
+
+    def url(self, command, extra_args = None):
         if extra_args is None:
             extra_args = ""
 
@@ -193,13 +428,102 @@ class ActiveSync:
         if self.profile:
             profile = "XDEBUG_TRIGGER=StartProfileForMe&"
 
-        return http_request(
-            f"https://{self.host}/Microsoft-Server-ActiveSync?{profile}Cmd={command}&User={self.username}&DeviceId={self.deviceid}&DeviceType={self.devicetype}{extra_args}",
-            "POST",
-            None,
-            headers,
-            body
-        )
+        return f"https://{self.host}/Microsoft-Server-ActiveSync?{profile}Cmd={command}&User={self.username}&DeviceId={self.deviceid}&DeviceType={self.devicetype}{extra_args}"
+
+
+    def send_request(self, command, request, extra_args = None):
+        """
+            POST a command on the connection of this device, which is kept open between
+            commands. A connection the server closed in the meantime is replaced and the
+            command is sent again.
+
+            The request is an element tree, see element(), encoded without going through
+            XML text.
+        """
+        if self.pending is not None:
+            # The response of the previous request was never decoded completely
+            self.decoded(None)
+
+        started = time.perf_counter()
+        body = aswbxml.encode(request)
+        encoded = time.perf_counter()
+        url = self.url(command, extra_args)
+
+        if self.connection is None:
+            self.connect()
+
+        for attempt in range(2):
+            # The connection (re)connects by itself, after a close by either side
+            reconnected = self.connection.sock is None
+            try:
+                sent = time.perf_counter()
+                self.connection.request("POST", url, body, self.headers)
+                response = self.connection.getresponse()
+                self.server_time = time.perf_counter() - sent
+            except (http.client.RemoteDisconnected, http.client.ImproperConnectionState, ConnectionResetError, BrokenPipeError):
+                # Only an idle connection that went away is worth a second try
+                self.connection.close()
+                if reconnected or attempt:
+                    raise
+                continue
+            break
+
+        self.round_trips += 1
+        if reconnected:
+            self.handshakes += 1
+        self.last_status = response.status
+
+        if self.recorder is not None:
+            self.pending = {
+                't': round(started - self.recorder.start, 6),
+                'user': self.username,
+                'device': self.deviceid,
+                'type': self.devicetype,
+                'cmd': command,
+                'args': self.recorder.arguments(command, request),
+                'req': len(body),
+                'resp': None,
+                'enc': round(encoded - started, 6),
+                'net': round(self.server_time, 6),
+                'dec': 0,
+                'status': response.status,
+            }
+            # Callers only decode the body of a 200 response
+            if response.status != 200:
+                self.decoded(response.getheader('Content-Length'))
+
+        if response.status in (301, 302,):
+            response.read()
+            return http_request(
+                urllib.parse.urljoin(url, response.getheader('location', '')),
+                "POST",
+                None,
+                self.headers,
+                body
+            )
+
+        if not response.status == 200 and not self.quiet:
+            print("  ", "Status", response.status)
+            print("  ", response.read().decode())
+
+        return response
+
+
+    def decoded(self, size):
+        """
+            Completes the record of the last request, once its response of size bytes is decoded.
+        """
+        if self.pending is None:
+            return
+        record = self.pending
+        self.pending = None
+        record['resp'] = int(size) if size is not None else None
+        record['dec'] = round(max(time.perf_counter() - self.recorder.start - record['t'] - record['enc'] - record['net'], 0), 6)
+        self.recorder.add(record)
+
+
+    def connection_stats(self):
+        return f"Round-trips: {self.round_trips}, TLS handshakes: {self.handshakes}"
 
 
     def check(self):
@@ -233,99 +557,107 @@ class ActiveSync:
         return success
 
 
-    def add(self):
-        request = """
-        <Add xmlns:default="uri:Email" xmlns:default1="uri:AirSyncBase">
-            <Class>Tasks</Class>
-            <ClientId>30858234-494C-42FB-9352-009FA305762B</ClientId>
-            <ApplicationData>
-                <Subject xmlns="uri:Tasks">{subject}</Subject>
-                <Importance xmlns="uri:Tasks">1</Importance>
-                <Categories xmlns="uri:Tasks"/>
-                <Complete xmlns="uri:Tasks">0</Complete>
-                <ReminderSet xmlns="uri:Tasks">0</ReminderSet>
-                <Sensitivity xmlns="uri:Tasks">0</Sensitivity>
-                <DueDate xmlns="uri:Tasks">2020-11-04T00:00:00.000Z</DueDate>
-                <UTCDueDate xmlns="uri:Tasks">2020-11-03T23:00:00.000Z</UTCDueDate>
-            </ApplicationData>
-        </Add>
-        """.replace('        ', '').replace('      ', '').replace('    ', '').replace('  ', '').replace('\n', '').format(
-            subject="subject"
+    @staticmethod
+    def add(client_id, subject = "subject"):
+        """
+            The Add of a new task, for the Commands of a Sync request.
+        """
+        return element("airsync", "Add",
+            element("airsync", "Class", "Tasks"),
+            element("airsync", "ClientId", client_id),
+            element("airsync", "ApplicationData",
+                element("tasks", "Subject", subject),
+                element("tasks", "Importance", 1),
+                element("tasks", "Categories"),
+                element("tasks", "Complete", 0),
+                element("tasks", "ReminderSet", 0),
+                element("tasks", "Sensitivity", 0),
+                element("tasks", "DueDate", "2020-11-04T00:00:00.000Z"),
+                element("tasks", "UTCDueDate", "2020-11-03T23:00:00.000Z"),
+            ),
         )
-        return request
 
+    def sync_request(self, sync_keys, commands = None):
+        """
+            The Sync request for {collection_id: sync_key}, with the changes of {collection_id: [Add, ...]}.
+        """
+        if commands is None:
+            commands = {}
 
-    def do_sync(self, collection_id, sync_key = 0, upload_count = None):
-        start = time.time();
-        commands = ""
+        body_type, truncation_size = self.body_preference
+        if truncation_size is None:
+            body_preference = [element("airsyncbase", "Type", body_type), element("airsyncbase", "AllOrNone", 1)]
+        else:
+            body_preference = [element("airsyncbase", "Type", body_type), element("airsyncbase", "TruncationSize", truncation_size)]
+
+        collections = []
+        for collection_id, sync_key in sync_keys.items():
+            collection = element("airsync", "Collection",
+                element("airsync", "SyncKey", sync_key),
+                element("airsync", "CollectionId", collection_id),
+                element("airsync", "DeletesAsMoves", 0),
+                element("airsync", "WindowSize", self.window_size),
+                element("airsync", "Options",
+                    element("airsync", "FilterType", self.filter_type),
+                    element("airsync", "MIMESupport", 2),
+                    element("airsync", "MIMETruncation", 8),
+                    element("airsyncbase", "BodyPreference", *body_preference),
+                ),
+            )
+            if commands.get(collection_id):
+                collection.append(element("airsync", "Commands", *commands[collection_id]))
+            collections.append(collection)
+
+        return element("airsync", "Sync",
+            element("airsync", "Collections", *collections),
+            element("airsync", "WindowSize", self.window_size),
+        )
 
+    def do_sync(self, collection_id, sync_key = 0, upload_count = None):
+        commands = {}
         if upload_count is not None:
-            add_commands = ""
-            for i in range(upload_count):
-                add_commands = add_commands + self.add()
-            commands = """
-        <Commands>
-            {add_commands}
-        </Commands>
-        """.replace('    ', '').replace('\n', '').format(add_commands=add_commands)
-
-        request = """
-        <?xml version="1.0" encoding="utf-8"?>
-        <!DOCTYPE AirSync PUBLIC "-//AIRSYNC//DTD AirSync//EN" "http://www.microsoft.com/">
-        <Sync xmlns="uri:AirSync" xmlns:AirSyncBase="uri:AirSyncBase" xmlns:Email="uri:Email" xmlns:Tasks="uri:Tasks" >
-            <Collections>
-                <Collection>
-                    <SyncKey>{sync_key}</SyncKey>
-                    <CollectionId>{collection_id}</CollectionId>
-                    <DeletesAsMoves>0</DeletesAsMoves>
-                    <DeletesAsMoves>0</DeletesAsMoves>
-                    <WindowSize>512</WindowSize>
-                    <Options>
-                        <FilterType>0</FilterType>
-                        <MIMESupport>2</MIMESupport>
-                        <MIMETruncation>8</MIMETruncation>
-                        <BodyPreference xmlns="uri:AirSyncBase">
-                            <Type>4</Type>
-                            <AllOrNone>1</AllOrNone>
-                        </BodyPreference>
-                    </Options>
-                    {commands}
-                </Collection>
-            </Collections>
-            <WindowSize>512</WindowSize>
-        </Sync>
-        """.replace('    ', '').replace('\n', '').format(collection_id=collection_id, sync_key=sync_key, commands=commands)
+            commands[collection_id] = [self.add(uuid.uuid4()) for _ in range(upload_count)]
 
-        response = self.send_request('Sync', request)
+        return self.do_sync_collections({collection_id: sync_key}, commands, upload_count)[collection_id]
 
-        assert response.status == 200
+    def do_sync_collections(self, sync_keys, commands = None, upload_count = None):
+        """
+            Sync several collections in one request, returns {collection_id: [sync_key, more_available]}.
+        """
+        start = time.time();
 
-        data = response.read()
-        if not data:
-            if self.verbose:
-                print("Empty response, no changes on server")
-            return [sync_key, False]
+        request = self.sync_request(sync_keys, commands)
 
-        result = wbxml.wbxml_to_xml(data)
+        response = self.send_request('Sync', request)
 
-        if self.verbose:
-            print(result)
+        assert response.status == 200
 
-        root = ET.fromstring(result)
         xmlns = "http://synce.org/formats/airsync_wm5/airsync"
 
-        status = root.find(f".//{{{xmlns}}}Status")
-        if status is not None and status.text != "1":
-            raise Exception(f'Sync failed with status code {status.text}')
+        # Each change is decoded as it arrives and dropped once processed, so memory
+        # does not grow with the WindowSize
+        parser = aswbxml.StreamParser(response)
+        failed = 0
+        self.last_changes = 0
+        for parent, change in parser.iterchanges():
+            if self.verbose:
+                print(aswbxml.tostring(change))
 
-        sync_key = root.find(f".//{{{xmlns}}}SyncKey").text
-        if self.verbose:
-            print("Current SyncKey:", sync_key)
+            if parent.tag == f"{{{xmlns}}}Responses":
+                if change.findtext(f"{{{xmlns}}}Status") != "1":
+                    failed += 1
+            else:
+                self.last_changes += 1
 
-        for add in root.findall(f".//{{{xmlns}}}Add"):
-            serverId = add.find(f"{{{xmlns}}}ServerId").text
+            if self.quiet or change.tag != f"{{{xmlns}}}Add":
+                continue
+
+            if len(sync_keys) > 1:
+                # The Collection, around the Commands
+                print("  CollectionId", parser.stack[-2].findtext(f"{{{xmlns}}}CollectionId"))
+            serverId = change.findtext(f"{{{xmlns}}}ServerId")
             print("  ServerId", serverId)
-            applicationData = add.find(f"{{{xmlns}}}ApplicationData")
+            applicationData = change.find(f"{{{xmlns}}}ApplicationData")
             if applicationData is None:
                 continue
 
@@ -345,12 +677,48 @@ class ActiveSync:
                 print(f"  TimeZone bias: {bias}min")
             print("")
 
-        end = time.time();
-        print("Elapsed: " + str(end - start))
-        print("\n")
+        self.last_bytes = parser.bytes_read
+        self.decoded(parser.bytes_read)
 
-        more_available = (len(root.findall(f".//{{{xmlns}}}MoreAvailable")) == 1)
-        return [sync_key, more_available]
+        # Collections without changes keep their sync key
+        result = {collection_id: [sync_key, False] for collection_id, sync_key in sync_keys.items()}
+
+        root = parser.root
+        if root is None:
+            if self.verbose:
+                print("Empty response, no changes on server")
+            return result
+
+        if self.verbose:
+            print(aswbxml.tostring(root))
+
+        # A Status of the Sync itself, e.g. 4 for a malformed request
+        status = root.find(f"{{{xmlns}}}Status")
+        if status is not None and status.text != "1":
+            raise StatusError('Sync', status.text)
+
+        for collection in root.iter(f"{{{xmlns}}}Collection"):
+            status = collection.find(f"{{{xmlns}}}Status")
+            if status is not None and status.text != "1":
+                raise StatusError('Sync', status.text)
+
+            collection_id = collection.findtext(f"{{{xmlns}}}CollectionId")
+            if collection_id is None and len(sync_keys) == 1:
+                collection_id = next(iter(sync_keys))
+            sync_key = collection.findtext(f"{{{xmlns}}}SyncKey")
+            if self.verbose:
+                print("Current SyncKey:", collection_id, sync_key)
+            result[collection_id] = [sync_key, collection.find(f"{{{xmlns}}}MoreAvailable") is not None]
+
+        if failed:
+            print(f"=> Error: {failed} of {upload_count} uploads failed")
+
+        if not self.quiet:
+            end = time.time();
+            print("Elapsed: " + str(end - start))
+            print("\n")
+
+        return result
 
 
     def sync(self, collection_id, sync_key = 0, uploads = None):
@@ -360,6 +728,14 @@ class ActiveSync:
         if uploads is not None:
             uploads = int(uploads)
 
+        # Continue where the last run stopped, without the FolderSync and initial sync of a new device
+        stored = False
+        if sync_key == 0 and self.state is not None and self.state.folders:
+            names = {name: serverId for serverId, name in self.state.folders.items()}
+            collection_id = names.get(collection_id, collection_id)
+            sync_key = self.state.sync_keys.get(collection_id, 0)
+            stored = sync_key != 0
+
         # Initial sync if required
         if sync_key == 0:
             # Required for new devices
@@ -372,18 +748,103 @@ class ActiveSync:
             except:
                 pass
             [sync_key, _] = self.do_sync(collection_id, sync_key, None)
-        # Fetch until there is no more to fetch
+            if self.state is not None:
+                self.state.save_sync_key(collection_id, sync_key)
+        # Upload in batches, then fetch until there is no more to fetch
+        upload_start = time.time()
+        uploaded = 0
+        batches = 0
         while True:
-            [sync_key, more_available] = self.do_sync(collection_id, sync_key, uploads)
-            uploads = None
+            batch = min(uploads, self.batch) if uploads else None
+            try:
+                [sync_key, more_available] = self.do_sync(collection_id, sync_key, batch)
+            except StatusError as err:
+                # 3: Invalid sync key, the server no longer knows the stored one
+                if not stored or err.status != "3":
+                    raise
+                stored = False
+                [sync_key, _] = self.do_sync(collection_id, 0, None)
+                self.state.save_sync_key(collection_id, sync_key)
+                continue
+            if self.state is not None:
+                self.state.save_sync_key(collection_id, sync_key)
+            if batch:
+                uploads -= batch
+                uploaded += batch
+                batches += 1
+                if not uploads:
+                    elapsed = time.time() - upload_start
+                    print(f"Uploaded {uploaded} items in {batches} requests, {uploaded / elapsed:.1f} items/s")
+                continue
             # track_memory_usage()
             if not more_available:
+                print(self.connection_stats())
                 if self.poll:
                     time.sleep(2)
                     continue
                 break
 
 
+    def sync_collections(self, collection_ids):
+        """
+            Sync several collections per request, like clients do for Inbox, Calendar,
+            Contacts and Tasks. Pages with the collections that still have MoreAvailable
+            until all are drained.
+        """
+        if self.state is not None and self.state.folders:
+            folders = self.state.folders
+        else:
+            # Required for new devices
+            folders = self.list()
+        names = {name: serverId for serverId, name in folders.items()}
+        collection_ids = [names.get(collection_id, collection_id) for collection_id in collection_ids]
+
+        sync_keys = {collection_id: 0 for collection_id in collection_ids}
+        if self.state is not None:
+            sync_keys.update((collection_id, self.state.sync_keys[collection_id]) for collection_id in collection_ids if collection_id in self.state.sync_keys)
+        stored = any(sync_keys.values())
+
+        # Initial sync of the collections that need one, all in one request
+        initial = {collection_id: 0 for collection_id, sync_key in sync_keys.items() if not sync_key}
+        if initial:
+            for collection_id, [sync_key, _] in self.do_sync_collections(initial).items():
+                sync_keys[collection_id] = sync_key
+
+        requests = 0
+        pending = dict(sync_keys)
+        while True:
+            try:
+                result = self.do_sync_collections(pending)
+            except StatusError as err:
+                # 3: Invalid sync key, the server no longer knows a stored one
+                if not stored or err.status != "3":
+                    raise
+                stored = False
+                result = self.do_sync_collections({collection_id: 0 for collection_id in collection_ids})
+                pending = {collection_id: sync_key for collection_id, [sync_key, _] in result.items()}
+                continue
+            requests += 1
+
+            pending = {}
+            for collection_id, [sync_key, more_available] in result.items():
+                sync_keys[collection_id] = sync_key
+                if more_available:
+                    pending[collection_id] = sync_key
+            if self.state is not None:
+                self.state.sync_keys.update(sync_keys)
+                self.state.save()
+
+            if not pending:
+                print(f"{len(collection_ids)} collections drained in {requests} requests")
+                print(self.connection_stats())
+                if self.poll:
+                    time.sleep(2)
+                    pending = dict(sync_keys)
+                    requests = 0
+                    continue
+                break
+
+
     def idFromName(self, name):
         collection_id = name
         # required for new devices
@@ -406,103 +867,102 @@ class ActiveSync:
         # mail user-created
         folder_type = 12
 
-        request = """
-        <?xml version="1.0" encoding="utf-8"?>
-        <!DOCTYPE ActiveSync PUBLIC "-//MICROSOFT//DTD ActiveSync//EN" "http://www.microsoft.com/">
-        <FolderCreate xmlns="FolderHierarchy:">
-            <SyncKey>{folder_sync_key}</SyncKey>
-            <ParentId>0</ParentId>
-            <DisplayName>{collection_name}</DisplayName>
-            <Type>{folder_type}</Type>
-        </FolderCreate>
-        """.replace('    ', '').replace('\n', '').format(collection_name=collection_name, folder_sync_key=folder_sync_key, folder_type=folder_type)
-
-        print(request)
+        request = element("folderhierarchy", "FolderCreate",
+            element("folderhierarchy", "SyncKey", folder_sync_key),
+            element("folderhierarchy", "ParentId", 0),
+            element("folderhierarchy", "DisplayName", collection_name),
+            element("folderhierarchy", "Type", folder_type),
+        )
+
+        print(aswbxml.tostring(request))
         response = self.send_request('FolderCreate', request)
 
         assert response.status == 200
 
         data = response.read()
         if not data:
+            self.decoded(0)
             if self.verbose:
                 print("Empty response, no changes on server")
             return [sync_key, False]
 
-        result = wbxml.wbxml_to_xml(data)
+        root = aswbxml.parse(data)
+        self.decoded(len(data))
 
         if self.verbose:
-            print(result)
-
-        root = ET.fromstring(result)
+            print(aswbxml.tostring(root))
         xmlns = "http://synce.org/formats/airsync_wm5/airsync"
 
         status = root.find(f".//{{{xmlns}}}Status")
         if status is not None and status.text != "1":
-            raise Exception(f'Create failed with status code {status.text}')
+            raise StatusError('Create', status.text)
 
         end = time.time()
         print("Elapsed: " + str(end - start))
         print("\n")
 
     def ping(self, collection_id):
+        self.do_ping(self.idFromName(collection_id))
+
+    @staticmethod
+    def ping_request(collection_id, heartbeat, folder_class):
+        return element("ping", "Ping",
+            element("ping", "HeartbeatInterval", heartbeat),
+            element("ping", "Folders",
+                element("ping", "Folder",
+                    element("ping", "Id", collection_id),
+                    element("ping", "Class", folder_class),
+                ),
+            ),
+        )
+
+    def do_ping(self, collection_id, heartbeat = 900, folder_class = "Email"):
         start = time.time()
-        collection_id = self.idFromName(collection_id)
-
-        request = """
-        <?xml version="1.0" encoding="utf-8"?>
-        <!DOCTYPE AirSync PUBLIC "-//AIRSYNC//DTD AirSync//EN" "http://www.microsoft.com/">
-        <Ping xmlns="uri:AirSync" xmlns:AirSyncBase="uri:AirSyncBase" xmlns:Email="uri:Email" xmlns:Tasks="uri:Tasks" >
-            <HeartbeatInterval>900</HeartbeatInterval>
-            <Folders>
-                <Folder>
-                    <Id>{collection_id}</Id>
-                    <Class>Email</Class>
-                </Folder>
-            </Folders>
-        </Ping>
-        """.replace('    ', '').replace('\n', '').format(collection_id=collection_id)
+
+        request = self.ping_request(collection_id, heartbeat, folder_class)
 
         response = self.send_request('Ping', request)
 
-        if response.status != 200:
+        if response.status != 200 and not self.quiet:
             end = time.time()
             print("Elapsed: " + str(end - start))
             print("\n")
         assert response.status == 200
 
-        data = response.read()
-        if not data:
+        parser = aswbxml.StreamParser(response)
+        root = parser.parse()
+        self.decoded(parser.bytes_read)
+        if root is None:
             if self.verbose:
                 print("Empty response, no changes on server")
-            return [sync_key, False]
-
-        result = wbxml.wbxml_to_xml(data)
+            return None
 
         if self.verbose:
-            print(result)
+            print(aswbxml.tostring(root))
 
-        root = ET.fromstring(result)
-        xmlns = "http://synce.org/formats/airsync_wm5/airsync"
+        xmlns = "http://synce.org/formats/airsync_wm5/ping"
 
+        # 1: The heartbeat expired, 2: Changes occurred
         status = root.find(f".//{{{xmlns}}}Status")
-        if status is not None and status.text != "1":
-            raise Exception(f'Sync failed with status code {status.text}')
+        if status is not None and status.text not in ("1", "2"):
+            raise StatusError('Ping', status.text)
 
-        end = time.time()
-        print("Elapsed: " + str(end - start))
-        print("\n")
+        if not self.quiet:
+            end = time.time()
+            print("Elapsed: " + str(end - start))
+            print("\n")
+
+        return status.text if status is not None else None
+
+    @staticmethod
+    def folder_sync_request(sync_key):
+        return element("folderhierarchy", "FolderSync", element("folderhierarchy", "SyncKey", sync_key))
 
     def folder_sync(self, sync_key = 0):
-        request = """
-            <?xml version="1.0" encoding="utf-8"?>
-            <!DOCTYPE ActiveSync PUBLIC "-//MICROSOFT//DTD ActiveSync//EN" "http://www.microsoft.com/">
-            <FolderSync xmlns="FolderHierarchy:">
-                <SyncKey>{sync_key}</SyncKey>
-            </FolderSync>
-        """.replace('    ', '').replace('\n', '').format(sync_key=sync_key)
+        request = self.folder_sync_request(sync_key)
 
         if self.verbose:
-            print(request)
+            print(aswbxml.tostring(request))
 
         response = self.send_request('FolderSync', request)
 
@@ -513,13 +973,18 @@ class ActiveSync:
         if self.verbose:
             print(wbxmldata.hex())
 
-        result = wbxml.wbxml_to_xml(wbxmldata)
+        root = aswbxml.parse(wbxmldata)
+        self.decoded(len(wbxmldata))
 
         if self.verbose:
-            print(result)
+            print(aswbxml.tostring(root))
 
-        root = ET.fromstring(result)
         xmlns = "http://synce.org/formats/airsync_wm5/folderhierarchy"
+
+        status = root.find(f".//{{{xmlns}}}Status")
+        if status is not None and status.text != "1":
+            raise StatusError('FolderSync', status.text)
+
         folder_sync_key = root.find(f".//{{{xmlns}}}SyncKey").text
         if self.verbose:
             print("Current SyncKey:", folder_sync_key)
@@ -527,46 +992,62 @@ class ActiveSync:
         return [folder_sync_key, root]
 
     def list(self):
-        [folder_sync_key, root] = self.folder_sync(self.folder_sync_key)
+        try:
+            [folder_sync_key, root] = self.folder_sync(self.folder_sync_key)
+        except StatusError as err:
+            # 9: Invalid sync key, the server no longer knows the stored one
+            if self.state is None or not self.folder_sync_key or err.status != "9":
+                raise
+            self.state.reset()
+            self.folder_sync_key = 0
+            [folder_sync_key, root] = self.folder_sync(0)
 
         xmlns = "http://synce.org/formats/airsync_wm5/folderhierarchy"
-        folders = {}
-        for add in root.findall(f".//{{{xmlns}}}Add"):
-            displayName = add.find(f"{{{xmlns}}}DisplayName").text
-            serverId = add.find(f"{{{xmlns}}}ServerId").text
-
-            folders[serverId] = displayName
+        # An incremental FolderSync only has the changes to the stored hierarchy
+        folders = dict(self.state.folders) if self.state is not None else {}
+        for change in root.findall(f".//{{{xmlns}}}Add") + root.findall(f".//{{{xmlns}}}Update"):
+            serverId = change.find(f"{{{xmlns}}}ServerId").text
+            folders[serverId] = change.find(f"{{{xmlns}}}DisplayName").text
+        for delete in root.findall(f".//{{{xmlns}}}Delete"):
+            serverId = delete.find(f"{{{xmlns}}}ServerId").text
+            folders.pop(serverId, None)
+            if self.state is not None:
+                self.state.sync_keys.pop(serverId, None)
+
+        for serverId, displayName in folders.items():
             print("ServerId", serverId)
             print("DisplayName", displayName)
 
+        if self.state is not None:
+            self.folder_sync_key = folder_sync_key
+            self.state.folder_sync_key = folder_sync_key
+            self.state.folders = folders
+            self.state.save()
+
         return folders
 
 
     def search(self, search_string):
-        request = """
-            <?xml version="1.0" encoding="utf-8"?>
-            <!DOCTYPE ActiveSync PUBLIC "-//MICROSOFT//DTD ActiveSync//EN" "http://www.microsoft.com/">
-            <Search xmlns="FolderHierarchy:">
-                <Store>
-                    <Name>Mailbox</Name>
-                    <Query>
-                        <And>
-                            <Class xmlns="uri:AirSync">Email</Class>
-                            <FreeText>{search_string}</FreeText>
-                        </And>
-                    </Query>
-                    <Options>
-                    <RebuildResults/>
-                    <DeepTraversal/>
-                    <Range>0-9</Range>
-                    <BodyPreference xmlns="uri:AirSyncBase">
-                        <Type>2</Type>
-                        <TruncationSize>20000</TruncationSize>
-                    </BodyPreference>
-                    </Options>
-                </Store>
-            </Search>
-        """.replace('    ', '').replace('\n', '').format(search_string=search_string)
+        request = element("search", "Search",
+            element("search", "Store",
+                element("search", "Name", "Mailbox"),
+                element("search", "Query",
+                    element("search", "And",
+                        element("airsync", "Class", "Email"),
+                        element("search", "FreeText", search_string),
+                    ),
+                ),
+                element("search", "Options",
+                    element("search", "RebuildResults"),
+                    element("search", "DeepTraversal"),
+                    element("search", "Range", "0-9"),
+                    element("airsyncbase", "BodyPreference",
+                        element("airsyncbase", "Type", 2),
+                        element("airsyncbase", "TruncationSize", 20000),
+                    ),
+                ),
+            ),
+        )
 
         response = self.send_request('Search', request)
 
@@ -577,10 +1058,674 @@ class ActiveSync:
         if self.verbose:
             print(wbxmldata.hex())
 
-        result = wbxml.wbxml_to_xml(wbxmldata)
+        root = aswbxml.parse(wbxmldata)
+        self.decoded(len(wbxmldata))
 
         if self.verbose:
-            print(result)
+            print(aswbxml.tostring(root))
+
+
+def load_accounts(path):
+    """
+        The accounts of the load mode: a CSV file with a header line and the columns
+        user, password, deviceid and devicetype; only user is required.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+def parse_mix(value):
+    """
+        Parse a command mix like 'FolderSync=1,Sync=6,Ping=2' into {command: weight}.
+    """
+    mix = {}
+    for item in value.split(','):
+        command, _, weight = item.partition('=')
+        if command not in LoadTest.COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {command}, expected one of {', '.join(LoadTest.COMMANDS)}")
+        mix[command] = float(weight or 1)
+    return mix
+
+
+def parse_numbers(value):
+    """
+        Parse a comma separated list of numbers like '25,100,512'.
+    """
+    return [int(number) for number in value.split(',')]
+
+
+def parse_body_preferences(value):
+    """
+        Parse body preferences like '1:5120,2,4' into [(type, truncation_size)], the
+        truncation size is None if not given.
+    """
+    preferences = []
+    for item in value.split(','):
+        body_type, _, truncation_size = item.partition(':')
+        if body_type not in ('1', '2', '3', '4'):
+            raise argparse.ArgumentTypeError(f"unknown body type {body_type}, expected 1 (plain), 2 (HTML), 3 (RTF) or 4 (MIME)")
+        preferences.append((int(body_type), int(truncation_size) if truncation_size else None))
+    return preferences
+
+
+class LoadTest:
+    """
+        Simulated devices, each an ActiveSync session with its own user, deviceid and
+        keep-alive connection, running in a thread of its own.
+
+        A device starts like a new device (FolderSync and an initial Sync of --folder),
+        then picks commands from the weighted --mix until --duration is over, waiting an
+        exponentially distributed think time with a mean of --think seconds in between.
+    """
+
+    COMMANDS = ('FolderSync', 'Sync', 'Ping', 'Search')
+
+    def __init__(self, options, accounts):
+        self.options = options
+        self.accounts = accounts
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(collections.Counter)
+        self.round_trips = 0
+        self.handshakes = 0
+
+    def device(self, number, deviceid = None):
+        account = self.accounts[number % len(self.accounts)]
+        if deviceid is None:
+            deviceid = account.get('deviceid') or self.options.deviceid or 'loaddevice'
+            # Devices sharing an account still need their own deviceid
+            if not account.get('deviceid') or number >= len(self.accounts):
+                deviceid = f"{deviceid}{number}"
+
+        return ActiveSync(argparse.Namespace(
+            host=self.options.host,
+            user=account['user'],
+            password=account.get('password') or self.options.password,
+            verbose=False,
+            deviceid=deviceid,
+            devicetype=account.get('devicetype') or self.options.devicetype,
+            profile=self.options.profile,
+            quiet=True,
+            recorder=self.options.recorder,
+        ))
+
+    def timed(self, device, command, func, *args):
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except AssertionError:
+            error = f"HTTP {device.last_status}"
+        except Exception as err:  # pylint: disable=broad-except
+            error = f"{type(err).__name__}: {err}"
+        else:
+            with self.lock:
+                self.latencies[command].append(time.perf_counter() - start)
+            return result
+
+        with self.lock:
+            self.errors[command][error] += 1
+        # The response may not have been read completely
+        if device.connection is not None:
+            device.connection.close()
+        return None
+
+    def run_device(self, number, start, deadline):
+        time.sleep(max(0, start - time.monotonic()))
+        device = self.device(number)
+        try:
+            self.session(device, random.Random(number), deadline)
+        finally:
+            with self.lock:
+                self.round_trips += device.round_trips
+                self.handshakes += device.handshakes
+
+    def session(self, device, rng, deadline):
+        result = self.timed(device, 'FolderSync', device.folder_sync, 0)
+        if result is None:
+            return
+        [folder_sync_key, root] = result
+
+        xmlns = "http://synce.org/formats/airsync_wm5/folderhierarchy"
+        collection_id = self.options.folder
+        for add in root.findall(f".//{{{xmlns}}}Add"):
+            if add.find(f"{{{xmlns}}}DisplayName").text == self.options.folder:
+                collection_id = add.find(f"{{{xmlns}}}ServerId").text
+
+        result = self.timed(device, 'Sync', device.do_sync, collection_id, 0)
+        if result is None:
+            return
+        [sync_key, _] = result
+
+        commands = list(self.options.mix.keys())
+        weights = list(self.options.mix.values())
+        while time.monotonic() < deadline:
+            command = rng.choices(commands, weights)[0]
+            if command == 'FolderSync':
+                result = self.timed(device, command, device.folder_sync, folder_sync_key)
+                if result is not None:
+                    folder_sync_key = result[0]
+            elif command == 'Sync':
+                result = self.timed(device, command, device.do_sync, collection_id, sync_key)
+                if result is not None:
+                    sync_key = result[0]
+            elif command == 'Ping':
+                self.timed(device, command, device.do_ping, collection_id, self.options.heartbeat)
+            else:
+                self.timed(device, command, device.search, self.options.search)
+
+            if self.options.think > 0:
+                time.sleep(max(0, min(rng.expovariate(1 / self.options.think), deadline - time.monotonic())))
+
+    def run(self):
+        devices = self.options.devices or len(self.accounts)
+        start = time.monotonic()
+        deadline = start + self.options.ramp_up + self.options.duration
+        threads = [
+            threading.Thread(
+                target=self.run_device,
+                args=(number, start + self.options.ramp_up * number / devices, deadline),
+                daemon=True
+            )
+            for number in range(devices)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.report(devices, time.monotonic() - start)
+
+    def report(self, devices, elapsed):
+        print(f"{devices} devices, {elapsed:.1f}s, {self.round_trips} round-trips, {self.handshakes} TLS handshakes")
+        print()
+        print(f"{'Command':<12} {'count':>7} {'errors':>7} {'per s':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for command in self.COMMANDS:
+            latencies = self.latencies[command]
+            errors = sum(self.errors[command].values())
+            if not latencies and not errors:
+                continue
+            line = f"{command:<12} {len(latencies):>7} {errors:>7} {len(latencies) / elapsed:>8.1f}"
+            if latencies:
+                line += "".join(f" {percentile(latencies, quantile) * 1000:>7.1f}ms" for quantile in (0.5, 0.9, 0.99, 1))
+            print(line)
+
+        for command in self.COMMANDS:
+            for error, count in self.errors[command].most_common():
+                print(f"=> Error: {command} {error} ({count}x)")
+
+
+class TraceReplay(LoadTest):
+    """
+        Sends the commands of a trace recorded with --trace again, at the original
+        rate or --speed times as fast, each device of the trace in a thread of its own.
+
+        The devices start fresh: sync keys come from the replayed responses, so the
+        first Sync of a collection is an initial sync. Passwords are not part of the
+        trace, they come from --accounts or --password.
+    """
+
+    def __init__(self, options, accounts):
+        super().__init__(options, accounts)
+        self.passwords = {account['user']: account.get('password') for account in accounts}
+        self.lateness = []
+        self.skipped = collections.Counter()
+
+    @staticmethod
+    def load(path):
+        """
+            The records of a trace file by (user, deviceid, devicetype), in order.
+        """
+        if path.endswith('.gz'):
+            import gzip  # pylint: disable=import-outside-toplevel
+            f = gzip.open(path, 'rt', encoding='utf-8')
+        else:
+            f = open(path, encoding='utf-8')  # pylint: disable=consider-using-with
+        sessions = collections.defaultdict(list)
+        with f:
+            for line in f:
+                record = json.loads(line)
+                sessions[(record['user'], record['device'], record['type'])].append(record)
+        for records in sessions.values():
+            records.sort(key=lambda record: record['t'])
+        return sessions
+
+    def replay(self, session, records, start):
+        user, deviceid, devicetype = session
+        device = ActiveSync(argparse.Namespace(
+            host=self.options.host,
+            user=user,
+            password=self.passwords.get(user) or self.options.password,
+            verbose=False,
+            deviceid=deviceid,
+            devicetype=devicetype,
+            profile=self.options.profile,
+            quiet=True,
+            recorder=self.options.recorder,
+        ))
+
+        folder_sync_key = 0
+        sync_keys = {}
+        try:
+            for record in records:
+                delay = start + record['t'] / self.options.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    with self.lock:
+                        self.lateness.append(-delay)
+
+                command = record['cmd']
+                arguments = record['args']
+                collection_ids = arguments.get('collections', [])
+                if command == 'FolderSync':
+                    result = self.timed(device, command, device.folder_sync, folder_sync_key)
+                    if result is not None:
+                        folder_sync_key = result[0]
+                elif command == 'Sync' and collection_ids:
+                    keys = {collection_id: sync_keys.get(collection_id, 0) for collection_id in collection_ids}
+                    commands = {}
+                    adds = arguments.get('adds')
+                    # Uploads need a sync key, like on the original device
+                    if adds and keys[collection_ids[0]]:
+                        commands[collection_ids[0]] = [device.add(uuid.uuid4()) for _ in range(adds)]
+                    result = self.timed(device, command, device.do_sync_collections, keys, commands, adds)
+                    if result is not None:
+                        sync_keys.update((collection_id, sync_key) for collection_id, [sync_key, _] in result.items())
+                elif command == 'Ping' and collection_ids:
+                    self.timed(device, command, device.do_ping, collection_ids[0], arguments.get('heartbeat', 900))
+                elif command == 'Search':
+                    self.timed(device, command, device.search, arguments.get('query', ""))
+                else:
+                    with self.lock:
+                        self.skipped[command] += 1
+        finally:
+            with self.lock:
+                self.round_trips += device.round_trips
+                self.handshakes += device.handshakes
+
+    def run(self):
+        sessions = self.load(self.options.trace_file)
+        start = time.monotonic()
+        threads = [
+            threading.Thread(target=self.replay, args=(session, records, start), daemon=True)
+            for session, records in sessions.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.report(len(sessions), time.monotonic() - start)
+
+    def report(self, devices, elapsed):
+        super().report(devices, elapsed)
+        print()
+        if self.lateness:
+            values = ", ".join(f"{name} {percentile(self.lateness, quantile) * 1000:.1f}ms" for name, quantile in (("p50", 0.5), ("p99", 0.99), ("max", 1)))
+            print(f"Behind schedule: {len(self.lateness)} commands, {values}")
+        else:
+            print("All commands were sent on schedule")
+        for command, count in self.skipped.most_common():
+            print(f"Not replayed: {command} ({count}x)")
+
+
+class AsyncConnection:
+    """
+        The keep-alive connection of a device on the event loop, a minimal HTTP/1.1
+        client for the commands of PingLoadTest.
+    """
+
+    def __init__(self, device, context):
+        self.device = device
+        self.context = context
+        parsed_url = urllib.parse.urlparse(f"https://{device.host}")
+        self.address = (parsed_url.hostname, parsed_url.port or 443)
+        self.reader = None
+        self.writer = None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def post(self, command, body):
+        """
+            POST a command, returns the status and body of the response. An idle
+            connection the server closed in the meantime is replaced once.
+        """
+        while True:
+            reconnected = self.writer is None
+            if reconnected:
+                self.reader, self.writer = await asyncio.open_connection(*self.address, ssl=self.context, server_hostname=self.address[0])
+                self.device.handshakes += 1
+            try:
+                return await self.exchange(command, body)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.close()
+                if reconnected:
+                    raise
+
+    async def exchange(self, command, body):
+        parsed_url = urllib.parse.urlparse(self.device.url(command))
+        head = "".join(f"{name}: {value}\r\n" for name, value in self.device.headers.items())
+        self.writer.write(
+            f"POST {parsed_url.path}?{parsed_url.query} HTTP/1.1\r\n{head}Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        parts = status_line.split()
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError(f"Malformed status line {status_line[:80]!r}")
+        status = int(parts[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if not size:
+                    while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            data = b"".join(chunks)
+        else:
+            data = await self.reader.readexactly(int(headers.get('content-length', 0)))
+
+        self.device.round_trips += 1
+        self.device.last_status = status
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, data
+
+
+class PingLoadTest(LoadTest):
+    """
+        Outstanding Ping long-polls of many simulated devices, all on one event loop.
+
+        Devices are started at --rate per second. Each syncs --folder like a new device and
+        then keeps a Ping on it: re-issued when the heartbeat expires, and after a Sync when
+        the server reports changes. With --notify-interval a writer device per account adds
+        a task to the folder that often, and the time until the Ping of each device of that
+        account returns is the notification latency.
+
+        The number of outstanding Pings when the first one fails is the ceiling of
+        concurrent long-polls of the server.
+    """
+
+    def __init__(self, options, accounts):
+        super().__init__(options, accounts)
+        self.outstanding = 0
+        self.peak = 0
+        self.ceiling = None
+        self.held = 0
+        self.dropped = 0
+        self.pings = collections.Counter()
+        self.notifications = []
+        # Times of the changes added by the writers, by user
+        self.changes = collections.defaultdict(list)
+        self.encoded = {}
+
+    def ping_body(self, collection_id):
+        # Ping requests only differ by folder
+        if collection_id not in self.encoded:
+            request = ActiveSync.ping_request(collection_id, self.options.heartbeat, self.options.folder_class)
+            self.encoded[collection_id] = aswbxml.encode(request)
+        return self.encoded[collection_id]
+
+    def failed(self, command, error):
+        self.errors[command][error] += 1
+        if self.ceiling is None:
+            self.ceiling = self.outstanding
+
+    async def command(self, connection, command, request):
+        body = request if isinstance(request, bytes) else aswbxml.encode(request)
+        start = time.perf_counter()
+        status, data = await connection.post(command, body)
+        if status != 200:
+            raise StatusError(command, f"HTTP {status}")
+        self.latencies[command].append(time.perf_counter() - start)
+        return aswbxml.parse(data)
+
+    async def sync(self, connection, device, collection_id, sync_key, commands = None):
+        xmlns = "http://synce.org/formats/airsync_wm5/airsync"
+        root = await self.command(connection, 'Sync', device.sync_request({collection_id: sync_key}, {collection_id: commands or []}))
+        if root is None:
+            return sync_key
+        status = root.find(f".//{{{xmlns}}}Status")
+        if status is not None and status.text != "1":
+            raise StatusError('Sync', status.text)
+        sync_key = root.findtext(f".//{{{xmlns}}}SyncKey")
+        if sync_key is None:
+            raise StatusError('Sync', "missing SyncKey")
+        return sync_key
+
+    async def setup(self, connection, device):
+        """
+            FolderSync and initial Sync of --folder, returns its collection id and sync key.
+        """
+        xmlns = "http://synce.org/formats/airsync_wm5/folderhierarchy"
+        root = await self.command(connection, 'FolderSync', device.folder_sync_request(0))
+        if root is None:
+            raise StatusError('FolderSync', "empty response")
+        collection_id = self.options.folder
+        for add in root.findall(f".//{{{xmlns}}}Add"):
+            if add.findtext(f"{{{xmlns}}}DisplayName") == self.options.folder:
+                collection_id = add.findtext(f"{{{xmlns}}}ServerId")
+        return collection_id, await self.sync(connection, device, collection_id, 0)
+
+    async def run_device(self, number, start, deadline, context):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0, start - loop.time()))
+        device = self.device(number)
+        connection = AsyncConnection(device, context)
+        command = 'FolderSync'
+        try:
+            collection_id, sync_key = await self.setup(connection, device)
+            ping = self.ping_body(collection_id)
+            seen = len(self.changes[device.username])
+
+            while loop.time() < deadline:
+                command = 'Ping'
+                self.outstanding += 1
+                self.peak = max(self.peak, self.outstanding)
+                try:
+                    root = await asyncio.wait_for(self.command(connection, 'Ping', ping), self.options.heartbeat + 60)
+                finally:
+                    self.outstanding -= 1
+
+                status = root.findtext(".//{http://synce.org/formats/airsync_wm5/ping}Status") if root is not None else None
+                self.pings[status] += 1
+                if status == "2":
+                    changes = self.changes[device.username]
+                    if len(changes) > seen:
+                        self.notifications.append(loop.time() - changes[seen])
+                    seen = len(changes)
+                    command = 'Sync'
+                    sync_key = await self.sync(connection, device, collection_id, sync_key)
+                elif status != "1":
+                    raise StatusError('Ping', status)
+            self.held += 1
+        # Whatever a misbehaving server makes a device fail with, the others go on
+        except Exception as err:  # pylint: disable=broad-except
+            self.failed(command, f"{type(err).__name__}: {err}")
+            self.dropped += 1
+        finally:
+            connection.close()
+            self.round_trips += device.round_trips
+            self.handshakes += device.handshakes
+
+    async def run_writer(self, number, deadline, context):
+        """
+            Adds a task to --folder of an account every --notify-interval seconds.
+        """
+        loop = asyncio.get_running_loop()
+        device = self.device(number, f"{self.options.deviceid or 'loaddevice'}writer{number}")
+        connection = AsyncConnection(device, context)
+        try:
+            collection_id, sync_key = await self.setup(connection, device)
+            while loop.time() < deadline:
+                await asyncio.sleep(self.options.notify_interval)
+                sync_key = await self.sync(connection, device, collection_id, sync_key, [device.add(uuid.uuid4())])
+                self.changes[device.username].append(loop.time())
+        except Exception as err:  # pylint: disable=broad-except
+            self.errors['Sync'][f"writer {type(err).__name__}: {err}"] += 1
+        finally:
+            connection.close()
+
+    async def fan_out(self, devices):
+        loop = asyncio.get_running_loop()
+        context = ssl._create_unverified_context()
+        start = loop.time()
+        deadline = start + devices / self.options.rate + self.options.duration
+        tasks = [
+            self.run_device(number, start + number / self.options.rate, deadline, context)
+            for number in range(devices)
+        ]
+        if self.options.notify_interval:
+            tasks += [self.run_writer(number, deadline, context) for number in range(min(devices, len(self.accounts)))]
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.failed('Ping', f"{type(result).__name__}: {result}")
+
+    def run(self):
+        devices = self.options.devices or len(self.accounts)
+        raise_open_files_limit(devices + len(self.accounts))
+        start = time.monotonic()
+        asyncio.run(self.fan_out(devices))
+        self.report(devices, time.monotonic() - start)
+
+    def report(self, devices, elapsed):
+        super().report(devices, elapsed)
+        print()
+        print(f"Peak outstanding Pings: {self.peak}, held to the end: {self.held}, dropped: {self.dropped}")
+        if self.ceiling is not None:
+            print(f"Ceiling: the first failure came with {self.ceiling} outstanding Pings")
+        print(f"Pings returned: {self.pings['1']} heartbeat expired, {self.pings['2']} with changes")
+        if self.notifications:
+            values = ", ".join(f"{name} {percentile(self.notifications, quantile) * 1000:.1f}ms" for name, quantile in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1)))
+            print(f"Notification latency: {values} ({len(self.notifications)} samples)")
+
+
+class SyncBenchmark:
+    """
+        A full initial sync of one collection for every combination of --window-sizes,
+        --filter-types and --body-preferences, on one device and keep-alive connection.
+
+        The server time of a page is the time from sending the request to the response
+        headers, the rest of a round-trip is spent on the transfer and decoding. It is
+        kept for every page, including the first one with SyncKey 0.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.device = ActiveSync(argparse.Namespace(
+            host=options.host,
+            user=options.user,
+            password=options.password,
+            verbose=False,
+            deviceid=options.deviceid or 'benchmarkdevice',
+            devicetype=options.devicetype,
+            profile=options.profile,
+            quiet=True,
+            recorder=options.recorder,
+        ))
+
+    def collection_id(self):
+        [_, root] = self.device.folder_sync(0)
+        xmlns = "http://synce.org/formats/airsync_wm5/folderhierarchy"
+        for add in root.findall(f".//{{{xmlns}}}Add"):
+            if add.findtext(f"{{{xmlns}}}DisplayName") == self.options.collectionId:
+                return add.findtext(f"{{{xmlns}}}ServerId")
+        return self.options.collectionId
+
+    def initial_sync(self, collection_id, window_size, filter_type, body_preference):
+        device = self.device
+        device.window_size = window_size
+        device.filter_type = filter_type
+        device.body_preference = body_preference
+
+        start = time.perf_counter()
+        [sync_key, _] = device.do_sync(collection_id, 0)
+        requests = 1
+        size = device.last_bytes
+        items = 0
+        server_times = [device.server_time]
+        more_available = True
+        while more_available:
+            [sync_key, more_available] = device.do_sync(collection_id, sync_key)
+            requests += 1
+            size += device.last_bytes
+            items += device.last_changes
+            server_times.append(device.server_time)
+        elapsed = time.perf_counter() - start
+        p50, p95 = percentiles(server_times, (0.5, 0.95))
+
+        return {
+            'window_size': window_size,
+            'filter_type': filter_type,
+            'body_type': body_preference[0],
+            'truncation_size': body_preference[1],
+            'items': items,
+            'bytes': size,
+            'requests': requests,
+            'elapsed': elapsed,
+            'items_per_second': items / elapsed,
+            'bytes_per_second': size / elapsed,
+            'server_times': server_times,
+            'server_time_p50': p50,
+            'server_time_p95': p95,
+            'server_time_max': max(server_times),
+        }
+
+    def run(self):
+        collection_id = self.collection_id()
+        print(f"{'Window':>7} {'Filter':>7} {'Body':>10} {'items':>8} {'requests':>9} {'items/s':>9} {'KiB/s':>9} {'server p50':>11} {'p95':>9} {'max':>9}")
+        results = []
+        for window_size, filter_type, body_preference in itertools.product(
+            self.options.window_sizes, self.options.filter_types, self.options.body_preferences
+        ):
+            try:
+                result = self.initial_sync(collection_id, window_size, filter_type, body_preference)
+            except (AssertionError, StatusError) as err:
+                error = f"HTTP {self.device.last_status}" if isinstance(err, AssertionError) else str(err)
+                print(f"=> Error: WindowSize {window_size}, FilterType {filter_type}, BodyPreference {body_preference}: {error}")
+                # The response may not have been read completely
+                self.device.connection.close()
+                continue
+            results.append(result)
+            self.report(result)
+
+        print()
+        print(self.device.connection_stats())
+
+        if self.options.json:
+            with open(self.options.json, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+
+    @staticmethod
+    def report(result):
+        body = str(result['body_type'])
+        if result['truncation_size'] is not None:
+            body += f":{result['truncation_size']}"
+        print(
+            f"{result['window_size']:>7} {result['filter_type']:>7} {body:>10} {result['items']:>8} {result['requests']:>9}"
+            f" {result['items_per_second']:>9.1f} {result['bytes_per_second'] / 1024:>9.1f}"
+            f" {result['server_time_p50'] * 1000:>9.1f}ms {result['server_time_p95'] * 1000:>7.1f}ms"
+            f" {result['server_time_max'] * 1000:>7.1f}ms"
+        )
 
 
 def main():
@@ -593,6 +1738,9 @@ def main():
     parser.add_argument("--profile", action='store_true', help="Send the XDEBUG_TRIGGER")
     parser.add_argument("--deviceid", help="Device identifier ")
     parser.add_argument("--devicetype", help="devicetype (WindowsOutlook15, iphone)")
+    parser.add_argument("--state", help="Keep the folder hierarchy and sync keys in this file between runs")
+    parser.add_argument("--stats", action='store_true', help="Print per-command timings and sizes at the end")
+    parser.add_argument("--trace", help="Record every request to this file (.gz to compress), see replay")
 
     subparsers = parser.add_subparsers()
 
@@ -606,11 +1754,16 @@ def main():
     parser_list.set_defaults(func=lambda args: ActiveSync(args).list())
 
     parser_list = subparsers.add_parser('sync')
-    parser_list.add_argument("collectionId", help="Collection Id")
+    parser_list.add_argument("collectionId", nargs='+', help="Collection Id (several are synced in one request each page)")
     parser_list.add_argument("--upload", help="Upload N messages", default=None)
+    parser_list.add_argument("--batch", help="Upload at most N messages per Sync request", default=100)
     parser_list.add_argument("--sync_key", help="Sync key to start from")
     parser_list.add_argument("--poll", action='store_true', help="Keep syncing every 2 seconds")
-    parser_list.set_defaults(func=lambda args: ActiveSync(args).sync(args.collectionId, 0, args.upload))
+    parser_list.set_defaults(func=lambda args: (
+        ActiveSync(args).sync(args.collectionId[0], 0, args.upload) if len(args.collectionId) == 1
+        else ActiveSync(args).sync_collections(args.collectionId)
+    ))
+    parser_sync = parser_list
 
     parser_list = subparsers.add_parser('search')
     parser_list.add_argument("string", help="Collection Id")
@@ -625,12 +1778,61 @@ def main():
     parser_list.set_defaults(func=lambda args: ActiveSync(args).create(args.collectionName))
 
     parser_check = subparsers.add_parser('check')
-    parser_check.set_defaults(func=lambda args: ActiveSync(args).check())
+    parser_check.set_defaults(func=lambda args: sys.exit(0 if ActiveSync(args).check() else 1))
+
+    parser_load = subparsers.add_parser('load')
+    parser_load.add_argument("--accounts", required=True, help="CSV file with the columns user, password, deviceid and devicetype")
+    parser_load.add_argument("--devices", type=int, default=0, help="Number of devices (default: one per account)")
+    parser_load.add_argument("--duration", type=float, default=60, help="Seconds to run the command mix for")
+    parser_load.add_argument("--ramp-up", type=float, default=0, help="Seconds over which to start the devices")
+    parser_load.add_argument("--think", type=float, default=1, help="Mean seconds between the commands of a device")
+    parser_load.add_argument("--mix", type=parse_mix, default="FolderSync=1,Sync=6,Ping=2,Search=1", help="Weighted command mix")
+    parser_load.add_argument("--heartbeat", type=int, default=60, help="HeartbeatInterval of the Ping command")
+    parser_load.add_argument("--folder", default="INBOX", help="Folder to Sync and Ping")
+    parser_load.add_argument("--search", default="test", help="Search string of the Search command")
+    parser_load.set_defaults(func=lambda args: LoadTest(args, load_accounts(args.accounts)).run())
+
+    parser_ping_load = subparsers.add_parser('ping_load')
+    parser_ping_load.add_argument("--accounts", required=True, help="CSV file with the columns user, password, deviceid and devicetype")
+    parser_ping_load.add_argument("--devices", type=int, default=0, help="Number of devices (default: one per account)")
+    parser_ping_load.add_argument("--rate", type=float, default=50, help="Devices started per second")
+    parser_ping_load.add_argument("--duration", type=float, default=300, help="Seconds to hold the Pings once all devices are started")
+    parser_ping_load.add_argument("--heartbeat", type=int, default=300, help="HeartbeatInterval of the Pings")
+    parser_ping_load.add_argument("--folder", default="Tasks", help="Folder to Ping")
+    parser_ping_load.add_argument("--folder-class", default="Tasks", help="Class of the folder")
+    parser_ping_load.add_argument("--notify-interval", type=float, default=0, help="Add a task to the folder of each account this often (seconds)")
+    parser_ping_load.set_defaults(func=lambda args: PingLoadTest(args, load_accounts(args.accounts)).run())
+
+    parser_sync_benchmark = subparsers.add_parser('sync_benchmark')
+    parser_sync_benchmark.add_argument("collectionId", help="Collection Id or name")
+    parser_sync_benchmark.add_argument("--window-sizes", type=parse_numbers, default=[25, 100, 512], help="WindowSize values")
+    parser_sync_benchmark.add_argument("--filter-types", type=parse_numbers, default=[0], help="FilterType values, e.g. 0 (all), 3 (2 weeks), 5 (1 month)")
+    parser_sync_benchmark.add_argument("--body-preferences", type=parse_body_preferences, default=[(4, None)], help="BodyPreference Types with an optional TruncationSize, e.g. 1:5120,2:51200,4")
+    parser_sync_benchmark.add_argument("--json", help="Write the results to this file")
+    parser_sync_benchmark.set_defaults(func=lambda args: SyncBenchmark(args).run())
+
+    parser_replay = subparsers.add_parser('replay')
+    parser_replay.add_argument("trace_file", help="A trace recorded with --trace")
+    parser_replay.add_argument("--speed", type=float, default=1, help="Replay this many times as fast as recorded")
+    parser_replay.add_argument("--accounts", help="CSV file with the passwords of the users in the trace, see load")
+    parser_replay.set_defaults(func=lambda args: TraceReplay(args, load_accounts(args.accounts) if args.accounts else []).run())
 
     options = parser.parse_args()
 
+    if getattr(options, 'func', None) is parser_sync.get_default('func') and options.upload and len(options.collectionId) > 1:
+        parser_sync.error("--upload needs a single collection")
+
+    options.recorder = Recorder(options.trace) if options.stats or options.trace else None
+
     if 'func' in options:
-        options.func(options)
+        try:
+            options.func(options)
+        finally:
+            if options.recorder is not None:
+                options.recorder.close()
+                if options.stats:
+                    print()
+                    options.recorder.report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,757 @@
+#!/bin/env python3
+
+"""
+aswbxml.py response.wbxml
+aswbxml.py --encode request.xml > request.wbxml
+aswbxml.py --benchmark --rounds 200
+
+    ActiveSync WBXML decoding in pure python, reading the document in chunks
+    as it arrives, e.g. from an http.client.HTTPResponse:
+
+        parser = aswbxml.StreamParser(response)
+        for parent, element in parser.iterchanges():
+            ...
+        root = parser.root
+
+    Elements are xml.etree.ElementTree elements, with the namespaces libwbxml
+    uses ("http://synce.org/formats/airsync_wm5/airsync", ...), so the same
+    find() calls work on the output of wbxml.wbxml_to_xml.
+
+    OPAQUE data (MIME bodies, attachments) is binary: its text is decoded with
+    surrogateescape, opaque() returns the original bytes, and tostring() is
+    safe to print.
+
+    Encoding works from an element (encode()) or from start/text/end events
+    (Encoder), and accepts the namespaces of XML documents written by hand as
+    well ("uri:AirSync", "FolderHierarchy:", ...). activesynccli.py builds its
+    requests as elements, xml_to_wbxml() and wbxml_to_xml() work on XML text
+    like the libwbxml binding, for the command line and the benchmark.
+
+    Run as a script it prints a WBXML file as XML, encodes an XML file, or
+    compares the speed with the libwbxml binding.
+"""
+
+import argparse
+import functools
+import io
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+
+NAMESPACE = "http://synce.org/formats/airsync_wm5/"
+
+# MS-ASWBXML code pages: (namespace, tags), the first tag has token 0x05
+CODEPAGES = {
+    0x00: ("airsync", (
+        "Sync", "Responses", "Add", "Change", "Delete", "Fetch", "SyncKey", "ClientId", "ServerId", "Status",
+        "Collection", "Class", "Version", "CollectionId", "GetChanges", "MoreAvailable", "WindowSize",
+        "Commands", "Options", "FilterType", "Truncation", "RtfTruncation", "Conflict", "Collections",
+        "ApplicationData", "DeletesAsMoves", "NotifyGUID", "Supported", "SoftDelete", "MIMESupport",
+        "MIMETruncation", "Wait", "Limit", "Partial", "ConversationMode", "MaxItems", "HeartbeatInterval",
+    )),
+    0x01: ("contacts", (
+        "Anniversary", "AssistantName", "AssistantPhoneNumber", "Birthday", "Body", "BodySize",
+        "BodyTruncated", "Business2PhoneNumber", "BusinessAddressCity", "BusinessAddressCountry",
+        "BusinessAddressPostalCode", "BusinessAddressState", "BusinessAddressStreet", "BusinessFaxNumber",
+        "BusinessPhoneNumber", "CarPhoneNumber", "Categories", "Category", "Children", "Child", "CompanyName",
+        "Department", "Email1Address", "Email2Address", "Email3Address", "FileAs", "FirstName",
+        "Home2PhoneNumber", "HomeAddressCity", "HomeAddressCountry", "HomeAddressPostalCode",
+        "HomeAddressState", "HomeAddressStreet", "HomeFaxNumber", "HomePhoneNumber", "JobTitle", "LastName",
+        "MiddleName", "MobilePhoneNumber", "OfficeLocation", "OtherAddressCity", "OtherAddressCountry",
+        "OtherAddressPostalCode", "OtherAddressState", "OtherAddressStreet", "PagerNumber",
+        "RadioPhoneNumber", "Spouse", "Suffix", "Title", "WebPage", "YomiCompanyName", "YomiFirstName",
+        "YomiLastName", "CompressedRTF", "Picture", "Alias", "WeightedRank",
+    )),
+    0x02: ("mail", (
+        "Attachment", "Attachments", "AttName", "AttSize", "Att0Id", "AttMethod", "AttRemoved", "Body",
+        "BodySize", "BodyTruncated", "DateReceived", "DisplayName", "DisplayTo", "Importance",
+        "MessageClass", "Subject", "Read", "To", "Cc", "From", "ReplyTo", "AllDayEvent", "Categories",
+        "Category", "DtStamp", "EndTime", "InstanceType", "BusyStatus", "Location", "MeetingRequest",
+        "Organizer", "RecurrenceId", "Reminder", "ResponseRequested", "Recurrences", "Recurrence",
+        "Recurrence_Type", "Recurrence_Until", "Recurrence_Occurrences", "Recurrence_Interval",
+        "Recurrence_DayOfWeek", "Recurrence_DayOfMonth", "Recurrence_WeekOfMonth",
+        "Recurrence_MonthOfYear", "StartTime", "Sensitivity", "TimeZone", "GlobalObjId", "ThreadTopic",
+        "MIMEData", "MIMETruncated", "MIMESize", "InternetCPID", "Flag", "FlagStatus", "ContentClass",
+        "FlagType", "CompleteTime", "DisallowNewTimeProposal",
+    )),
+    0x03: ("airnotify", (
+        "Notify", "Notification", "Version", "LifeTime", "DeviceInfo", "Enable", "Folder", "ServerId",
+        "DeviceAddress", "ValidCarrierProfiles", "CarrierProfile", "Status", "Responses", "Devices",
+        "Device", "Id", "Expiry", "NotifyGUID", "DeviceFriendlyName",
+    )),
+    0x04: ("calendar", (
+        "TimeZone", "AllDayEvent", "Attendees", "Attendee", "Email", "Name", "Body", "BodyTruncated",
+        "BusyStatus", "Categories", "Category", "CompressedRTF", "DtStamp", "EndTime", "Exception",
+        "Exceptions", "Deleted", "ExceptionStartTime", "Location", "MeetingStatus", "OrganizerEmail",
+        "OrganizerName", "Recurrence", "Type", "Until", "Occurrences", "Interval", "DayOfWeek",
+        "DayOfMonth", "WeekOfMonth", "MonthOfYear", "Reminder", "Sensitivity", "Subject", "StartTime",
+        "UID", "AttendeeStatus", "AttendeeType", "Attachment", "Attachments", "AttName", "AttSize",
+        "AttOid", "AttMethod", "AttRemoved", "DisplayName", "DisallowNewTimeProposal",
+        "ResponseRequested", "AppointmentReplyTime", "ResponseType", "CalendarType", "IsLeapMonth",
+        "FirstDayOfWeek", "OnlineMeetingConfLink", "OnlineMeetingExternalLink",
+    )),
+    0x05: ("move", (
+        "MoveItems", "Move", "SrcMsgId", "SrcFldId", "DstFldId", "Response", "Status", "DstMsgId",
+    )),
+    0x06: ("getitemestimate", (
+        "GetItemEstimate", "Version", "Collections", "Collection", "Class", "CollectionId", "DateTime",
+        "Estimate", "Response", "Status",
+    )),
+    0x07: ("folderhierarchy", (
+        "Folders", "Folder", "DisplayName", "ServerId", "ParentId", "Type", "Response", "Status",
+        "ContentClass", "Changes", "Add", "Delete", "Update", "SyncKey", "FolderCreate", "FolderDelete",
+        "FolderUpdate", "FolderSync", "Count", "Version",
+    )),
+    0x08: ("meetingresponse", (
+        "CalendarId", "CollectionId", "MeetingResponse", "RequestId", "Request", "Result", "Status",
+        "UserResponse", "Version", "InstanceId",
+    )),
+    0x09: ("tasks", (
+        "Body", "BodySize", "BodyTruncated", "Categories", "Category", "Complete", "DateCompleted",
+        "DueDate", "UtcDueDate", "Importance", "Recurrence", "Recurrence_Type", "Recurrence_Start",
+        "Recurrence_Until", "Recurrence_Occurrences", "Recurrence_Interval", "Recurrence_DayOfMonth",
+        "Recurrence_DayOfWeek", "Recurrence_WeekOfMonth", "Recurrence_MonthOfYear",
+        "Recurrence_Regenerate", "Recurrence_DeadOccur", "ReminderSet", "ReminderTime", "Sensitivity",
+        "StartDate", "UtcStartDate", "Subject", "CompressedRTF", "OrdinalDate", "SubOrdinalDate",
+        "CalendarType", "IsLeapMonth", "FirstDayOfWeek",
+    )),
+    0x0a: ("resolverecipients", (
+        "ResolveRecipients", "Response", "Status", "Type", "Recipient", "DisplayName", "EmailAddress",
+        "Certificates", "Certificate", "MiniCertificate", "Options", "To", "CertificateRetrieval",
+        "RecipientCount", "MaxCertificates", "MaxAmbiguousRecipients", "CertificateCount", "Availability",
+        "StartTime", "EndTime", "MergedFreeBusy", "Picture", "MaxSize", "Data", "MaxPictures",
+    )),
+    0x0b: ("validatecert", (
+        "ValidateCert", "Certificates", "Certificate", "CertificateChain", "CheckCRL", "Status",
+    )),
+    0x0c: ("contacts2", (
+        "CustomerId", "GovernmentId", "IMAddress", "IMAddress2", "IMAddress3", "ManagerName",
+        "CompanyMainPhone", "AccountName", "NickName", "MMS",
+    )),
+    0x0d: ("ping", (
+        "Ping", "AutdState", "Status", "HeartbeatInterval", "Folders", "Folder", "Id", "Class", "MaxFolders",
+    )),
+    0x0e: ("provision", (
+        "Provision", "Policies", "Policy", "PolicyType", "PolicyKey", "Data", "Status", "RemoteWipe",
+        "EASProvisionDoc", "DevicePasswordEnabled", "AlphanumericDevicePasswordRequired",
+        "DeviceEncryptionEnabled", "PasswordRecoveryEnabled", "DocumentBrowseEnabled",
+        "AttachmentsEnabled", "MinDevicePasswordLength", "MaxInactivityTimeDeviceLock",
+        "MaxDevicePasswordFailedAttempts", "MaxAttachmentSize", "AllowSimpleDevicePassword",
+        "DevicePasswordExpiration", "DevicePasswordHistory", "AllowStorageCard", "AllowCamera",
+        "RequireDeviceEncryption", "AllowUnsignedApplications", "AllowUnsignedInstallationPackages",
+        "MinDevicePasswordComplexCharacters", "AllowWiFi", "AllowTextMessaging", "AllowPOPIMAPEmail",
+        "AllowBluetooth", "AllowIrDA", "RequireManualSyncWhenRoaming", "AllowDesktopSync",
+        "MaxCalendarAgeFilter", "AllowHTMLEmail", "MaxEmailAgeFilter", "MaxEmailBodyTruncationSize",
+        "MaxEmailHTMLBodyTruncationSize", "RequireSignedSMIMEMessages", "RequireEncryptedSMIMEMessages",
+        "RequireSignedSMIMEAlgorithm", "RequireEncryptionSMIMEAlgorithm",
+        "AllowSMIMEEncryptionAlgorithmNegotiation", "AllowSMIMESoftCerts", "AllowBrowser",
+        "AllowConsumerEmail", "AllowRemoteDesktop", "AllowInternetSharing",
+        "UnapprovedInROMApplicationList", "ApplicationName", "ApprovedApplicationList", "Hash",
+    )),
+    0x0f: ("search", (
+        "Search", "Stores", "Store", "Name", "Query", "Options", "Range", "Status", "Response", "Result",
+        "Properties", "Total", "EqualTo", "Value", "And", "Or", "FreeText", "SubstringOp", "DeepTraversal",
+        "LongId", "RebuildResults", "LessThan", "GreaterThan", "Schema", "Supported", "UserName",
+        "Password", "ConversationId", "Picture", "MaxSize", "MaxPictures",
+    )),
+    0x10: ("gal", (
+        "DisplayName", "Phone", "Office", "Title", "Company", "Alias", "FirstName", "LastName", "HomePhone",
+        "MobilePhone", "EmailAddress", "Picture", "Status", "Data",
+    )),
+    0x11: ("airsyncbase", (
+        "BodyPreference", "Type", "TruncationSize", "AllOrNone", None, "Body", "Data", "EstimatedDataSize",
+        "Truncated", "Attachments", "Attachment", "DisplayName", "FileReference", "Method", "ContentId",
+        "ContentLocation", "IsInline", "NativeBodyType", "ContentType", "Preview", "BodyPartPreference",
+        "BodyPart", "Status",
+    )),
+    0x12: ("settings", (
+        "Settings", "Status", "Get", "Set", "Oof", "OofState", "StartTime", "EndTime", "OofMessage",
+        "AppliesToInternal", "AppliesToExternalKnown", "AppliesToExternalUnknown", "Enabled",
+        "ReplyMessage", "BodyType", "DevicePassword", "Password", "DeviceInformation", "Model", "IMEI",
+        "FriendlyName", "OS", "OSLanguage", "PhoneNumber", "UserInformation", "EmailAddresses",
+        "SmtpAddress", "UserAgent", "EnableOutboundSMS", "MobileOperator", "PrimarySmtpAddress",
+        "Accounts", "Account", "AccountId", "AccountName", "UserDisplayName", "SendDisabled", None,
+        "RightsManagementInformation",
+    )),
+    0x13: ("documentlibrary", (
+        "LinkId", "DisplayName", "IsFolder", "CreationDate", "LastModifiedDate", "IsHidden",
+        "ContentLength", "ContentType",
+    )),
+    0x14: ("itemoperations", (
+        "ItemOperations", "Fetch", "Store", "Options", "Range", "Total", "Properties", "Data", "Status",
+        "Response", "Version", "Schema", "Part", "EmptyFolderContents", "DeleteSubFolders", "UserName",
+        "Password", "Move", "DstFldId", "ConversationId", "MoveAlways",
+    )),
+    0x15: ("composemail", (
+        "SendMail", "SmartForward", "SmartReply", "SaveInSentItems", "ReplaceMime", None, "Source",
+        "FolderId", "ItemId", "LongId", "InstanceId", "Mime", "ClientId", "Status", "AccountId",
+    )),
+    0x16: ("email2", (
+        "UmCallerID", "UmUserNotes", "UmAttDuration", "UmAttOrder", "ConversationId", "ConversationIndex",
+        "LastVerbExecuted", "LastVerbExecutionTime", "ReceivedAsBcc", "Sender", "CalendarType",
+        "IsLeapMonth", "AccountId", "FirstDayOfWeek", "MeetingMessageType",
+    )),
+    0x17: ("notes", (
+        "Subject", "MessageClass", "LastModifiedDate", "Categories", "Category",
+    )),
+    0x18: ("rightsmanagement", (
+        "RightsManagementSupport", "RightsManagementTemplates", "RightsManagementTemplate",
+        "RightsManagementLicense", "EditAllowed", "ReplyAllowed", "ReplyAllAllowed", "ForwardAllowed",
+        "ModifyRecipientsAllowed", "ExtractAllowed", "PrintAllowed", "ExportAllowed",
+        "ProgrammaticAccessAllowed", "Owner", "ContentExpiryDate", "TemplateID", "TemplateName",
+        "TemplateDescription", "ContentOwner", "RemoveRightsManagementDistribution",
+    )),
+}
+
+# Global tokens of WBXML 1.3
+SWITCH_PAGE = 0x00
+END = 0x01
+STR_I = 0x03
+STR_T = 0x83
+OPAQUE = 0xC3
+
+# The element tags by code page and token, as ElementTree "{namespace}Name"
+TAGS = {
+    page: {
+        token: f"{{{NAMESPACE}{namespace}}}{name}"
+        for token, name in enumerate(names, 0x05) if name is not None
+    }
+    for page, (namespace, names) in CODEPAGES.items()
+}
+
+# The page and token of each tag by code page name, the tag names in lower case
+TOKENS = {
+    namespace: {
+        name.lower(): (page, token)
+        for token, name in enumerate(names, 0x05) if name is not None
+    }
+    for page, (namespace, names) in CODEPAGES.items()
+}
+
+# The code pages of other names of their namespaces
+NAMESPACE_ALIASES = {
+    "email": "mail",
+    "poommail": "mail",
+    "poomcal": "calendar",
+    "poomcontacts": "contacts",
+    "poomcontacts2": "contacts2",
+    "poomtasks": "tasks",
+}
+
+# The header of encoded documents: WBXML 1.3, unknown public id, UTF-8, no string table
+HEADER = bytes((0x03, 0x01, 0x6A, 0x00))
+
+# Sync and FolderSync changes, see StreamParser.iterchanges()
+CHANGES = ("Add", "Change", "Delete", "Update", "SoftDelete")
+
+
+class WBXMLError(ValueError):
+    pass
+
+
+class StreamParser:
+    """
+        Decodes an ActiveSync WBXML document from a file-like source (or bytes),
+        reading chunk_size bytes at a time, so decoding starts with the first chunk
+        and the raw document is never held in memory as a whole.
+    """
+
+    def __init__(self, source, chunk_size=65536):
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        self.source = source
+        self.chunk_size = chunk_size
+        # Consumed bytes are dropped in place when more are read, see fill()
+        self.buffer = bytearray()
+        self.offset = 0
+        self.strings = b""
+        # The document element, None for an empty document
+        self.root = None
+        # The elements that are still open, innermost last
+        self.stack = []
+        # The size of the document as read from the source so far
+        self.bytes_read = 0
+
+    def fill(self, needed):
+        """
+            Make sure the buffer holds at least needed unread bytes, returns False at the end of the source.
+        """
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        while len(self.buffer) < needed:
+            chunk = self.source.read(self.chunk_size)
+            if not chunk:
+                return False
+            self.bytes_read += len(chunk)
+            self.buffer += chunk
+        return True
+
+    def byte(self):
+        if self.offset >= len(self.buffer) and not self.fill(1):
+            raise WBXMLError("Truncated WBXML document")
+        value = self.buffer[self.offset]
+        self.offset += 1
+        return value
+
+    def read(self, length):
+        """
+            Reads length bytes, what the buffer does not hold yet is read from the
+            source in one go instead of chunk by chunk.
+        """
+        data = self.buffer[self.offset:self.offset + length]
+        self.offset += len(data)
+        while len(data) < length:
+            chunk = self.source.read(length - len(data))
+            if not chunk:
+                raise WBXMLError("Truncated WBXML document")
+            self.bytes_read += len(chunk)
+            data += chunk
+        return bytes(data)
+
+    def mb_u_int32(self):
+        value = 0
+        while True:
+            octet = self.byte()
+            value = (value << 7) | (octet & 0x7F)
+            if not octet & 0x80:
+                return value
+
+    def inline_string(self):
+        end = self.buffer.find(b"\0", self.offset)
+        while end < 0:
+            searched = len(self.buffer) - self.offset
+            # Only the bytes read by fill() still need to be searched
+            if not self.fill(searched + 1):
+                raise WBXMLError("Unterminated inline string")
+            end = self.buffer.find(b"\0", searched)
+        data = self.buffer[self.offset:end]
+        self.offset = end + 1
+        return data.decode('utf-8', errors='replace')
+
+    def header(self):
+        """
+            Reads version, public id, charset and string table, returns False for an empty document.
+        """
+        if not self.fill(1):
+            return False
+        self.byte()
+        if self.mb_u_int32() == 0:
+            # The public id is given as string table index
+            self.mb_u_int32()
+        self.mb_u_int32()
+        self.strings = self.read(self.mb_u_int32())
+        return True
+
+    def events(self):
+        """
+            Yields ("start", element, parent) and ("end", element, parent) like
+            ElementTree.iterparse, text is only complete on "end".
+        """
+        if not self.header():
+            return
+
+        page = 0
+        stack = self.stack
+        while True:
+            token = self.byte()
+            if token == SWITCH_PAGE:
+                page = self.byte()
+            elif token == END:
+                if not stack:
+                    raise WBXMLError("END without an open element")
+                element = stack.pop()
+                yield "end", element, stack[-1] if stack else None
+                if not stack:
+                    break
+            elif token == STR_I:
+                self.text(stack, self.inline_string())
+            elif token == STR_T:
+                index = self.mb_u_int32()
+                end = self.strings.find(b"\0", index)
+                self.text(stack, self.strings[index:end].decode('utf-8', errors='replace'))
+            elif token == OPAQUE:
+                # Lossless for any bytes, see opaque()
+                self.text(stack, self.read(self.mb_u_int32()).decode('utf-8', errors='surrogateescape'))
+            elif token & 0x3F >= 0x05:
+                if token & 0x80:
+                    raise WBXMLError("Attributes are not used by ActiveSync")
+                tag = TAGS.get(page, {}).get(token & 0x3F)
+                if tag is None:
+                    tag = f"{{{NAMESPACE}page{page}}}Unknown0x{token & 0x3F:02x}"
+                parent = stack[-1] if stack else None
+                element = ET.Element(tag) if parent is None else ET.SubElement(parent, tag)
+                if parent is None:
+                    if self.root is not None:
+                        raise WBXMLError("More than one document element")
+                    self.root = element
+                yield "start", element, parent
+                if token & 0x40:
+                    stack.append(element)
+                else:
+                    yield "end", element, parent
+                    if parent is None:
+                        break
+            else:
+                raise WBXMLError(f"Unsupported WBXML token 0x{token:02x}")
+
+        # Leave nothing unread on a keep-alive connection
+        while True:
+            chunk = self.source.read(self.chunk_size)
+            if not chunk:
+                break
+            self.bytes_read += len(chunk)
+
+    @staticmethod
+    def text(stack, value):
+        if not stack:
+            raise WBXMLError("Text outside of the document element")
+        element = stack[-1]
+        # Text after a child element, not used by ActiveSync but keep it anyway
+        if len(element):
+            element[-1].tail = (element[-1].tail or "") + value
+        else:
+            element.text = (element.text or "") + value
+
+    def iterchanges(self, tags=CHANGES):
+        """
+            Yields (parent, element) for each complete element with one of these local names.
+
+            The element is removed from its parent once the next one is asked for, so
+            only what has not been processed yet is kept. Afterwards root has the rest
+            of the document (SyncKey, Status, MoreAvailable, ...).
+        """
+        for event, element, parent in self.events():
+            if event == "end" and parent is not None and element.tag.rpartition('}')[2] in tags:
+                yield parent, element
+                parent.remove(element)
+
+    def parse(self):
+        """
+            Decodes the whole document, returns the document element (None if empty).
+        """
+        for _ in self.events():
+            pass
+        return self.root
+
+
+def parse(source):
+    return StreamParser(source).parse()
+
+
+def opaque(element):
+    """
+        The bytes of an element with OPAQUE data, e.g. a MIME body in another charset.
+    """
+    return (element.text or "").encode('utf-8', errors='surrogateescape')
+
+
+def tostring(element):
+    """
+        An element as XML to print, binary OPAQUE data is replaced.
+    """
+    xml = ET.tostring(element, encoding='unicode')
+    return xml.encode('utf-8', errors='surrogateescape').decode('utf-8', errors='replace')
+
+
+@functools.lru_cache(maxsize=None)
+def codepage(namespace):
+    """
+        The code page name of a namespace like "uri:AirSync", "AirSyncBase:" or
+        "http://synce.org/formats/airsync_wm5/airsync", None if there is none.
+    """
+    if namespace.startswith(NAMESPACE):
+        namespace = namespace[len(NAMESPACE):]
+    name = namespace.lower()
+    if name.startswith("uri:"):
+        name = name[4:]
+    name = name.rstrip(":")
+    name = NAMESPACE_ALIASES.get(name, name)
+    return name if name in TOKENS else None
+
+
+def split(tag):
+    return tag[1:].rpartition('}')[::2] if tag.startswith('{') else ("", tag)
+
+
+@functools.lru_cache(maxsize=None)
+def token(tag, parent_tag=None, parent_page=0):
+    """
+        The code page and token of an ElementTree tag.
+
+        A tag that is not in the code page of its namespace (e.g. Search in
+        "FolderHierarchy:") is looked up in the code page of its parent first,
+        then in any other. So is a tag that inherits the namespace of such a
+        parent, e.g. HeartbeatInterval in <Ping xmlns="uri:AirSync">.
+    """
+    namespace, name = split(tag)
+    name = name.lower()
+    parent_tokens = TOKENS[CODEPAGES[parent_page][0]]
+    if parent_tag is not None and split(parent_tag)[0] == namespace and name in parent_tokens:
+        return parent_tokens[name]
+
+    page = codepage(namespace) if namespace else None
+    if page is not None and name in TOKENS[page]:
+        return TOKENS[page][name]
+
+    found = [tokens[name] for tokens in TOKENS.values() if name in tokens]
+    for candidate in found:
+        if candidate[0] == parent_page:
+            return candidate
+    if found:
+        return found[0]
+    raise WBXMLError(f"Unknown ActiveSync tag {tag}")
+
+
+def mb_u_int32(value):
+    """
+        The WBXML multi-byte encoding of an unsigned integer.
+    """
+    octets = [value & 0x7F]
+    value >>= 7
+    while value:
+        octets.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(octets))
+
+
+class Encoder:
+    """
+        Encodes an ActiveSync document from start/text/end events:
+
+            encoder = aswbxml.Encoder()
+            encoder.start("{uri:FolderHierarchy}FolderSync")
+            encoder.start("{uri:FolderHierarchy}SyncKey")
+            encoder.text("0")
+            encoder.end()
+            encoder.end()
+            data = encoder.getvalue()
+
+        A start token is written once the next event shows whether the element
+        has content. Text is written as an inline string, bytes (and the binary
+        OPAQUE data of a decoded document) as OPAQUE.
+    """
+
+    def __init__(self):
+        self.out = bytearray(HEADER)
+        self.page = 0
+        # The tags and code pages of the open elements
+        self.tags = []
+        self.pages = []
+        # The start token waiting for the next event
+        self.pending = None
+
+    def flush(self, content):
+        page, value = self.pending
+        self.pending = None
+        if page != self.page:
+            self.out += bytes((SWITCH_PAGE, page))
+            self.page = page
+        self.out.append(value | 0x40 if content else value)
+
+    def start(self, tag):
+        if self.pending is not None:
+            self.flush(True)
+        if self.pages:
+            page, value = token(tag, self.tags[-1], self.pages[-1])
+        else:
+            page, value = token(tag)
+        self.pending = (page, value)
+        self.tags.append(tag)
+        self.pages.append(page)
+
+    def text(self, value):
+        if not value:
+            return
+        if not self.pages:
+            raise WBXMLError("Text outside of the document element")
+        if self.pending is not None:
+            self.flush(True)
+        if isinstance(value, str):
+            try:
+                value = value.encode('utf-8')
+            except UnicodeEncodeError:
+                # Binary OPAQUE data of a decoded document
+                value = value.encode('utf-8', errors='surrogateescape')
+            else:
+                self.out.append(STR_I)
+                self.out += value
+                self.out.append(0)
+                return
+        self.out.append(OPAQUE)
+        self.out += mb_u_int32(len(value))
+        self.out += value
+
+    def end(self):
+        if not self.pages:
+            raise WBXMLError("END without an open element")
+        self.tags.pop()
+        self.pages.pop()
+        if self.pending is not None:
+            self.flush(False)
+        else:
+            self.out.append(END)
+
+    def element(self, element):
+        self.start(element.tag)
+        # Whitespace between child elements is only indentation
+        if len(element) == 0 or (element.text and not element.text.isspace()):
+            self.text(element.text)
+        for child in element:
+            self.element(child)
+        self.end()
+
+    def getvalue(self):
+        if self.pages:
+            raise WBXMLError("Unclosed elements")
+        return bytes(self.out)
+
+
+def encode(element):
+    """
+        Encodes an ElementTree element as WBXML.
+    """
+    encoder = Encoder()
+    encoder.element(element)
+    return encoder.getvalue()
+
+
+def xml_to_wbxml(xml):
+    """
+        Encodes an XML document, like wbxml.xml_to_wbxml of the libwbxml binding.
+    """
+    return encode(ET.fromstring(xml))
+
+
+def wbxml_to_xml(data):
+    """
+        Decodes a WBXML document as XML, like wbxml.wbxml_to_xml of the libwbxml binding.
+    """
+    root = parse(data)
+    return tostring(root) if root is not None else ""
+
+
+def benchmark_documents():
+    """
+        XML requests and a WBXML Sync response of the kind activesynccli.py sends and receives.
+    """
+    add = (
+        "<Add><Class>Tasks</Class><ClientId>{number}</ClientId><ApplicationData>"
+        "<Subject xmlns=\"uri:Tasks\">Task {number}</Subject><Importance xmlns=\"uri:Tasks\">1</Importance>"
+        "<DueDate xmlns=\"uri:Tasks\">2020-11-04T00:00:00.000Z</DueDate>"
+        "<UTCDueDate xmlns=\"uri:Tasks\">2020-11-03T23:00:00.000Z</UTCDueDate>"
+        "</ApplicationData></Add>"
+    )
+    requests = {
+        'FolderSync': '<?xml version="1.0" encoding="utf-8"?><FolderSync xmlns="FolderHierarchy:"><SyncKey>0</SyncKey></FolderSync>',
+        'Sync 100 Adds': (
+            '<?xml version="1.0" encoding="utf-8"?><Sync xmlns="uri:AirSync"><Collections><Collection>'
+            '<SyncKey>1</SyncKey><CollectionId>38</CollectionId><WindowSize>512</WindowSize><Options>'
+            '<FilterType>0</FilterType><BodyPreference xmlns="uri:AirSyncBase"><Type>4</Type></BodyPreference>'
+            f'</Options><Commands>{"".join(add.format(number=number) for number in range(100))}</Commands>'
+            '</Collection></Collections></Sync>'
+        ),
+    }
+
+    airsync = f"{{{NAMESPACE}airsync}}"
+    tasks = f"{{{NAMESPACE}tasks}}"
+    airsyncbase = f"{{{NAMESPACE}airsyncbase}}"
+    root = ET.Element(f"{airsync}Sync")
+    collection = ET.SubElement(ET.SubElement(root, f"{airsync}Collections"), f"{airsync}Collection")
+    ET.SubElement(collection, f"{airsync}SyncKey").text = "2"
+    ET.SubElement(collection, f"{airsync}CollectionId").text = "38"
+    ET.SubElement(collection, f"{airsync}Status").text = "1"
+    commands = ET.SubElement(collection, f"{airsync}Commands")
+    for number in range(512):
+        change = ET.SubElement(commands, f"{airsync}Add")
+        ET.SubElement(change, f"{airsync}ServerId").text = f"38:{number}"
+        data = ET.SubElement(change, f"{airsync}ApplicationData")
+        ET.SubElement(data, f"{tasks}Subject").text = f"Task {number}"
+        body = ET.SubElement(data, f"{airsyncbase}Body")
+        ET.SubElement(body, f"{airsyncbase}Type").text = "1"
+        ET.SubElement(body, f"{airsyncbase}Data").text = "Lorem ipsum dolor sit amet. " * 40
+    ET.SubElement(collection, f"{airsync}MoreAvailable")
+
+    return requests, encode(root)
+
+
+def timed(func, rounds):
+    """
+        The median seconds of a call of func over rounds calls.
+    """
+    durations = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2]
+
+
+def benchmark(rounds):
+    try:
+        import wbxml  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        wbxml = None
+        print("The libwbxml binding is not installed, only timing the pure python codec")
+        print()
+
+    requests, response = benchmark_documents()
+
+    print(f"{'Document':<34} {'size':>9} {'libwbxml':>10} {'python':>10}")
+    for name, xml in requests.items():
+        encoded = xml_to_wbxml(xml)
+        tree = ET.fromstring(xml)
+        cases = [
+            (f"encode {name}", lambda xml=xml: wbxml.xml_to_wbxml(xml), lambda xml=xml: xml_to_wbxml(xml)),
+            (f"encode {name} from a tree", None, lambda tree=tree: encode(tree)),
+        ]
+        for case, native, python in cases:
+            report(case, len(encoded), native if wbxml else None, python, rounds)
+        if wbxml and wbxml.xml_to_wbxml(xml) != encoded:
+            print(f"=> Error: {name} is encoded differently than by libwbxml")
+
+    report(
+        "decode Sync 512 Adds",
+        len(response),
+        (lambda: ET.fromstring(wbxml.wbxml_to_xml(response))) if wbxml else None,
+        lambda: parse(response),
+        rounds
+    )
+
+
+def report(case, size, native, python, rounds):
+    line = f"{case:<34} {size:>8}B"
+    line += f" {timed(native, rounds) * 1000:>8.3f}ms" if native else f" {'-':>10}"
+    line += f" {timed(python, rounds) * 1000:>8.3f}ms"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", nargs='?', help="WBXML file to print as XML")
+    parser.add_argument("--encode", action='store_true', help="Encode the XML file as WBXML to stdout instead")
+    parser.add_argument("--benchmark", action='store_true', help="Compare encoding and decoding with the libwbxml binding")
+    parser.add_argument("--rounds", type=int, default=100, help="Runs per case of the benchmark")
+    options = parser.parse_args()
+
+    if options.benchmark:
+        benchmark(options.rounds)
+        return
+    if not options.file:
+        parser.error("a file is required")
+
+    if options.encode:
+        with open(options.file, encoding='utf-8') as f:
+            sys.stdout.buffer.write(xml_to_wbxml(f.read()))
+        return
+
+    with open(options.file, 'rb') as f:
+        root = parse(f)
+    if root is not None:
+        ET.indent(root)
+        print(tostring(root))
+
+
+if __name__ == "__main__":
+    main()
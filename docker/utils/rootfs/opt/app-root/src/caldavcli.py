@@ -14,6 +14,7 @@ import base64
 import http.client
 import urllib.parse
 import ssl
+import sys
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 
@@ -25,9 +26,9 @@ def http_request(url, method, params=None, headers=None, body=None):
 
     parsed_url = urllib.parse.urlparse(url)
     if url.startswith('https://'):
-        conn = http.client.HTTPSConnection(parsed_url.netloc, 443, context = ssl._create_unverified_context())
+        conn = http.client.HTTPSConnection(parsed_url.hostname, parsed_url.port or 443, context = ssl._create_unverified_context())
     else:
-        conn = http.client.HTTPConnection(parsed_url.netloc, 80)
+        conn = http.client.HTTPConnection(parsed_url.hostname, parsed_url.port or 80)
 
     if params is None:
         params = {}
@@ -255,7 +256,7 @@ def main():
     parser_search.set_defaults(func=lambda args: CalDAV(args).search(args.href))
 
     parser_check = subparsers.add_parser('check')
-    parser_check.set_defaults(func=lambda args: CalDAV(args).check())
+    parser_check.set_defaults(func=lambda args: sys.exit(0 if CalDAV(args).check() else 1))
 
     options = parser.parse_args()
 
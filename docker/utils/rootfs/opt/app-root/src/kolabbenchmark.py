@@ -0,0 +1,302 @@
+#!/bin/env python3
+
+"""
+kolabbenchmark.py
+    --rounds 5 --concurrency 1,8,32 --tenants 32
+    --latency 10ms --jitter 2ms
+    --json results.json --baseline baseline.json --tolerance 1.5
+
+    Run kolabendpointtester.py, caldavcli.py and activesynccli.py against the
+    local stand-ins of kolabstandin.py, so no Kolab deployment is needed:
+
+    * probes: every check of a single tenant, median and p95 duration over
+      --rounds runs
+    * scaling: a fleet of --tenants tenants at each --concurrency
+    * cli: the wall time of caldavcli.py check and activesynccli.py check
+    * startup: the wall time of commands that need no server at all, and
+      which of the expensive modules importing the scripts loads; any of
+      these (see EAGER_IMPORTS) is reported as a regression
+
+    With --baseline the results are compared to the --json output of an
+    earlier run, and the exit code is 1 if anything got slower than
+    --tolerance times its baseline.
+"""
+
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from kolabstandin import StandIn, parse_faults
+from kolabutils import percentile
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DOMAIN = "example.org"
+PASSWORD = "Secret"
+
+# All checks of kolabendpointtester.py that the stand-ins can answer
+PROBE_ARGS = [
+    "--default", "--dns", "--dkim", "dkim", "--mtasts", "1", "--autoconfig", "1",
+    "--meet", DOMAIN, "--fb", f"https://{DOMAIN}/freebusy",
+]
+
+# Modules the scripts must only import once a check or command needs them
+EAGER_IMPORTS = {
+    'kolabendpointtester': [
+        'asyncio', 'concurrent.futures', 'dns.resolver', 'http.client', 'http.server',
+        'imaplib', 'smtplib', 'sqlite3', 'ssl',
+    ],
+    'activesynccli': ['asyncio', 'aswbxml', 'http.client', 'ssl', 'wbxml', 'xml.etree.ElementTree'],
+}
+
+# Base64 encoded TIME_ZONE_INFORMATION of W. Europe Standard Time
+TIMEZONE = (
+    "xP///1cALgAgAEUAdQByAG8AcABlACAAUwB0AGEAbgBkAGEAcgBkACAAVABpAG0AZQAAAAAAAAAAAAAAAAAAAAAAAAAA"
+    "AAoAAAAFAAMAAAAAAAAAAAAAAFcALgAgAEUAdQByAG8AcABlACAARABhAHkAbABpAGcAaAB0ACAAVABpAG0AZQAAAAAA"
+    "AAAAAAAAAAAAAAAAAAAAAAMAAAAFAAIAAAAAAAAAxP///w=="
+)
+
+
+def summary(durations, failures):
+    return {
+        'median': percentile(durations, 0.5),
+        'p95': percentile(durations, 0.95),
+        'failures': failures,
+    }
+
+
+def run(command, env):
+    """
+        Run a command, returns the wall time and the completed process.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(command, env=env, capture_output=True, text=True, check=False)
+    return time.perf_counter() - start, result
+
+
+def endpointtester(standin, args, env):
+    """
+        Run kolabendpointtester.py against the stand-ins, returns the wall time,
+        the ndjson records of the checks and whether the run succeeded (exit
+        status 0 and at least one record, so a crash doesn't pass as no checks).
+    """
+    command = [
+        sys.executable, os.path.join(HERE, "kolabendpointtester.py"),
+        "--format", "ndjson", "--password", PASSWORD, "--timeout", "30",
+        *standin.endpointtester_args(), *args,
+    ]
+    wall, result = run(command, env)
+    records = [json.loads(line) for line in result.stdout.splitlines() if line.startswith('{')]
+    if not records:
+        stderr = result.stderr.strip().splitlines()
+        print(f"kolabendpointtester.py returned no records: {stderr[-1] if stderr else f'exit status {result.returncode}'}", file=sys.stderr)
+    return wall, records, result.returncode == 0 and bool(records)
+
+
+def bench_probes(standin, env, rounds):
+    durations = collections.defaultdict(list)
+    failures = collections.Counter()
+    walls = []
+    for _ in range(rounds):
+        wall, records, success = endpointtester(standin, [*PROBE_ARGS, "--username", f"user@{DOMAIN}", "--concurrency", "1"], env)
+        walls.append(wall)
+        if not success:
+            failures['(process)'] += 1
+        for record in records:
+            durations[record['name']].append(record['duration'])
+            if record['status'] != 'pass':
+                failures[record['name']] += 1
+
+    results = {name: summary(values, failures[name]) for name, values in durations.items()}
+    results['(process)'] = summary(walls, failures['(process)'])
+    return results
+
+
+def bench_scaling(standin, env, tenants, levels, directory):
+    fleet = os.path.join(directory, "fleet.csv")
+    with open(fleet, 'w', encoding='utf-8') as f:
+        f.write("username\n")
+        for number in range(tenants):
+            f.write(f"user{number}@{DOMAIN}\n")
+
+    results = {}
+    for concurrency in levels:
+        wall, records, success = endpointtester(
+            standin,
+            ["--fleet", fleet, "--default", "--dns", "--concurrency", str(concurrency), "--per-host-concurrency", str(concurrency)],
+            env
+        )
+        results[str(concurrency)] = {
+            'wall': wall,
+            'checks': len(records),
+            'checks_per_second': len(records) / wall,
+            'failures': max(sum(1 for record in records if record['status'] != 'pass'), 0 if success else 1),
+        }
+    return results
+
+
+def bench_cli(standin, env, rounds):
+    host = f"{standin.address}:{standin.ports['https']}"
+    commands = {
+        'caldavcli.py check': [
+            sys.executable, os.path.join(HERE, "caldavcli.py"),
+            "--host", f"https://{host}", "--user", f"user@{DOMAIN}", "--password", PASSWORD, "check",
+        ],
+        'activesynccli.py check': [
+            sys.executable, os.path.join(HERE, "activesynccli.py"),
+            "--host", host, "--user", f"user@{DOMAIN}", "--password", PASSWORD, "check",
+        ],
+    }
+
+    results = {}
+    for name, command in commands.items():
+        walls = []
+        failures = 0
+        for _ in range(rounds):
+            wall, result = run(command, env)
+            walls.append(wall)
+            if result.returncode != 0:
+                failures += 1
+        results[name] = summary(walls, failures)
+    return results
+
+
+def bench_startup(env, rounds):
+    commands = {
+        'kolabendpointtester.py --help': [sys.executable, os.path.join(HERE, "kolabendpointtester.py"), "--help"],
+        'activesynccli.py decode_timezone': [sys.executable, os.path.join(HERE, "activesynccli.py"), "decode_timezone", TIMEZONE],
+        'caldavcli.py --help': [sys.executable, os.path.join(HERE, "caldavcli.py"), "--help"],
+    }
+
+    results = {}
+    for name, command in commands.items():
+        walls = []
+        failures = 0
+        for _ in range(rounds):
+            wall, result = run(command, env)
+            walls.append(wall)
+            if result.returncode != 0:
+                failures += 1
+        results[name] = summary(walls, failures)
+    return results
+
+
+def eager_imports(env):
+    """
+        The expensive modules that importing each script loads right away.
+    """
+    loaded = {}
+    for script, modules in EAGER_IMPORTS.items():
+        code = f"import sys, {script}; print(*(name for name in {modules!r} if name in sys.modules))"
+        _, result = run([sys.executable, "-c", code], {**env, 'PYTHONPATH': HERE})
+        loaded[script] = result.stdout.split() if result.returncode == 0 else [result.stderr.strip().splitlines()[-1]]
+    return loaded
+
+
+def flatten(results, prefix=""):
+    """
+        The timings of the results as {"probes/IMAP/median": seconds}.
+    """
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f"{prefix}{key}/"))
+        elif key in ('median', 'p95', 'wall'):
+            metrics[f"{prefix}{key}"] = value
+    return metrics
+
+
+def regressions(results, baseline, tolerance):
+    current = flatten(results)
+    return [
+        (name, before, current[name])
+        for name, before in flatten(baseline).items()
+        if name in current and before > 0 and current[name] > before * tolerance
+    ]
+
+
+def report(results):
+    print(f"{'Probe':<28} {'median':>10} {'p95':>10} {'failures':>9}")
+    for name, values in results['probes'].items():
+        print(f"{name:<28} {values['median'] * 1000:>8.1f}ms {values['p95'] * 1000:>8.1f}ms {values['failures']:>9}")
+    print()
+    print(f"{'Concurrency':<28} {'wall':>10} {'checks/s':>10} {'failures':>9}")
+    for concurrency, values in results['scaling'].items():
+        print(f"{concurrency:<28} {values['wall']:>9.2f}s {values['checks_per_second']:>10.1f} {values['failures']:>9}")
+    print()
+    print(f"{'Command':<28} {'median':>10} {'p95':>10} {'failures':>9}")
+    for name, values in results['cli'].items():
+        print(f"{name:<28} {values['median'] * 1000:>8.1f}ms {values['p95'] * 1000:>8.1f}ms {values['failures']:>9}")
+    print()
+    print(f"{'Startup':<34} {'median':>10} {'p95':>10} {'failures':>9}")
+    for name, values in results['startup'].items():
+        print(f"{name:<34} {values['median'] * 1000:>8.1f}ms {values['p95'] * 1000:>8.1f}ms {values['failures']:>9}")
+    for script, modules in results['eager_imports'].items():
+        print(f"Importing {script} loads: {', '.join(modules) or 'nothing expensive'}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--rounds", type=int, default=5, help="Number of runs to take the probe and cli percentiles over")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated concurrency levels of the scaling run")
+    parser.add_argument("--tenants", type=int, default=32, help="Number of tenants in the scaling run")
+    parser.add_argument("--latency", action='append', metavar="[SERVICE=]DURATION", help="Latency of the stand-ins, see kolabstandin.py")
+    parser.add_argument("--jitter", action='append', metavar="[SERVICE=]DURATION", help="Jitter of the stand-ins")
+    parser.add_argument("--failure-rate", action='append', metavar="[SERVICE=]RATE", help="Failure rate of the stand-ins")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Flag timings above this multiple of the baseline")
+
+    options = parser.parse_args()
+
+    try:
+        faults = parse_faults(options.latency, options.jitter, options.failure_rate)
+    except ValueError as err:
+        parser.error(str(err))
+
+    levels = [int(level) for level in options.concurrency.split(',') if level]
+    ports = {'https': 0, 'imaps': 0, 'smtps': 0, 'submission': 0, 'dns': 0}
+    standin = StandIn(DOMAIN, ports=ports, faults=faults, password=PASSWORD).start()
+    env = {**os.environ, 'SSL_CERT_FILE': standin.certfile}
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='kolabbenchmark') as directory:
+            results = {
+                'probes': bench_probes(standin, env, options.rounds),
+                'scaling': bench_scaling(standin, env, options.tenants, levels, directory),
+                'cli': bench_cli(standin, env, options.rounds),
+                'startup': bench_startup(env, options.rounds),
+                'eager_imports': eager_imports(env),
+            }
+    finally:
+        standin.stop()
+
+    report(results)
+
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, options.tolerance)
+        print()
+        for name, before, after in slower:
+            print(f"Regression: {name} {before * 1000:.1f}ms -> {after * 1000:.1f}ms")
+        if slower:
+            sys.exit(1)
+        print(f"No regressions against {options.baseline}")
+
+    if any(results['eager_imports'].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,23 +7,59 @@ kolabendpointtester.py
     --password Secret
     --dav https://apps.kolabnow.com
     --fb https://apps.kolabnow.com/calendars/user@kolab.org/6f552d35-95c4-41f6-a7d2-cfd02dd867db
+
+kolabendpointtester.py
+    --default --username user@kolab.org --password Secret
+    --listen 127.0.0.1:9100 --interval 60 --check-interval Certificates=3600
+
+kolabendpointtester.py
+    --fleet tenants.csv --default --concurrency 64 --per-host-concurrency 4
+
+    tenants.csv:
+        username,password,host,dns
+        user@kolab.org,Secret,,1
+        other@example.com,Secret,example.com,
+
+kolabendpointtester.py
+    --default --username user@example.org --password Secret
+    --nameserver 127.0.0.1:5353 --connect-to :443:127.0.0.1:8443 --connect-to :993:127.0.0.1:9993
+
+    Against the local stand-ins of kolabstandin.py, see also kolabbenchmark.py
 """
 
 import sys
-import traceback
+import calendar
+import contextlib
+import functools
+import io
+import math
+import os
+import queue
+import threading
+import time
 import socket
-import ssl
 import argparse
+import collections
 from base64 import b64encode
-import http.client
+import json
 import urllib.parse
-from imaplib import IMAP4
-from imaplib import IMAP4_SSL
-from smtplib import SMTP
-from smtplib import SMTP_SSL
-import dns.resolver
+import zlib
 import re
 
+from kolabutils import LazyModule, percentiles, raise_open_files_limit
+
+
+asyncio = LazyModule('asyncio')
+concurrent = LazyModule('concurrent')
+dns = LazyModule('dns')
+http = LazyModule('http')
+imaplib = LazyModule('imaplib')
+smtplib = LazyModule('smtplib')
+sqlite3 = LazyModule('sqlite3')
+ssl = LazyModule('ssl')
+traceback = LazyModule('traceback')
+uuid = LazyModule('uuid')
+
 # print('\033[31m' + 'some red text')
 
 RED='\033[31m'
@@ -32,7 +68,13 @@ RESET='\033[39m'
 
 SSLNOVERIFY = True
 
+# Per thread state of the check that is currently running
+_context = threading.local()
+
 def print_error(msg):
+    errors = getattr(_context, 'errors', None)
+    if errors is not None:
+        errors.append(msg)
     print(RED + f"=> ERROR: {msg}")
     print(RESET)  # and reset to default color
 
@@ -41,6 +83,53 @@ def print_success(msg):
     print(RESET)  # and reset to default color
 
 
+def ssl_context(verify=not SSLNOVERIFY):
+    """
+        The shared client SSL context, so it is only set up once per process.
+    """
+    return _ssl_context(verify)
+
+
+@functools.lru_cache(maxsize=None)
+def _ssl_context(verify):
+    if verify:
+        return ssl.create_default_context()
+    return ssl._create_unverified_context()
+
+
+# Endpoints to connect to instead, by (host, port), see --connect-to
+connect_to = {}
+
+
+def connect_address(host, port):
+    """
+        The address to connect to for an endpoint. Names in TLS handshakes and
+        Host headers stay the same.
+    """
+    for key in ((host, port), (host, None), (None, port), (None, None)):
+        if key in connect_to:
+            to_host, to_port = connect_to[key]
+            return to_host or host, to_port or port
+    return host, port
+
+
+def parse_connect_to(values):
+    """
+        Parse HOST:PORT:CONNECT-TO-HOST:CONNECT-TO-PORT entries, like curl --connect-to.
+
+        An empty HOST or PORT matches any, an empty CONNECT-TO-HOST or
+        CONNECT-TO-PORT keeps the original one.
+    """
+    result = {}
+    for value in values or []:
+        fields = value.split(':')
+        if len(fields) != 4:
+            raise ValueError(f"Invalid --connect-to {value}, expected HOST:PORT:CONNECT-TO-HOST:CONNECT-TO-PORT")
+        host, port, to_host, to_port = fields
+        result[(host or None, int(port) if port else None)] = (to_host or None, int(to_port) if to_port else None)
+    return result
+
+
 def print_assertion_failure():
     """
         Print an error message about a failed assertion
@@ -48,24 +137,197 @@ def print_assertion_failure():
     _, _, trace = sys.exc_info()
     tb_info = traceback.extract_tb(trace)
     _filename, line, _func, text = tb_info[-1]
+    errors = getattr(_context, 'errors', None)
+    if errors is not None:
+        errors.append(f"assertion on line {line} failed on {text}")
     print(f"  ERROR assertion on line {line} failed on {text}")
 
 
-def http_request(url, method, params=None, headers=None, body=None, verbose=False):
+class PhaseTimings:
     """
-        Perform an HTTP request.
+        Time spent in the individual phases of a request, in seconds.
     """
 
-    parsed_url = urllib.parse.urlparse(url)
-    # print("Connecting to ", parsed_url.netloc)
-    if url.startswith('https://'):
-        conn = http.client.HTTPSConnection(parsed_url.netloc, 443, context = (ssl._create_unverified_context() if SSLNOVERIFY else None))
-    else:
-        conn = http.client.HTTPConnection(parsed_url.netloc, 80)
+    def __init__(self, protocol="http"):
+        self.phases = {}
+        # "http", or "imap", "smtp" and "tls" for the probes of other services
+        self.protocol = protocol
+        # "new", "resumed" (new connection, resumed TLS session) or "reused", HTTP only
+        self.connection = None
+        # Bytes of the response body
+        self.size = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
 
-    if verbose:
-        conn.set_debuglevel(9)
-    conn.connect()
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def __str__(self):
+        phases = ", ".join(f"{name} {duration * 1000:.1f}ms" for name, duration in self.phases.items())
+        if self.connection:
+            return f"{phases} (total {self.total() * 1000:.1f}ms, {self.connection} connection)"
+        return f"{phases} (total {self.total() * 1000:.1f}ms)"
+
+
+class ProbeResponse:
+    """
+        A completely read HTTP response, along with the timings of the request.
+
+        Mimics the parts of http.client.HTTPResponse the checks use.
+    """
+
+    def __init__(self, response, data, timings):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.data = data
+        self.timings = timings
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self):
+        return self.data
+
+
+def record_timings(name, timings, quiet=False):
+    """
+        Report the timings of a request and keep them with the running check.
+    """
+    if not quiet:
+        print(f"  Timings: {timings}")
+    recorded = getattr(_context, 'timings', None)
+    if recorded is not None:
+        recorded.append((name, timings))
+
+
+def print_distribution(name, values):
+    if not values:
+        print(f"  {name}: no samples")
+        return
+    p50, p90, p99 = percentiles(values, (0.5, 0.9, 0.99))
+    print(f"  {name}: min {min(values) * 1000:.1f}ms, p50 {p50 * 1000:.1f}ms, p90 {p90 * 1000:.1f}ms,"
+          f" p99 {p99 * 1000:.1f}ms, max {max(values) * 1000:.1f}ms ({len(values)} samples)")
+
+
+def run_parallel(funcs, workers=None):
+    """
+        Run callables at the same time (at most `workers`) on behalf of the running check.
+
+        The output of each is collected separately and printed in order once all
+        are done, timings and errors are kept with the check. Returns the results
+        in order.
+    """
+    timings = getattr(_context, 'timings', None)
+    errors = getattr(_context, 'errors', None)
+
+    def run(func):
+        _context.output = io.StringIO()
+        _context.timings = timings
+        _context.errors = errors
+        try:
+            return func(), _context.output.getvalue()
+        finally:
+            _context.output = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or len(funcs)) as executor:
+        results = list(executor.map(run, funcs))
+
+    for _result, output in results:
+        sys.stdout.write(output)
+    return [result for result, _output in results]
+
+
+class ConnectionPool:
+    """
+        Keep-alive HTTP(S) connections, keyed by scheme, host and port.
+
+        Connections are handed out again once the previous response is read, to
+        later checks as well as to redirects. New TLS connections to a host
+        resume the last TLS session of that host, if the server allows it.
+    """
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.sessions = {}
+
+    def get(self, scheme, host, port, timings, reuse=True):
+        """
+            An idle connection, or a new one if there is none (or `reuse` is off).
+            Connection setup is recorded in `timings`.
+        """
+        key = (scheme, host, port)
+        with self.lock:
+            if reuse and self.idle[key]:
+                timings.connection = "reused"
+                return self.idle[key].pop()
+
+        with timings.phase('dns'):
+            address = socket.getaddrinfo(*connect_address(host, port), type=socket.SOCK_STREAM)[0][4]
+
+        with timings.phase('connect'):
+            sock = socket.create_connection(address[:2])
+        # Like HTTPConnection.connect(), headers and body are sent separately
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if scheme == 'https':
+            context = ssl_context()
+            with timings.phase('tls'):
+                sock = context.wrap_socket(sock, server_hostname=host, session=self.sessions.get(key))
+            timings.connection = "resumed" if sock.session_reused else "new"
+            conn = http.client.HTTPSConnection(host, port, context=context)
+        else:
+            timings.connection = "new"
+            conn = http.client.HTTPConnection(host, port)
+        conn.sock = sock
+        return conn
+
+    def put(self, scheme, host, port, conn, max_idle=None):
+        """
+            Hand back a connection after its response was read completely, keeping
+            up to `max_idle` (default: the limit of the pool) idle connections to the host.
+        """
+        key = (scheme, host, port)
+        with self.lock:
+            if scheme == 'https':
+                # With TLS 1.3 the session ticket only arrives after the handshake
+                self.sessions[key] = conn.sock.session
+            if len(self.idle[key]) < (max_idle or self.max_idle):
+                self.idle[key].append(conn)
+                return
+        conn.close()
+
+
+pool = ConnectionPool()
+
+
+# Redirects followed by http_request() before giving up
+MAX_REDIRECTS = 10
+
+
+def http_request(url, method, params=None, headers=None, body=None, verbose=False, quiet=False, max_idle=None):
+    """
+        Perform an HTTP request, following up to MAX_REDIRECTS redirects.
+
+        Connections come from the shared keep-alive pool. The response is read
+        completely and the time spent on name resolution, TCP connect, TLS
+        handshake, time to first byte and body transfer is recorded separately
+        in `response.timings`, along with whether the connection was reused.
+        The time of the redirects before the final response is its `redirect` phase.
+
+        `max_idle` overrides the number of idle connections the pool keeps to the host.
+    """
 
     if params is None:
         params = {}
@@ -78,24 +340,293 @@ def http_request(url, method, params=None, headers=None, body=None, verbose=Fals
     if body is None:
         body = urllib.parse.urlencode(params)
 
+    redirect = 0
+    location = url
+    for _ in range(MAX_REDIRECTS + 1):
+        response, data, timings = http_exchange(location, method, headers, body, verbose, quiet, max_idle)
+        if response.status not in (301, 302,):
+            break
+        if not quiet:
+            print("Following redirect ", response.getheader('location', ''))
+        redirect += timings.total()
+        location = urllib.parse.urljoin(location, response.getheader('location', ''))
+    else:
+        raise http.client.HTTPException(f"More than {MAX_REDIRECTS} redirects from {url}")
+
+    if redirect:
+        timings.add('redirect', redirect)
+    record_timings(f"{method} {url}", timings, quiet)
+
+    return ProbeResponse(response, data, timings)
+
+
+def http_exchange(url, method, headers, body, verbose, quiet, max_idle=None):
+    """
+        One request and its completely read response on a pooled connection,
+        returns the response, its body and the timings.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    scheme = 'https' if url.startswith('https://') else 'http'
+    port = parsed_url.port or (443 if scheme == 'https' else 80)
+
     # Assemble a relative url
-    url = urllib.parse.urlunsplit(["", "", parsed_url.path, parsed_url.query, parsed_url.fragment])
-    print(f"Requesting {url} From {parsed_url.netloc} Using {method}")
-    conn.request(method, url, body, headers)
-    response = conn.getresponse()
-
-    # Handle redirects
-    if response.status in (301, 302,):
-        print("Following redirect ", response.getheader('location', ''))
-        return http_request(
-            urllib.parse.urljoin(url, response.getheader('location', '')),
-            method,
-            params,
-            headers,
-            body,
-            verbose)
+    path = urllib.parse.urlunsplit(["", "", parsed_url.path, parsed_url.query, parsed_url.fragment])
+    if not quiet:
+        print(f"Requesting {path} From {parsed_url.netloc} Using {method}")
+
+    reuse = True
+    while True:
+        timings = PhaseTimings()
+        conn = pool.get(scheme, parsed_url.hostname, port, timings, reuse)
+        conn.set_debuglevel(9 if verbose else 0)
+        try:
+            with timings.phase('ttfb'):
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            break
+        except (http.client.BadStatusLine, ConnectionResetError, BrokenPipeError, socket.timeout):
+            conn.close()
+            # The idle connection went stale in the meantime (closed by the server
+            # or dropped on the way), try once more on a fresh one
+            if timings.connection != "reused":
+                raise
+            reuse = False
+        except BaseException:
+            conn.close()
+            raise
+
+    try:
+        with timings.phase('transfer'):
+            data = response.read()
+    except BaseException:
+        # Never hand back a connection with a half read response
+        conn.close()
+        raise
+    timings.size = len(data)
+
+    if response.will_close:
+        conn.close()
+    else:
+        pool.put(scheme, parsed_url.hostname, port, conn, max_idle)
+
+    return response, data, timings
+
 
-    return response
+class CheckOutput:
+    """
+        Stand-in for sys.stdout that collects what a running check prints
+        in a buffer of its own, so concurrent checks don't interleave.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        output = getattr(_context, 'output', None)
+        if output is not None:
+            return output.write(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        if getattr(_context, 'output', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Check:
+    """
+        A single named check.
+
+        Checks that are not fatal are reported, but don't change the exit code.
+        A check only starts once the checks named in `after` (of the same tenant)
+        are finished. `host` is the frontend the check talks to, if any.
+    """
+
+    def __init__(self, name, func, success_message, fatal=True, after=None, host=None, tenant=None, target=None):
+        self.name = name
+        self.func = func
+        self.success_message = success_message
+        self.fatal = fatal
+        self.after = after or []
+        self.host = host
+        self.tenant = tenant
+        self.target = target
+
+        self.success = None
+        self.timed_out = False
+        self.finished = None
+        self.duration = None
+        self.output = ""
+        self.timings = []
+        self.errors = []
+        self.baseline = None
+        self.regression = False
+
+    @property
+    def key(self):
+        return (self.tenant, self.name)
+
+    def run(self):
+        """
+            Run the check in the current thread, returns (success, output, duration, timings, errors).
+        """
+        _context.output = io.StringIO()
+        _context.timings = []
+        _context.errors = []
+        start = time.monotonic()
+        try:
+            success = bool(self.func())
+        except Exception as err:  # pylint: disable=broad-except
+            print_error(f"{self.name} failed: {err!r}")
+            success = False
+        duration = time.monotonic() - start
+        result = (success, _context.output.getvalue(), duration, _context.timings, _context.errors)
+        _context.output = None
+        _context.timings = None
+        _context.errors = None
+        return result
+
+    def record(self, verbose=False):
+        """
+            The outcome of the check as a plain dict, e.g. to be serialized as json.
+
+            Phases are summed up over all requests the check made.
+        """
+        if self.timed_out:
+            status = "timeout"
+        else:
+            status = "pass" if self.success else "fail"
+
+        phases = {}
+        connections = collections.Counter()
+        response_size = 0
+        for _request, timings in self.timings:
+            for phase, duration in timings.phases.items():
+                phases[phase] = round(phases.get(phase, 0) + duration, 6)
+            if timings.connection:
+                connections[timings.connection] += 1
+            response_size += timings.size
+
+        record = {
+            "name": self.name,
+            "tenant": self.tenant,
+            "target": self.target,
+            "status": status,
+            "fatal": self.fatal,
+            "finished": self.finished,
+            "duration": round(self.duration or 0, 6),
+            "phases": phases,
+            "requests": len(self.timings),
+            "connections": dict(connections),
+            "response_size": response_size,
+            "error": self.errors[-1] if self.errors else None,
+        }
+        if self.baseline is not None:
+            record["baseline"] = round(self.baseline, 6)
+            record["regression"] = self.regression
+        if verbose:
+            record["output"] = self.output
+        return record
+
+
+def run_checks(checks, concurrency, timeout, per_host=None):
+    """
+        Run checks concurrently, at most `concurrency` at a time, and yield them as they finish.
+
+        With `per_host` no more than that many checks talk to the same host at once.
+
+        A check that is still running after `timeout` seconds is yielded as timed out.
+        Its thread is abandoned (threads can't be killed), but it is a daemon thread,
+        so it doesn't keep the process alive.
+    """
+    finished = queue.Queue()
+    pending = list(checks)
+    running = {}
+    per_host_running = collections.Counter()
+    keys = {check.key for check in checks}
+    done = set()
+
+    def run(check):
+        finished.put((check, *check.run()))
+
+    def ready(check):
+        if per_host and check.host and per_host_running[check.host] >= per_host:
+            return False
+        return all((check.tenant, name) in done or (check.tenant, name) not in keys for name in check.after)
+
+    def stop(check):
+        del running[check]
+        per_host_running[check.host] -= 1
+        done.add(check.key)
+
+    while pending or running:
+        for check in list(pending):
+            if len(running) >= max(concurrency, 1):
+                break
+            if ready(check):
+                pending.remove(check)
+                running[check] = time.monotonic()
+                per_host_running[check.host] += 1
+                threading.Thread(target=run, args=(check,), daemon=True).start()
+
+        if not running:
+            # Only checks waiting for each other are left
+            for check in pending:
+                check.success = False
+                check.finished = time.time()
+                check.output = f"  ERROR {check.name} waits for a check that never runs\n"
+                check.errors = ["waits for a check that never runs"]
+                yield check
+            return
+
+        deadline = min(running.values()) + timeout
+        try:
+            check, success, output, duration, timings, errors = finished.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            now = time.monotonic()
+            for check, started in list(running.items()):
+                if now - started >= timeout:
+                    stop(check)
+                    check.success = False
+                    check.timed_out = True
+                    check.finished = time.time()
+                    check.duration = now - started
+                    check.output = ""
+                    check.timings = []
+                    check.errors = [f"did not finish within {timeout}s"]
+                    yield check
+            continue
+
+        if check not in running:
+            # Already reported as timed out
+            continue
+
+        stop(check)
+        check.success = success
+        check.timed_out = False
+        check.finished = time.time()
+        check.output = output
+        check.duration = duration
+        check.timings = timings
+        check.errors = errors
+        yield check
+
+
+def in_order(checks, results):
+    """
+        Reorder finished checks back into report order, yielding each as soon as
+        all checks before it are finished.
+    """
+    position = {check: index for index, check in enumerate(checks)}
+    ready = {}
+    next_index = 0
+    for check in results:
+        ready[position[check]] = check
+        while next_index in ready:
+            yield ready.pop(next_index)
+            next_index += 1
 
 
 def basic_auth_headers(username, password):
@@ -177,6 +708,69 @@ def test_freebusy_unauthenticated(url, username, password, verbose = False):
     return try_get("Unauthenticated Freebusy", f"{url}/{username}.ifb", verbose)
 
 
+def load_users(value):
+    """
+        Users from a comma separated list, or from a file with a user per line.
+    """
+    if os.path.isfile(value):
+        with open(value, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return [user.strip() for user in value.split(',') if user.strip()]
+
+
+def test_freebusy_sweep(url, users, username, password, verbose=False, concurrency=16):
+    """
+        Request the freebusy of many users at once, authenticated, like Roundcube
+        does for the attendees of a meeting.
+
+        Connections come from the shared pool, which keeps up to `concurrency`
+        idle connections to the freebusy host for this. The latency and size per
+        user and the overall throughput are reported.
+    """
+    if not users:
+        print_error("Freebusy sweep without users")
+        return False
+
+    headers = basic_auth_headers(username, password)
+    max_idle = max(pool.max_idle, concurrency)
+
+    def fetch(user):
+        try:
+            response = http_request(f"{url}/{user}.ifb", "GET", None, headers, None, verbose, quiet=True, max_idle=max_idle)
+        except (OSError, http.client.HTTPException) as err:
+            return user, None, err
+        return user, response, None
+
+    start = time.perf_counter()
+    results = run_parallel([functools.partial(fetch, user) for user in users], concurrency)
+    elapsed = time.perf_counter() - start
+
+    success = True
+    latencies = []
+    size = 0
+    width = max(len(user) for user in users)
+    for user, response, error in results:
+        if error is not None:
+            print(f"  {user:<{width}}  ERROR {error}")
+            success = False
+            continue
+        latencies.append(response.timings.total())
+        size += response.timings.size
+        print(f"  {user:<{width}}  {response.status}  {response.timings.size:>8}B  {response.timings.total() * 1000:>8.1f}ms"
+              f"  ({response.timings.connection} connection)")
+        if response.status != 200:
+            success = False
+
+    print(f"  {len(users)} users in {elapsed:.2f}s: {len(users) / elapsed:.1f} requests/s,"
+          f" {size / elapsed / 1024:.1f}KB/s, {concurrency} at a time")
+    print_distribution("Latency", latencies)
+
+    if not success:
+        print_error("Freebusy sweep failed for some users")
+
+    return success
+
+
 def test_autoconfig(host, username, password, verbose = False):
     if not try_get("Autoconf .well-known", f"https://{host}/.well-known/autoconfig/mail/config-v1.1.xml?emailaddress={username}", verbose):
         return False
@@ -345,10 +939,122 @@ def test_activesync(host, username, password, verbose = False):
     return success
 
 
+class Resolver:
+    """
+        The dns resolver shared by all checks of a run.
+
+        Queries are answered from a thread pool, so a check can send all its
+        queries at once and only then wait for the answers. Identical queries are
+        sent only once, also while still in flight, and answers are cached for
+        their TTL. NXDOMAIN and empty answers are cached for NEGATIVE_TTL seconds.
+    """
+
+    NEGATIVE_TTL = 60
+
+    def __init__(self, workers=32):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    @functools.cached_property
+    def resolver(self):
+        return dns.resolver.Resolver()
+
+    @functools.cached_property
+    def executor(self):
+        return concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="dns")
+
+    def query(self, name, rdtype):
+        """
+            Start a query (unless already cached or in flight), returns a future for the answer.
+        """
+        key = (str(name).lower().rstrip('.'), rdtype)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, future = entry
+                if expires is None or expires > time.time():
+                    return future
+            future = self.executor.submit(self.resolver.resolve, key[0], rdtype)
+            self.entries[key] = (None, future)
+        future.add_done_callback(lambda future: self._expire(key, future))
+        return future
+
+    def _expire(self, key, future):
+        error = future.exception()
+        with self.lock:
+            if error is None:
+                self.entries[key] = (future.result().expiration, future)
+            elif isinstance(error, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)):
+                self.entries[key] = (time.time() + self.NEGATIVE_TTL, future)
+            else:
+                # Don't hold on to timeouts and the like
+                self.entries.pop(key, None)
+
+    def prefetch(self, queries):
+        """
+            Send a batch of (name, rdtype) queries at once.
+        """
+        for name, rdtype in queries:
+            self.query(name, rdtype)
+
+    def resolve(self, name, rdtype):
+        return self.query(name, rdtype).result()
+
+    def addresses(self, host):
+        """
+            The IPv4 and IPv6 addresses of a host, like dns.resolver.resolve_name().
+        """
+        self.prefetch([(host, 'A'), (host, 'AAAA')])
+        addresses = []
+        errors = []
+        for rdtype in ('A', 'AAAA'):
+            try:
+                addresses.extend(str(rdata) for rdata in self.resolve(host, rdtype))
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as err:
+                errors.append(err)
+        if not addresses:
+            raise errors[0]
+        return addresses
+
+    def reverse(self, address):
+        """
+            The PTR records of an address, like dns.resolver.resolve_address().
+        """
+        return self.resolve(dns.reversename.from_address(address), 'PTR')
+
+
+resolver = Resolver()
+
+
 def test_dns(host, verbose = False):
     success = True
+
+    srv_records = [
+        f"_autodiscover._tcp.{host}",
+        f"_caldav._tcp.{host}",
+        f"_caldavs._tcp.{host}",
+        f"_carddav._tcp.{host}",
+        f"_carddavs._tcp.{host}",
+        f"_imap._tcp.{host}",
+        f"_imaps._tcp.{host}",
+        f"_sieve._tcp.{host}",
+        f"_submission._tcp.{host}",
+        f"_webdav._tcp.{host}",
+        f"_webdavs._tcp.{host}",
+    ]
+
+    # Send everything at once, the answers are collected below
+    resolver.prefetch([
+        (host, 'MX'),
+        (host, 'A'),
+        (host, 'AAAA'),
+        (f"autodiscover.{host}", 'CNAME'),
+        *((record, 'SRV') for record in srv_records),
+    ])
+
     try:
-        answers = dns.resolver.resolve(host, 'MX')
+        answers = resolver.resolve(host, 'MX')
         for rdata in answers:
             print('  MX Host', rdata.exchange, 'has preference', rdata.preference)
     except dns.resolver.NXDOMAIN:
@@ -363,7 +1069,7 @@ def test_dns(host, verbose = False):
         print("  ERROR on Reverse lookup")
 
     try:
-        answers = dns.resolver.resolve(f"autodiscover.{host}", 'CNAME')
+        answers = resolver.resolve(f"autodiscover.{host}", 'CNAME')
         for rdata in answers:
             print('  autodiscover CNAME', rdata.target)
     except dns.resolver.NXDOMAIN:
@@ -373,23 +1079,9 @@ def test_dns(host, verbose = False):
         success = False
         print(f"  ERROR on autodiscover.{host} CNAME entry")
 
-    srv_records = [
-        f"_autodiscover._tcp.{host}",
-        f"_caldav._tcp.{host}",
-        f"_caldavs._tcp.{host}",
-        f"_carddav._tcp.{host}",
-        f"_carddavs._tcp.{host}",
-        f"_imap._tcp.{host}",
-        f"_imaps._tcp.{host}",
-        f"_sieve._tcp.{host}",
-        f"_submission._tcp.{host}",
-        f"_webdav._tcp.{host}",
-        f"_webdavs._tcp.{host}",
-    ]
-
     for record in srv_records:
         try:
-            answers = dns.resolver.resolve(record, 'SRV')
+            answers = resolver.resolve(record, 'SRV')
             for rdata in answers:
                 print("  ", record, rdata.target)
         except dns.resolver.NXDOMAIN:
@@ -408,9 +1100,11 @@ def test_dns(host, verbose = False):
 def test_reverse_lookup(host, verbose=False):
     success = True
     try:
-        for address in dns.resolver.resolve_name(host).addresses():
+        addresses = resolver.addresses(host)
+        resolver.prefetch((dns.reversename.from_address(address), 'PTR') for address in addresses)
+        for address in addresses:
             print(f"  {host} resolves to", address)
-            reverseLookupResult = list(map(lambda x: str(x), dns.resolver.resolve_address(address)))
+            reverseLookupResult = list(map(lambda x: str(x), resolver.reverse(address)))
             print(f"  Reverse lookup result", reverseLookupResult)
             if f"{host}." not in reverseLookupResult:
                 success = False
@@ -428,17 +1122,18 @@ def test_reverse_lookup(host, verbose=False):
 def test_email_dns(host, verbose = False):
     success = True
 
-    if not test_reverse_lookup(host, verbose):
-        success = False
-        print("  ERROR on Reverse lookup")
-
     srv_records = [
         f"_autodiscover._tcp.{host}"
     ]
+    resolver.prefetch([(host, 'A'), (host, 'AAAA'), *((record, 'SRV') for record in srv_records)])
+
+    if not test_reverse_lookup(host, verbose):
+        success = False
+        print("  ERROR on Reverse lookup")
 
     for record in srv_records:
         try:
-            answers = dns.resolver.resolve(record, 'SRV')
+            answers = resolver.resolve(record, 'SRV')
             for rdata in answers:
                 print("  ", record, rdata.target)
         except dns.resolver.NXDOMAIN:
@@ -457,7 +1152,7 @@ def test_dmarc_dns(host, verbose = False):
     success = True
 
     try:
-        answers = dns.resolver.resolve(f"_dmarc.{host}", 'TXT')
+        answers = resolver.resolve(f"_dmarc.{host}", 'TXT')
         for rdata in answers:
             print("  _dmarc TXT", rdata)
     except dns.resolver.NXDOMAIN:
@@ -487,14 +1182,14 @@ def test_spf_dns(host, verbose = False):
     success = False
 
     try:
-        answers = dns.resolver.resolve(f"{host}", 'TXT')
+        answers = resolver.resolve(f"{host}", 'TXT')
         for rdata in answers:
             if validate_spf_record(rdata):
                 print("  SPF TXT", rdata)
                 success = True
                 break
             else:
-                print(f"  ERROR while validating spf record {data}")
+                print(f"  ERROR while validating spf record {rdata}")
 
     except dns.resolver.NXDOMAIN:
         success = False
@@ -521,13 +1216,13 @@ def test_dkim_dns(host, selector, verbose = False):
     success = False
 
     try:
-        answers = dns.resolver.resolve(f"{selector}._domainkey.{host}", 'TXT')
+        answers = resolver.resolve(f"{selector}._domainkey.{host}", 'TXT')
         for rdata in answers:
             print(f"  DKIM {selector}", rdata)
             if validate_dkim_record(rdata):
                 success = True
             else:
-                print(f"  ERROR while validating dkim key {data}")
+                print(f"  ERROR while validating dkim key {rdata}")
     except dns.resolver.NXDOMAIN:
         success = False
         print("  ERROR on DKIM TXT")
@@ -546,13 +1241,13 @@ def test_mta_sts(host, verbose = False):
 
     # lookup https://mta-sts.kolabnow.com/.well-known/mta-sts.txt
     try:
-        answers = dns.resolver.resolve(f"_mta_sts.{host}", 'TXT')
+        answers = resolver.resolve(f"_mta-sts.{host}", 'TXT')
         for rdata in answers:
             print("  MTA-STS ", rdata)
-            if rdata.startswith("v=STSv1;"):
+            if b"".join(rdata.strings).startswith(b"v=STSv1;"):
                 success = True
             else:
-                print(f"  ERROR while validating dkim key {rdata}")
+                print(f"  ERROR while validating mta-sts record {rdata}")
     except dns.resolver.NXDOMAIN:
         success = False
         print("  ERROR on MTA-STS TXT")
@@ -560,7 +1255,7 @@ def test_mta_sts(host, verbose = False):
         success = False
         print("  ERROR on MTA-STS TXT")
 
-    if not try_get(f"https://mta-sts.{host}/.well-known/mta-sts.txt"):
+    if not try_get("MTA-STS policy", f"https://mta-sts.{host}/.well-known/mta-sts.txt", verbose):
         success = False
         print("  Failed to get the mta-sts policy")
     # TODO validate policy and potentially cross check with spf policy?
@@ -571,7 +1266,202 @@ def test_mta_sts(host, verbose = False):
     return success
 
 
-def test_imap(host, user, password, verbose):
+class IMAPProbe:
+    """
+        Additions to imaplib for probing: connect and TLS handshake are timed
+        separately, and it supports COMPRESS=DEFLATE and IDLE.
+    """
+
+    def __init__(self, *args, timings, **kwargs):
+        self.timings = timings
+        self._deflate = None
+        self._inflate = None
+        self._inbuf = b""
+        super().__init__(*args, **kwargs)
+
+    def _create_socket(self, timeout):
+        address = connect_address(self.host, self.port)
+        with self.timings.phase('connect'):
+            if timeout is None:
+                sock = socket.create_connection(address)
+            else:
+                sock = socket.create_connection(address, timeout)
+        if isinstance(self, imaplib.IMAP4_SSL):
+            with self.timings.phase('tls'):
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+        return sock
+
+    def compress(self):
+        """
+            Enable COMPRESS=DEFLATE (RFC 4978) for the rest of the session.
+        """
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ == 'OK':
+            self._deflate = zlib.compressobj(wbits=-15)
+            self._inflate = zlib.decompressobj(wbits=-15)
+        return typ, data
+
+    def send(self, data):
+        if self._deflate:
+            data = self._deflate.compress(data) + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+    def _fill(self):
+        data = self.sock.recv(16384)
+        if not data:
+            raise self.abort("socket error: EOF")
+        self._inbuf += self._inflate.decompress(data)
+
+    def read(self, size):
+        if not self._inflate:
+            return super().read(size)
+        while len(self._inbuf) < size:
+            self._fill()
+        data, self._inbuf = self._inbuf[:size], self._inbuf[size:]
+        return data
+
+    def readline(self):
+        if not self._inflate:
+            return super().readline()
+        while b"\n" not in self._inbuf:
+            self._fill()
+        line, _, self._inbuf = self._inbuf.partition(b"\n")
+        return line + b"\n"
+
+    def idle_wakeup(self, trigger):
+        """
+            IDLE on the selected mailbox, run `trigger` in a thread and measure how
+            long after it returned the server announces the new message.
+
+            Returns the wake-up latency and the result of `trigger`, raises the
+            exception of `trigger` as soon as it fails.
+        """
+        tag = self._new_tag()
+        self.send(tag + b" IDLE\r\n")
+        line = self.readline()
+        if not line.startswith(b"+"):
+            raise self.error(f"IDLE not accepted: {line!r}")
+
+        lock = threading.Lock()
+        idling = [True]
+
+        def done():
+            # Whoever ends the IDLE first, the trigger on failure or the wait below
+            with lock:
+                if idling[0]:
+                    idling[0] = False
+                    self.send(b"DONE\r\n")
+
+        triggered = []
+        failed = []
+        finished = threading.Event()
+
+        def run():
+            try:
+                triggered.append((trigger(), time.perf_counter()))
+            except Exception as err:  # pylint: disable=broad-except
+                failed.append(err)
+                # Ends the wait for the notification below with the tagged response
+                done()
+            finally:
+                finished.set()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while b"EXISTS" not in line and not line.startswith(tag):
+            line = self.readline()
+        notified = time.perf_counter()
+
+        done()
+        while not line.startswith(tag):
+            line = self.readline()
+
+        if not finished.wait(self.sock.gettimeout() or 60):
+            raise self.error("Appending the IDLE probe message did not finish")
+        thread.join()
+        if failed:
+            raise failed[0]
+        result, appended = triggered[0]
+        # The notification may even overtake the APPEND response
+        return max(notified - appended, 0), result
+
+
+@functools.lru_cache(maxsize=None)
+def probe_imap_class(usessl):
+    """
+        The IMAP4 or IMAP4_SSL class with the IMAPProbe additions, created on first use.
+    """
+    # Not known to imaplib
+    imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+    imaplib.Commands.setdefault('IDLE', ('AUTH', 'SELECTED'))
+    base = imaplib.IMAP4_SSL if usessl else imaplib.IMAP4
+    return type(f"Probe{base.__name__}", (IMAPProbe, base), {})
+
+
+def append_idle_probe(host, port, usessl, user, password):
+    """
+        Append a message (already flagged as deleted) to the INBOX on a separate session.
+
+        Returns the session, the UID of the message if the server supports UIDPLUS,
+        and its Message-ID.
+    """
+    timings = PhaseTimings("imap")
+    if usessl:
+        imap = probe_imap_class(True)(host=host, port=port, ssl_context=ssl_context(), timings=timings)
+    else:
+        imap = probe_imap_class(False)(host=host, port=port, timings=timings)
+    message_id = f"<{uuid.uuid4()}@kolabendpointtester>"
+    message = (
+        f"From: {user}\r\nTo: {user}\r\nSubject: kolabendpointtester IDLE probe\r\n"
+        f"Message-ID: {message_id}\r\n\r\nIDLE probe\r\n"
+    ).encode()
+    try:
+        imap.login(user, password)
+        status, data = imap.append('INBOX', '(\\Seen \\Deleted)', None, message)
+        assert status == 'OK', f"APPEND failed: {data}"
+    except Exception:
+        close_imap(imap)
+        raise
+    match = re.search(rb"APPENDUID \d+ (\d+)", data[0] or b"")
+    return imap, match.group(1).decode() if match else None, message_id
+
+
+def remove_idle_probe(imap, uid, message_id):
+    """
+        Expunge the IDLE probe message, found by its Message-ID without UIDPLUS.
+    """
+    imap.select('INBOX')
+    if uid:
+        imap.uid('EXPUNGE', uid)
+        return
+    status, data = imap.uid('SEARCH', None, 'HEADER', 'Message-ID', f'"{message_id}"')
+    uids = (data[0] or b"").decode().split() if status == 'OK' else []
+    if uids:
+        imap.uid('STORE', ",".join(uids), '+FLAGS', '(\\Deleted)')
+        imap.expunge()
+
+
+def close_imap(imap):
+    """
+        Log out (or at least close) a session, whatever state it is in.
+    """
+    if imap.state == 'LOGOUT':
+        return
+    try:
+        imap.logout()
+    except Exception:  # pylint: disable=broad-except
+        imap.shutdown()
+
+
+def test_imap(host, user, password, verbose, idle=False, compress=False):
+    """
+        Log in and time the steps of a typical client session.
+
+        Connect, TLS, greeting, LOGIN, LIST, SELECT INBOX, a small FETCH and LOGOUT
+        are timed separately on one session. Optionally COMPRESS=DEFLATE is enabled
+        after LOGIN, and the IDLE wake-up latency is measured by appending a message
+        to the INBOX from a second session (and removing it again).
+    """
     success = True
 
     hosts = [
@@ -584,26 +1474,61 @@ def test_imap(host, user, password, verbose):
             print("Connecting to ", hosttuple)
 
         host, port, usessl, starttls = hosttuple
+        timings = PhaseTimings("imap")
+        imap = None
+        # The session of the IDLE probe message, once appended
+        probe = {}
 
         try:
+            start = time.perf_counter()
             if usessl:
-                imap = IMAP4_SSL(host=host, port=port)
+                imap = probe_imap_class(True)(host=host, port=port, ssl_context=ssl_context(), timings=timings)
             else:
-                imap = IMAP4(host=host, port=port)
+                imap = probe_imap_class(False)(host=host, port=port, timings=timings)
+            timings.add('greeting', time.perf_counter() - start - timings.total())
 
             if starttls:
-                imap.starttls()
+                with timings.phase('tls'):
+                    imap.starttls(ssl_context=ssl_context())
+
+            with timings.phase('login'):
+                imap.login(user, password)
+
+            if compress:
+                if 'COMPRESS=DEFLATE' in imap.capabilities:
+                    with timings.phase('compress'):
+                        status, _response = imap.compress()
+                    assert status == 'OK'
+                else:
+                    print("  COMPRESS=DEFLATE is not supported by", hosttuple)
+
+            with timings.phase('list'):
+                status, list_response = imap.list()
+            assert status == 'OK'
 
-            imap.login(user, password)
+            inbox_found = any('INBOX' in folder.decode('utf-8') for folder in list_response if folder)
+            assert inbox_found
 
-            status, list_response = imap.list()
+            with timings.phase('select'):
+                status, select_response = imap.select('INBOX', readonly=True)
             assert status == 'OK'
 
-            for folder in list_response:
-                if 'INBOX' in folder.decode('utf-8'):
-                    inbox_found = True
+            if int(select_response[0] or 0):
+                with timings.phase('fetch'):
+                    status, _response = imap.fetch('*', '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS (DATE SUBJECT)])')
+                assert status == 'OK'
 
-            assert inbox_found
+            if idle:
+                if 'IDLE' in imap.capabilities:
+                    wakeup, _ = imap.idle_wakeup(
+                        lambda: probe.setdefault('appended', append_idle_probe(host, port, usessl, user, password))
+                    )
+                    timings.add('idle', wakeup)
+                else:
+                    print("  IDLE is not supported by", hosttuple)
+
+            with timings.phase('logout'):
+                imap.logout()
 
         except AssertionError as err:
             print("  ERROR on peer", hosttuple, err)
@@ -613,55 +1538,176 @@ def test_imap(host, user, password, verbose):
             print("  ERROR on peer", hosttuple, err)
             success = False
 
+        finally:
+            if 'appended' in probe:
+                appender, uid, message_id = probe['appended']
+                try:
+                    remove_idle_probe(appender, uid, message_id)
+                except Exception as err:  # pylint: disable=broad-except
+                    print("  ERROR removing the IDLE probe message on peer", hosttuple, err)
+                close_imap(appender)
+            if imap is not None:
+                close_imap(imap)
+
+        record_timings(f"IMAP {host}:{port}", timings)
+
         if not success:
             print_error("IMAP failed")
 
     return success
 
 
-def test_smtp(host, user, password, verbose, testSMTPS=True):
-    success = True
+class SMTPProbe:
+    """
+        Additions to smtplib for probing: connect and TLS handshake are timed
+        separately, and messages can be pushed with ESMTP PIPELINING.
+    """
 
-    hosts = []
-    if testSMTPS:
-        hosts.append((host, 465, True, False))
-    hosts.append((host, 587, False, True))
+    def __init__(self, *args, timings, **kwargs):
+        self.timings = timings
+        super().__init__(*args, **kwargs)
+
+    def _get_socket(self, host, port, timeout):
+        with self.timings.phase('connect'):
+            sock = socket.create_connection(connect_address(host, port), timeout, self.source_address)
+        if isinstance(self, smtplib.SMTP_SSL):
+            with self.timings.phase('tls'):
+                sock = self.context.wrap_socket(sock, server_hostname=self._host)
+        return sock
+
+    def expect(self, *codes):
+        code, response = self.getreply()
+        if code not in codes:
+            raise smtplib.SMTPException(f"Unexpected reply {code} {response.decode(errors='replace')}")
+
+    def push_messages(self, sender, recipient, count):
+        """
+            Send `count` small messages from `sender` to `recipient` on this session.
+
+            With PIPELINING (RFC 2920) the envelope of a message is sent in one go,
+            and the message content together with the envelope of the next one,
+            otherwise every command waits for its reply.
+        """
+        def message(number):
+            return (
+                f"From: {sender}\r\nTo: {recipient}\r\nSubject: kolabendpointtester SMTP probe {number + 1}/{count}\r\n"
+                f"Message-ID: <{uuid.uuid4()}@kolabendpointtester>\r\n\r\nSMTP probe\r\n.\r\n"
+            ).encode()
+
+        if not self.has_extn('pipelining'):
+            for number in range(count):
+                self.sendmail(sender, [recipient], message(number)[:-3])
+            return
+
+        envelope = f"MAIL FROM:<{sender}>\r\nRCPT TO:<{recipient}>\r\nDATA\r\n".encode()
+        self.send(envelope)
+        for number in range(count):
+            self.expect(250)
+            self.expect(250, 251)
+            self.expect(354)
+            last = number == count - 1
+            self.send(message(number) + (b"" if last else envelope))
+            self.expect(250)
+
+
+@functools.lru_cache(maxsize=None)
+def probe_smtp_class(usessl):
+    """
+        The SMTP or SMTP_SSL class with the SMTPProbe additions, created on first use.
+    """
+    base = smtplib.SMTP_SSL if usessl else smtplib.SMTP
+    return type(f"Probe{base.__name__}", (SMTPProbe, base), {})
 
-    for hosttuple in hosts:
-        if verbose:
-            print("Connecting to ", hosttuple)
 
-        host, port, usessl, starttls = hosttuple
+def probe_smtp(host, port, usessl, starttls, user, password, verbose, messages=0):
+    """
+        Time the steps of a submission session on one port.
+    """
+    hosttuple = (host, port, usessl, starttls)
+    if verbose:
+        print("Connecting to ", hosttuple)
 
-        try:
-            if usessl:
-                smtp = SMTP_SSL(host=host, port=port)
-            else:
-                smtp = SMTP(host=host, port=port)
+    success = True
+    timings = PhaseTimings("smtp")
 
-            if starttls:
-                smtp.starttls()
+    try:
+        start = time.perf_counter()
+        if usessl:
+            smtp = probe_smtp_class(True)(host=host, port=port, context=ssl_context(), timings=timings)
+        else:
+            smtp = probe_smtp_class(False)(host=host, port=port, timings=timings)
+        timings.add('greeting', time.perf_counter() - start - timings.total())
+
+        # check we have an open socket
+        assert smtp.sock
 
-            # check we have an open socket
-            assert smtp.sock
+        with timings.phase('ehlo'):
+            status, _response = smtp.ehlo()
+        assert status == 250
 
-            # run a no-operation, which is basically a server-side pass-through
-            status, _response = smtp.noop()
+        if starttls:
+            with timings.phase('starttls'):
+                status, _response = smtp.starttls(context=ssl_context())
+                assert status == 220
+                status, _response = smtp.ehlo()
             assert status == 250
 
+        with timings.phase('auth'):
             status, _response = smtp.login(user, password)
-            assert status == 235
-
+        assert status == 235
+
+        # Envelope only, nothing is delivered
+        with timings.phase('accept'):
+            status, response = smtp.mail(user)
+            assert status == 250, response
+            status, response = smtp.rcpt(user)
+            assert status in (250, 251), response
+            status, _response = smtp.rset()
+        assert status == 250
+
+        if messages:
+            with timings.phase('messages'):
+                smtp.push_messages(user, user, messages)
+            duration = timings.phases['messages']
+            mode = "pipelined" if smtp.has_extn('pipelining') else "not pipelined"
+            print(f"  {messages} messages accepted by {host}:{port} in {duration:.2f}s"
+                  f" ({messages / duration:.1f} messages/s, {mode})")
+
+        with timings.phase('quit'):
             status, _response = smtp.quit()
-            assert status == 221
+        assert status == 221
 
-        except AssertionError as err:
-            print("  ERROR on peer", hosttuple, err)
-            success = False
+    except AssertionError as err:
+        print("  ERROR on peer", hosttuple, err)
+        success = False
 
-        except Exception as err:  # pylint: disable=broad-except
-            print("  ERROR on peer", hosttuple, err)
-            success = False
+    except Exception as err:  # pylint: disable=broad-except
+        print("  ERROR on peer", hosttuple, err)
+        success = False
+
+    record_timings(f"SMTP {host}:{port}", timings)
+    return success
+
+
+def test_smtp(host, user, password, verbose, testSMTPS=True, messages=0):
+    """
+        Time the steps of a submission session on 465 and 587, both at the same time.
+
+        Connect, TLS, greeting, EHLO, STARTTLS, AUTH and the acceptance of an envelope
+        (MAIL FROM and RCPT TO, followed by RSET) are timed separately. Optionally
+        `messages` small messages are sent to the user over the 587 session to
+        measure the throughput.
+    """
+    hosts = []
+    if testSMTPS:
+        hosts.append((host, 465, True, False, 0))
+    hosts.append((host, 587, False, True, messages))
+
+    results = run_parallel([
+        functools.partial(probe_smtp, host, port, usessl, starttls, user, password, verbose, count)
+        for host, port, usessl, starttls, count in hosts
+    ])
+    success = all(results)
 
     if not success:
         print_error("SMTP failed")
@@ -669,31 +1715,242 @@ def test_smtp(host, user, password, verbose, testSMTPS=True):
     return success
 
 
-def test_certificates(host, davhost, imaphost, verbose):
-    success = True
-    hosts = [
-        (host, 443),
+# Certificates scanned in an earlier round, by (hostname, port, starttls)
+_certificates = {}
+_certificates_lock = threading.Lock()
+
+# Rescan cached certificates at least this often, to notice replaced certificates
+CERTIFICATE_CACHE_TTL = 86400
+
+
+def certificate_covers(names, hostname):
+    """
+        Whether one of the subject alt names (wildcards included) matches the hostname.
+    """
+    hostname = hostname.lower()
+    for name in names:
+        name = name.lower()
+        if name == hostname:
+            return True
+        if name.startswith('*.') and '.' in hostname and hostname.split('.', 1)[1] == name[2:]:
+            return True
+    return False
+
+
+def der_children(data, start=0, end=None):
+    """
+        Yields (tag, content start, content end) of the DER values in data[start:end].
+    """
+    end = len(data) if end is None else end
+    while start < end:
+        tag, length = data[start], data[start + 1]
+        start += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(data[start:start + size], 'big')
+            start += size
+        yield tag, start, start + length
+        start += length
+
+
+def decode_certificate(der):
+    """
+        The expiry (seconds since the epoch), issuer and DNS subject alt names of a DER
+        certificate. getpeercert() only has them if the certificate was verified.
+    """
+    [(_, start, end)] = der_children(der)
+    _, start, end = next(der_children(der, start, end))
+    tbs = list(der_children(der, start, end))
+    # Skip the explicit version, then serial, signature algorithm, issuer, validity
+    if tbs[0][0] == 0xa0:
+        tbs = tbs[1:]
+    _, issuer_start, issuer_end = tbs[2]
+    _, validity_start, validity_end = tbs[3]
+
+    issuer = {}
+    for _, set_start, set_end in der_children(der, issuer_start, issuer_end):
+        for _, start, end in der_children(der, set_start, set_end):
+            (_, oid_start, oid_end), (_, value_start, value_end) = der_children(der, start, end)
+            name = {b"\x55\x04\x03": 'commonName', b"\x55\x04\x0a": 'organizationName'}.get(der[oid_start:oid_end])
+            if name:
+                issuer[name] = der[value_start:value_end].decode('utf-8', errors='replace')
+
+    kind, start, end = list(der_children(der, validity_start, validity_end))[1]
+    value = der[start:end].decode('ascii')
+    if kind == 0x17:
+        # UTCTime has a two digit year
+        value = ("19" if value[:2] >= "50" else "20") + value
+    not_after = calendar.timegm(time.strptime(value, "%Y%m%d%H%M%SZ"))
+
+    names = []
+    for kind, start, end in tbs[4:]:
+        if kind != 0xa3:
+            continue
+        [(_, start, end)] = der_children(der, start, end)
+        for _, extension_start, extension_end in der_children(der, start, end):
+            fields = list(der_children(der, extension_start, extension_end))
+            # subjectAltName (2.5.29.17), the value is the last field (after "critical")
+            if der[fields[0][1]:fields[0][2]] == b"\x55\x1d\x11":
+                _, value_start, value_end = fields[-1]
+                [(_, start, end)] = der_children(der, value_start, value_end)
+                names += [der[start:end].decode('ascii') for kind, start, end in der_children(der, start, end) if kind == 0x82]
+    return not_after, issuer.get('organizationName') or issuer.get('commonName'), names
+
+
+def fetch_certificate(hostname, port, starttls, context, timings):
+    """
+        Handshake with an endpoint, returns its certificate in DER form.
+    """
+    if starttls:
+        smtp = probe_smtp_class(False)(host=hostname, port=port, timings=timings)
+        try:
+            with timings.phase('tls'):
+                smtp.starttls(context=context)
+            return smtp.sock.getpeercert(binary_form=True)
+        finally:
+            smtp.close()
+
+    with timings.phase('connect'):
+        sock = socket.create_connection(connect_address(hostname, port))
+    with sock:
+        with timings.phase('tls'):
+            tls = context.wrap_socket(sock, server_hostname=hostname)
+        with tls:
+            return tls.getpeercert(binary_form=True)
+
+
+def scan_certificate(hostname, port, starttls=False):
+    """
+        Handshake with an endpoint and collect the details of its certificate.
+
+        The chain is verified, the hostname is matched against the subject alt
+        names separately, so a mismatch can be reported along with the names.
+        A certificate that fails verification (e.g. an expired one) is fetched
+        again without, so its expiry, issuer and names are reported along with
+        the verification error.
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+
+    timings = PhaseTimings("tls")
+    info = {'hostname': hostname, 'port': port, 'starttls': starttls, 'scanned': time.time(), 'verify_error': None}
+    try:
+        try:
+            der = fetch_certificate(hostname, port, starttls, context, timings)
+        except ssl.SSLCertVerificationError as err:
+            info['verify_error'] = err.verify_message or str(err)
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            timings = PhaseTimings("tls")
+            der = fetch_certificate(hostname, port, starttls, context, timings)
+        info['not_after'], info['issuer'], info['names'] = decode_certificate(der)
+    except (OSError, smtplib.SMTPException) as err:
+        info['error'] = str(err)
+        return info, timings
+    except (ValueError, IndexError) as err:
+        info['error'] = f"Undecodable certificate: {err}"
+        return info, timings
+
+    info['covered'] = certificate_covers(info['names'], hostname)
+    info['handshake'] = timings.phases['tls']
+    return info, timings
+
+
+def certificate_endpoints(host, davhost, imaphost, extra_hosts=None):
+    """
+        The (hostname, port, starttls) endpoints to scan.
+
+        Extra hosts are given as "host", "host:port" or "host:port/starttls".
+    """
+    endpoints = [
+        (host, 443, False),
     ]
 
     if davhost:
-        hosts.append((urllib.parse.urlparse(davhost).netloc, 443))
+        endpoints.append((urllib.parse.urlparse(davhost).hostname, 443, False))
     if imaphost:
-        hosts.append((imaphost, 993))
-        hosts.append((imaphost, 465))
+        endpoints.append((imaphost, 993, False))
+        endpoints.append((imaphost, 465, False))
+        endpoints.append((imaphost, 587, True))
 
-    context = ssl.create_default_context()
+    for extra in extra_hosts or []:
+        for entry in extra.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            address, _, mode = entry.partition('/')
+            hostname, _, port = address.rpartition(':') if ':' in address else (address, '', '443')
+            endpoints.append((hostname, int(port), mode == 'starttls'))
 
-    for hosttuple in hosts:
-        hostname, _port = hosttuple
-        try:
-            conn = context.wrap_socket(socket.socket(socket.AF_INET), server_hostname=hostname)
-            conn.connect(hosttuple)
-            cert = conn.getpeercert()
-            if verbose:
-                print(f"Certificate for {hosttuple}: {cert}")
-        except OSError as err:
-            print("  ERROR on peer", hosttuple, err)
+    # Keep the order, but don't scan an endpoint twice
+    return list(dict.fromkeys(endpoints))
+
+
+def test_certificates(host, davhost, imaphost, verbose, extra_hosts=None, warn_days=14):
+    """
+        Scan the certificates of all endpoints at once.
+
+        Certificates are cached between rounds until they get within `warn_days`
+        of their expiry (or CERTIFICATE_CACHE_TTL passed), expiring certificates fail the check.
+    """
+    success = True
+    endpoints = certificate_endpoints(host, davhost, imaphost, extra_hosts)
+    now = time.time()
+
+    results = {}
+    with _certificates_lock:
+        for endpoint in endpoints:
+            info = _certificates.get(endpoint)
+            if info and info['not_after'] - warn_days * 86400 > now and info['scanned'] + CERTIFICATE_CACHE_TTL > now:
+                results[endpoint] = (info, None)
+
+    scan = [endpoint for endpoint in endpoints if endpoint not in results]
+    if scan:
+        with concurrent.futures.ThreadPoolExecutor(len(scan)) as executor:
+            for endpoint, result in zip(scan, executor.map(lambda endpoint: scan_certificate(*endpoint), scan)):
+                results[endpoint] = result
+
+    for endpoint in endpoints:
+        info, timings = results[endpoint]
+        hostname, port, starttls = endpoint
+        name = f"{hostname}:{port}" + (" (STARTTLS)" if starttls else "")
+
+        if timings is None:
+            name += " (cached)"
+        elif timings.phases:
+            record_timings(f"TLS {hostname}:{port}", timings)
+
+        if 'error' in info:
+            print("  ERROR on peer", name, info['error'])
+            success = False
+            continue
+
+        days = (info['not_after'] - now) / 86400
+        expiry = time.strftime('%Y-%m-%d', time.gmtime(info['not_after']))
+        print(f"  {name}: expires {expiry} ({days:.0f} days), issued by {info['issuer']}, "
+              f"handshake {info['handshake'] * 1000:.1f}ms")
+        if verbose:
+            print(f"  {name}: subject alt names {', '.join(info['names'])}")
+
+        valid = True
+        if info['verify_error']:
+            print(f"  ERROR on peer {name}: certificate verification failed: {info['verify_error']}")
+            valid = False
+        if not info['covered']:
+            print(f"  ERROR on peer {name}: certificate doesn't cover {hostname} (only {', '.join(info['names'])})")
+            valid = False
+        if days < 0:
+            print(f"  ERROR on peer {name}: certificate expired {-days:.1f} days ago")
+            valid = False
+        elif days < warn_days:
+            print(f"  ERROR on peer {name}: certificate expires in {days:.1f} days")
+            valid = False
+        if not valid:
             success = False
+        elif timings is not None:
+            with _certificates_lock:
+                _certificates[endpoint] = info
 
     if not success:
         print_error("Not all certificates are valid")
@@ -701,7 +1958,227 @@ def test_certificates(host, davhost, imaphost, verbose):
     return success
 
 
-def test_meet(host, verbose):
+class SignalingSession:
+    """
+        A socket.io session with the meet server over a websocket.
+
+        The session stays on the engine.io level (there is no room to join),
+        it is kept open by answering the pings of the server.
+    """
+
+    GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def __init__(self, host, port=443, path="/meetmedia/signaling/"):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reader = None
+        self.writer = None
+
+    async def open(self, context):
+        """
+            Connect and upgrade to a websocket, returns the connect, upgrade and
+            first message latencies.
+        """
+        start = time.perf_counter()
+        address = connect_address(self.host, self.port)
+        self.reader, self.writer = await asyncio.open_connection(*address, ssl=context, server_hostname=self.host)
+        connected = time.perf_counter()
+
+        key = b64encode(os.urandom(16))
+        self.writer.write((
+            f"GET {self.path}?EIO=4&transport=websocket HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key.decode()}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+        head = (await self.reader.readuntil(b"\r\n\r\n")).decode(errors='replace')
+        if not head.startswith("HTTP/1.1 101"):
+            raise ValueError(f"Upgrade refused: {head.splitlines()[0]}")
+        import hashlib  # pylint: disable=import-outside-toplevel
+        accept = b64encode(hashlib.sha1(key + self.GUID).digest()).decode()
+        if f"sec-websocket-accept: {accept.lower()}" not in head.lower():
+            raise ValueError("Invalid Sec-WebSocket-Accept")
+        upgraded = time.perf_counter()
+
+        # The engine.io open packet
+        _opcode, payload = await self.receive()
+        if not payload.startswith(b"0"):
+            raise ValueError(f"Unexpected first message {payload[:40]!r}")
+        return connected - start, upgraded - connected, time.perf_counter() - upgraded
+
+    async def receive(self):
+        header = await self.reader.readexactly(2)
+        length = header[1] & 0x7f
+        if length == 126:
+            length = int.from_bytes(await self.reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await self.reader.readexactly(8), 'big')
+        mask = await self.reader.readexactly(4) if header[1] & 0x80 else None
+        payload = await self.reader.readexactly(length)
+        if mask:
+            payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        return header[0] & 0x0f, payload
+
+    def send(self, payload, opcode=0x1):
+        # Frames from clients are masked
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = bytes((0x80 | opcode, 0x80 | len(payload)))
+        else:
+            header = bytes((0x80 | opcode, 0x80 | 126)) + len(payload).to_bytes(2, 'big')
+        self.writer.write(header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+    async def hold(self, done):
+        """
+            Answer pings until `done` is set, returns False if the server ended
+            the session before.
+        """
+        stop = asyncio.ensure_future(done.wait())
+        try:
+            while True:
+                receive = asyncio.ensure_future(self.receive())
+                await asyncio.wait({receive, stop}, return_when=asyncio.FIRST_COMPLETED)
+                if not receive.done():
+                    receive.cancel()
+                    return True
+                try:
+                    opcode, payload = receive.result()
+                except (asyncio.IncompleteReadError, OSError):
+                    return False
+                if opcode == 0x8:
+                    return False
+                if opcode == 0x9:
+                    self.send(payload, 0xA)
+                elif payload == b"2":
+                    # engine.io ping
+                    self.send(b"3")
+                await self.writer.drain()
+        finally:
+            stop.cancel()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self.send((1000).to_bytes(2, 'big'), 0x8)
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+
+class MeetLoadTest:
+    """
+        Open `sessions` signaling sessions, `rate` per second (all at once if 0),
+        and hold them for `hold` seconds after the last one was opened.
+
+        The concurrency ceiling is the number of open sessions when the first
+        session failed to open or was dropped by the server.
+    """
+
+    def __init__(self, host, sessions, hold, rate=0, timeout=30):
+        self.host = host
+        self.sessions = sessions
+        self.hold = hold
+        self.rate = rate
+        self.timeout = timeout
+        self.latencies = {'connect': [], 'upgrade': [], 'first message': []}
+        self.failures = collections.Counter()
+        self.open = 0
+        self.peak = 0
+        self.held = 0
+        self.dropped = 0
+        self.ceiling = None
+
+    def failed(self, reason):
+        self.failures[reason] += 1
+        if self.ceiling is None:
+            self.ceiling = self.open
+
+    @staticmethod
+    def reason(err):
+        return f"{type(err).__name__}: {err}" if str(err) else type(err).__name__
+
+    async def session(self, number, context, attempted, done):
+        if self.rate:
+            await asyncio.sleep(number / self.rate)
+        session = SignalingSession(self.host)
+        # Whatever a misbehaving server makes a session fail with, the others go on
+        try:
+            latencies = await asyncio.wait_for(session.open(context), self.timeout)
+        except Exception as err:  # pylint: disable=broad-except
+            self.failed(self.reason(err))
+            await session.close()
+            return
+        finally:
+            attempted()
+
+        for name, latency in zip(self.latencies, latencies):
+            self.latencies[name].append(latency)
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+
+        try:
+            dropped = None if await session.hold(done) else "Dropped by the server"
+        except Exception as err:  # pylint: disable=broad-except
+            dropped = self.reason(err)
+        if dropped:
+            self.dropped += 1
+            self.failed(dropped)
+        self.open -= 1
+        await session.close()
+
+    async def run(self):
+        context = ssl_context()
+        done = asyncio.Event()
+        all_attempted = asyncio.Event()
+        attempts = []
+
+        def attempted():
+            attempts.append(1)
+            if len(attempts) == self.sessions:
+                all_attempted.set()
+
+        tasks = [asyncio.ensure_future(self.session(number, context, attempted, done)) for number in range(self.sessions)]
+        await all_attempted.wait()
+        await asyncio.sleep(self.hold)
+        self.held = self.open
+        done.set()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.failed(self.reason(result))
+
+    def report(self):
+        opened = len(self.latencies['connect'])
+        print(f"  Meet signaling load: {opened} of {self.sessions} sessions opened, peak {self.peak} open,"
+              f" {self.held} held for {self.hold:g}s, {self.dropped} dropped")
+        if self.ceiling is None:
+            print(f"  Concurrency ceiling not reached at {self.peak} sessions")
+        else:
+            print(f"  Concurrency ceiling reached at {self.ceiling} open sessions")
+        for name, values in self.latencies.items():
+            print_distribution(name.capitalize(), values)
+        for reason, count in self.failures.most_common():
+            print(f"  {count} x {reason}")
+
+
+def test_meet_load(host, sessions, hold, rate=0):
+    raise_open_files_limit(sessions)
+    load = MeetLoadTest(host, sessions, hold, rate, timeout=socket.getdefaulttimeout() or 30)
+    asyncio.run(load.run())
+    load.report()
+
+    success = not load.failures
+    if not success:
+        print_error(f"Meet signaling failed {sum(load.failures.values())} of {sessions} sessions")
+    return success
+
+
+def test_meet(host, verbose, sessions=0, hold=10, rate=0):
+    """
+        Check the signaling endpoint answers, and load test it with `sessions`
+        websocket sessions if given.
+    """
     headers = {
         "Host": host
     }
@@ -736,37 +2213,558 @@ def test_meet(host, verbose):
         print("  ", "Status", response.status)
         print("  ", data)
 
+    if success and sessions:
+        success = test_meet_load(host, sessions, hold, rate)
+
     return success
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--host", help="Host")
-    parser.add_argument("--username", help="Username")
-    parser.add_argument("--password", help="User password")
-    parser.add_argument("--imap", help="IMAP URI")
-    parser.add_argument("--smtp", help="SMTP URI")
-    parser.add_argument("--nosmtps", action='store_true', help="Boolean to disable the smtps check")
-    parser.add_argument("--dav", help="DAV URI")
-    parser.add_argument("--meet", help="MEET URI")
-    parser.add_argument("--autoconfig", help="Check autoconfig")
-    parser.add_argument("--dns", action='store_true', help="Check dns")
-    parser.add_argument("--dkim", help="Check DKIM dns record")
-    parser.add_argument("--mtasts", help="Check mta-sts")
-    parser.add_argument("--activesync", help="ActiveSync URI")
-    parser.add_argument("--certificates", action='store_true', help="Check Certificates")
-    parser.add_argument("--fb", help="Freebusy url as displayed in roundcube")
-    parser.add_argument("--verbose", action='store_true', help="Verbose output")
-    parser.add_argument("--default", action='store_true', help="Standard checks with only username and password")
-    options = parser.parse_args()
+CheckDefinition = collections.namedtuple(
+    'CheckDefinition',
+    ['name', 'enabled', 'run', 'success_message', 'target', 'host', 'fatal', 'after'],
+    defaults=[None, True, None]
+)
+
+
+def hostname(url):
+    return urllib.parse.urlparse(url).hostname
+
+
+# The registry of all checks, in report order.
+# Everything but the name and the flags is a function of the options of the run,
+# `host` is the frontend the check talks to (for --per-host-concurrency).
+CHECKS = [
+    CheckDefinition(
+        "Caldav",
+        enabled=lambda options: options.dav,
+        run=lambda options: discover_principal(options.dav, options.username, options.password, options.verbose),
+        success_message=lambda options: "Caldav is available",
+        target=lambda options: options.dav,
+        host=lambda options: hostname(options.dav)),
+    # Kolabnow doesn't support this atm (it offers the redirect on apps.kolabnow.com),
+    # so we ignore the error for now
+    CheckDefinition(
+        "Caldav redirect",
+        enabled=lambda options: options.dav and options.host,
+        run=lambda options: test_caldav_redirect(options.host, options.username, options.password, options.verbose),
+        success_message=lambda options: "Caldav on .well-known/caldav is available",
+        target=lambda options: f"https://{options.host}/.well-known/caldav",
+        host=lambda options: options.host,
+        fatal=False),
+    CheckDefinition(
+        "Autoconfig",
+        enabled=lambda options: options.autoconfig,
+        run=lambda options: test_autoconfig(options.host, options.username, options.password, options.verbose),
+        success_message=lambda options: "Autoconf available",
+        target=lambda options: options.host,
+        host=lambda options: options.host),
+    # Kolabnow doesn't support this, so we ignore the error for now
+    CheckDefinition(
+        "Activesync autodiscover",
+        enabled=lambda options: options.activesync and options.autoconfig,
+        run=lambda options: test_autodiscover_activesync(options.host, options.activesync, options.username, options.password, options.verbose),
+        success_message=lambda options: "Activesync Autodsicovery available",
+        target=lambda options: f"https://{options.host}/autodiscover/autodiscover.xml",
+        host=lambda options: options.host,
+        fatal=False),
+    CheckDefinition(
+        "Activesync",
+        enabled=lambda options: options.activesync,
+        run=lambda options: test_activesync(options.activesync, options.username, options.password, options.verbose),
+        success_message=lambda options: "Activesync available",
+        target=lambda options: f"https://{options.activesync}/Microsoft-Server-ActiveSync",
+        host=lambda options: options.activesync),
+    CheckDefinition(
+        "Authenticated freebusy",
+        enabled=lambda options: options.fb,
+        run=lambda options: test_freebusy_authenticated(options.fb, options.username, options.password, options.verbose),
+        success_message=lambda options: "Authenticated Freebusy is available",
+        target=lambda options: f"{options.fb}/{options.username}.ifb",
+        host=lambda options: hostname(options.fb)),
+    # We rely on the activesync test to have generated the token for unauthenticated access.
+    CheckDefinition(
+        "Unauthenticated freebusy",
+        enabled=lambda options: options.fb,
+        run=lambda options: test_freebusy_unauthenticated(options.fb, options.username, options.password, options.verbose),
+        success_message=lambda options: "Unauthenticated Freebusy is available",
+        target=lambda options: f"{options.fb}/{options.username}.ifb",
+        host=lambda options: hostname(options.fb),
+        after=["Activesync", "Authenticated freebusy"]),
+    CheckDefinition(
+        "Freebusy sweep",
+        enabled=lambda options: options.fb and options.fb_users,
+        run=lambda options: test_freebusy_sweep(options.fb, load_users(options.fb_users), options.username, options.password,
+                                                options.verbose, options.fb_concurrency),
+        success_message=lambda options: "Freebusy sweep succeeded",
+        target=lambda options: options.fb,
+        host=lambda options: hostname(options.fb),
+        fatal=False,
+        after=["Authenticated freebusy", "Unauthenticated freebusy"]),
+    CheckDefinition(
+        "DNS",
+        enabled=lambda options: options.dns,
+        run=lambda options: test_dns(options.host, options.verbose),
+        success_message=lambda options: f"DNS entries on {options.host} available",
+        target=lambda options: options.host),
+    CheckDefinition(
+        "DMARC",
+        enabled=lambda options: options.dns,
+        run=lambda options: test_dmarc_dns(options.host, options.verbose),
+        success_message=lambda options: f"DMARC DNS entries on {options.host} available",
+        target=lambda options: f"_dmarc.{options.host}"),
+    CheckDefinition(
+        "SPF",
+        enabled=lambda options: options.dns,
+        run=lambda options: test_spf_dns(options.host, options.verbose),
+        success_message=lambda options: f"SPF DNS entries on {options.host} available",
+        target=lambda options: options.host),
+    CheckDefinition(
+        "User DNS",
+        enabled=lambda options: options.dns,
+        run=lambda options: test_email_dns(options.username.split('@')[1], options.verbose),
+        success_message=lambda options: f"User DNS entries on {options.username.split('@')[1]} available",
+        target=lambda options: options.username.split('@')[1]),
+    CheckDefinition(
+        "DKIM",
+        enabled=lambda options: options.dkim,
+        run=lambda options: test_dkim_dns(options.host, options.dkim, options.verbose),
+        success_message=lambda options: f"DKIM DNS entries on {options.host} available",
+        target=lambda options: f"{options.dkim}._domainkey.{options.host}"),
+    CheckDefinition(
+        "MTA-STS",
+        enabled=lambda options: options.mtasts,
+        run=lambda options: test_mta_sts(options.host, options.verbose),
+        success_message=lambda options: f"MTA-STS on {options.host} available",
+        target=lambda options: f"_mta-sts.{options.host}"),
+    CheckDefinition(
+        "Certificates",
+        enabled=lambda options: options.certificates,
+        run=lambda options: test_certificates(options.host, options.dav, options.imap, options.verbose, options.cert_hosts, options.cert_warn_days),
+        success_message=lambda options: "All certificates are valid",
+        target=lambda options: options.host,
+        host=lambda options: options.host),
+    CheckDefinition(
+        "IMAP",
+        enabled=lambda options: options.imap,
+        run=lambda options: test_imap(options.imap, options.username, options.password, options.verbose, options.imap_idle, options.imap_compress),
+        success_message=lambda options: "IMAP is available",
+        target=lambda options: options.imap,
+        host=lambda options: options.imap),
+    CheckDefinition(
+        "SMTP",
+        enabled=lambda options: options.smtp,
+        run=lambda options: test_smtp(options.smtp, options.username, options.password, options.verbose,
+                                      not options.nosmtps, options.smtp_messages),
+        success_message=lambda options: "SMTP is available",
+        target=lambda options: options.smtp,
+        host=lambda options: options.smtp),
+    CheckDefinition(
+        "Meet",
+        enabled=lambda options: options.meet,
+        run=lambda options: test_meet(options.meet, options.verbose, options.meet_sessions,
+                                      options.meet_hold, options.meet_rate),
+        success_message=lambda options: "Meet is available",
+        target=lambda options: f"https://{options.meet}/meetmedia/signaling",
+        host=lambda options: options.meet),
+]
+
+
+def build_checks(options, tenant=None):
+    """
+        Instantiate the enabled checks of the registry, in report order.
+    """
+    checks = []
+    for definition in CHECKS:
+        if not definition.enabled(options):
+            continue
+        checks.append(Check(
+            definition.name,
+            functools.partial(definition.run, options),
+            definition.success_message(options),
+            fatal=definition.fatal,
+            after=definition.after,
+            host=definition.host(options) if definition.host else None,
+            tenant=tenant,
+            target=definition.target(options)))
+
+    return checks
+
+
+class Metrics:
+    """
+        Check results in the prometheus text exposition format.
+    """
+
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.success = {}
+        self.last_run = {}
+        self.runs = {}
+        self.durations = {}
+        self.phases = {}
+        self.probe_phases = {}
+        self.connections = {}
+
+    @staticmethod
+    def _observe(histogram, key, value):
+        buckets, total, count = histogram.get(key, ([0] * len(Metrics.BUCKETS), 0, 0))
+        buckets = [bucket + (1 if value <= le else 0) for bucket, le in zip(buckets, Metrics.BUCKETS)]
+        histogram[key] = (buckets, total + value, count + 1)
+
+    def observe(self, check):
+        if check.timed_out:
+            result = "timeout"
+        else:
+            result = "success" if check.success else "failure"
+
+        with self.lock:
+            self.success[check.key] = 1 if check.success else 0
+            self.last_run[check.key] = time.time()
+            self.runs[(*check.key, result)] = self.runs.get((*check.key, result), 0) + 1
+            self._observe(self.durations, check.key, check.duration)
+            for _request, timings in check.timings:
+                if timings.protocol != "http":
+                    for phase, duration in timings.phases.items():
+                        self._observe(self.probe_phases, (*check.key, timings.protocol, phase), duration)
+                    continue
+                for phase, duration in timings.phases.items():
+                    self._observe(self.phases, (*check.key, phase), duration)
+                # No connection if connecting failed
+                if timings.connection:
+                    key = (*check.key, timings.connection)
+                    self.connections[key] = self.connections.get(key, 0) + 1
+
+    @staticmethod
+    def _labels(names, values, extra=""):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        # The tenant label is left out when not running in fleet mode
+        labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values) if value is not None]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}"
+
+    def _histogram(self, lines, name, labels, histogram):
+        for key, (buckets, total, count) in sorted(histogram.items()):
+            for le, bucket in zip(self.BUCKETS + ("+Inf",), buckets + [count]):
+                bucket_labels = self._labels(labels, key, f'le="{le}"')
+                lines.append(f"{name}_bucket{bucket_labels} {bucket}")
+            lines.append(f"{name}_sum{self._labels(labels, key)} {total}")
+            lines.append(f"{name}_count{self._labels(labels, key)} {count}")
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append("# HELP kolab_endpoint_check_success Whether the last run of the check succeeded.")
+            lines.append("# TYPE kolab_endpoint_check_success gauge")
+            for key, value in sorted(self.success.items()):
+                lines.append(f"kolab_endpoint_check_success{self._labels(['tenant', 'check'], key)} {value}")
+
+            lines.append("# HELP kolab_endpoint_check_last_run_timestamp_seconds When the check last finished.")
+            lines.append("# TYPE kolab_endpoint_check_last_run_timestamp_seconds gauge")
+            for key, value in sorted(self.last_run.items()):
+                lines.append(f"kolab_endpoint_check_last_run_timestamp_seconds{self._labels(['tenant', 'check'], key)} {value}")
+
+            lines.append("# HELP kolab_endpoint_check_runs_total Number of check runs by result.")
+            lines.append("# TYPE kolab_endpoint_check_runs_total counter")
+            for key, value in sorted(self.runs.items()):
+                lines.append(f"kolab_endpoint_check_runs_total{self._labels(['tenant', 'check', 'result'], key)} {value}")
+
+            lines.append("# HELP kolab_endpoint_http_connections_total HTTP requests by kind of connection (new, resumed TLS session, reused).")
+            lines.append("# TYPE kolab_endpoint_http_connections_total counter")
+            for key, value in sorted(self.connections.items()):
+                lines.append(f"kolab_endpoint_http_connections_total{self._labels(['tenant', 'check', 'connection'], key)} {value}")
+
+            lines.append("# HELP kolab_endpoint_check_duration_seconds Duration of the check.")
+            lines.append("# TYPE kolab_endpoint_check_duration_seconds histogram")
+            self._histogram(lines, "kolab_endpoint_check_duration_seconds", ['tenant', 'check'], self.durations)
+
+            lines.append("# HELP kolab_endpoint_http_phase_seconds Duration of the phases of the HTTP requests of a check.")
+            lines.append("# TYPE kolab_endpoint_http_phase_seconds histogram")
+            self._histogram(lines, "kolab_endpoint_http_phase_seconds", ['tenant', 'check', 'phase'], self.phases)
+
+            lines.append("# HELP kolab_endpoint_probe_phase_seconds Duration of the phases of the IMAP, SMTP and TLS probes of a check.")
+            lines.append("# TYPE kolab_endpoint_probe_phase_seconds histogram")
+            self._histogram(lines, "kolab_endpoint_probe_phase_seconds", ['tenant', 'check', 'protocol', 'phase'], self.probe_phases)
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, listen):
+    """
+        Serve the metrics on http://<listen>/metrics from a background thread.
+    """
+    import http.server  # pylint: disable=import-outside-toplevel
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            data = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    address, port = listen.rsplit(':', 1)
+    server = http.server.ThreadingHTTPServer((address.strip('[]'), int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_intervals(default, overrides):
+    """
+        Parse the per check intervals given as NAME=SECONDS.
+    """
+    intervals = collections.defaultdict(lambda: default)
+    for override in overrides or []:
+        name, seconds = override.rsplit('=', 1)
+        intervals[name] = float(seconds)
+    return intervals
+
+
+def parse_duration(value):
+    """
+        Parse a duration like "90s", "15m", "24h" or "7d" into seconds.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+class ProbeStore:
+    """
+        History of check timings in a local sqlite database.
+
+        Every check run is appended to `probes`. Durations of passing checks are
+        also counted into an hourly histogram with logarithmic buckets
+        (`probe_histograms`), which the percentiles are computed from, so reporting
+        and regression detection only read a few rows per check and hour, no matter
+        how many probes the window holds.
+    """
+
+    # Bucket boundaries grow by 5% per bucket, starting at 0.1ms
+    BUCKET_BASE = 0.0001
+    BUCKET_GROWTH = 1.05
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS probes (
+                time REAL NOT NULL,
+                tenant TEXT NOT NULL,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                duration REAL NOT NULL,
+                phases TEXT
+            );
+            CREATE INDEX IF NOT EXISTS probes_time ON probes (time);
+            CREATE TABLE IF NOT EXISTS probe_histograms (
+                tenant TEXT NOT NULL,
+                name TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (tenant, name, hour, bucket)
+            ) WITHOUT ROWID;
+        """)
+
+    def bucket(self, duration):
+        return max(int(math.log(max(duration, self.BUCKET_BASE) / self.BUCKET_BASE, self.BUCKET_GROWTH)), 0)
+
+    def bucket_value(self, bucket):
+        # Geometric middle of the bucket
+        return self.BUCKET_BASE * self.BUCKET_GROWTH ** (bucket + 0.5)
+
+    def add(self, check):
+        record = check.record()
+        self.db.execute(
+            "INSERT INTO probes (time, tenant, name, status, duration, phases) VALUES (?, ?, ?, ?, ?, ?)",
+            (record['finished'], check.tenant or '', check.name, record['status'], record['duration'], json.dumps(record['phases']))
+        )
+        if record['status'] == 'pass':
+            self.db.execute(
+                """
+                INSERT INTO probe_histograms (tenant, name, hour, bucket, count) VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (tenant, name, hour, bucket) DO UPDATE SET count = count + 1
+                """,
+                (check.tenant or '', check.name, int(record['finished'] // 3600), self.bucket(record['duration']))
+            )
+
+    def commit(self):
+        self.db.commit()
+
+    def expire(self, before):
+        """
+            Drop the raw probes older than `before`, the hourly histograms are kept.
+        """
+        self.db.execute("DELETE FROM probes WHERE time < ?", (before,))
+        self.db.commit()
+
+    def _percentiles(self, counts, quantiles):
+        total = sum(count for _bucket, count in counts)
+        if not total:
+            return 0, [None] * len(quantiles)
+        results = []
+        for quantile in quantiles:
+            rank = quantile * total
+            seen = 0
+            for bucket, count in counts:
+                seen += count
+                if seen >= rank:
+                    results.append(self.bucket_value(bucket))
+                    break
+        return total, results
+
+    def percentiles(self, tenant, name, since, quantiles=(0.5, 0.95, 0.99)):
+        """
+            Returns (count, [percentiles]) of the passing runs of a check since `since`.
+        """
+        counts = self.db.execute(
+            """
+            SELECT bucket, SUM(count) FROM probe_histograms
+            WHERE tenant = ? AND name = ? AND hour >= ?
+            GROUP BY bucket ORDER BY bucket
+            """,
+            (tenant or '', name, int(since // 3600))
+        ).fetchall()
+        return self._percentiles(counts, quantiles)
+
+    def report(self, since, quantiles=(0.5, 0.95, 0.99)):
+        """
+            Yields (tenant, name, count, [percentiles]) for every check seen since `since`.
+        """
+        keys = self.db.execute(
+            "SELECT DISTINCT tenant, name FROM probe_histograms WHERE hour >= ? ORDER BY tenant, name",
+            (int(since // 3600),)
+        ).fetchall()
+        for tenant, name in keys:
+            count, values = self.percentiles(tenant, name, since, quantiles)
+            yield tenant, name, count, values
+
+
+def store_check(store, check, options):
+    """
+        Compare a finished check with its baseline and append it to the store.
+
+        Sets `check.baseline` (median duration of the baseline window) and
+        `check.regression` (whether it took longer than --regression-factor times that).
+    """
+    count, (median,) = store.percentiles(check.tenant, check.name, time.time() - parse_duration(options.baseline_window), (0.5,))
+    if count >= options.baseline_samples:
+        check.baseline = median
+        check.regression = bool(check.success and check.duration > median * options.regression_factor)
+    store.add(check)
+
+
+def print_stats(store, window):
+    """
+        Print the latency percentiles per check of the given window.
+    """
+    rows = [
+        (tenant, name, count, values)
+        for tenant, name, count, values in store.report(time.time() - parse_duration(window))
+    ]
+    width = max([len("CHECK")] + [len(f"{tenant} {name}".strip()) for tenant, name, _count, _values in rows])
+    print(f"{'CHECK':<{width}}  {'COUNT':>8}  {'P50':>9}  {'P95':>9}  {'P99':>9}")
+    for tenant, name, count, values in rows:
+        percentiles = "  ".join(f"{value * 1000:>7.1f}ms" for value in values)
+        print(f"{f'{tenant} {name}'.strip():<{width}}  {count:>8}  {percentiles}")
+
+
+def recorded(results, store, options):
+    """
+        Pass finished checks through, appending them to the store (if any) on the way.
+    """
+    for check in results:
+        if store:
+            store_check(store, check, options)
+        yield check
+
+    if store:
+        store.commit()
+
+
+def failed(check, options):
+    """
+        Whether a finished check makes the run fail.
+    """
+    return (not check.success and check.fatal) or (check.regression and options.fail_on_regression)
+
+
+def emit_record(check, verbose=False):
+    """
+        Write the result record of a finished check as a single line of json.
+    """
+    sys.stdout.write(json.dumps(check.record(verbose)) + "\n")
+    sys.stdout.flush()
+
+
+def report_check(check, timeout):
+    """
+        Print the output and the outcome of a finished check.
+    """
+    sys.stdout.write(check.output)
+    if check.timed_out:
+        print_error(f"{check.name} did not finish within {timeout}s")
+    elif check.success:
+        print_success(check.success_message)
+
+    if check.regression:
+        print_error(f"{check.name} took {check.duration * 1000:.1f}ms, its baseline is {check.baseline * 1000:.1f}ms")
+
+
+def run_daemon(checks, options, store=None):
+    """
+        Run the checks forever, each one on its own interval, and serve the results
+        as prometheus metrics.
+
+        The process stays warm in between: the ssl contexts and the dns resolver
+        cache are reused for every round.
+    """
+    metrics = Metrics()
+    serve_metrics(metrics, options.listen)
+
+    intervals = parse_intervals(options.interval, options.check_interval)
+    next_run = {check.key: 0 for check in checks}
+
+    while True:
+        now = time.monotonic()
+        due = [check for check in checks if next_run[check.key] <= now]
+        # Scheduled from the start of the round, so a check never runs more often than its interval
+        for check in due:
+            next_run[check.key] = now + intervals[check.name]
+
+        results = run_checks(due, options.concurrency, options.timeout, options.per_host_concurrency)
+        for check in in_order(due, recorded(results, store, options)):
+            metrics.observe(check)
+            if options.format == 'ndjson':
+                emit_record(check, options.verbose)
+            elif options.verbose or not check.success or check.regression:
+                report_check(check, options.timeout)
+        sys.stdout.flush()
+
+        time.sleep(max(min(next_run.values()) - time.monotonic(), 0))
 
-    error = False
 
-    # Maybe structure it like this.
-    # Then print report, and upload results to prometheus
-    # [testName, testEnabled, testLambda] => [testName, testResult]
+def apply_defaults(options):
+    """
+        Derive the standard checks from the username for --default.
 
+        Raises ValueError if there is no username to derive them from.
+    """
     if options.default:
+        if '@' not in (options.username or ''):
+            raise ValueError("--default requires a username of the form user@domain")
         options.host = options.username.split('@')[1]
         options.dav = "https://" + options.host + "/.well-known/caldav"
         options.imap = options.host
@@ -774,106 +2772,294 @@ def main():
         options.activesync = options.host
         options.certificates = True
 
-    if options.dav:
-        if discover_principal(options.dav, options.username, options.password, options.verbose):
-            print_success("Caldav is available")
-        else:
-            error = True
 
-        if options.host:
-            if test_caldav_redirect(options.host, options.username, options.password, options.verbose):
-                print_success("Caldav on .well-known/caldav is available")
-                # Kolabnow doesn't support this atm (it offers the redirect on apps.kolabnow.com),
-                # so we ignore the error for now
+# Options of the whole run, a fleet file row can't override them
+FLEET_RUN_OPTIONS = (
+    'help', 'fleet', 'concurrency', 'per_host_concurrency', 'connect_to', 'nameserver', 'timeout',
+    'listen', 'interval', 'check_interval', 'store', 'stats', 'baseline_window', 'baseline_samples',
+    'regression_factor', 'fail_on_regression', 'store_retention', 'format',
+)
 
-    if options.autoconfig:
-        if test_autoconfig(options.host, options.username, options.password, options.verbose):
-            print_success("Autoconf available")
-        else:
-            error = True
 
-    if options.activesync:
-        if options.autoconfig:
-            if test_autodiscover_activesync(options.host, options.activesync, options.username, options.password, options.verbose):
-                print_success("Activesync Autodsicovery available")
-                # Kolabnow doesn't support this, so we ignore the error for now
+def fleet_columns(parser):
+    """
+        The parser actions of the options a fleet file row may override, by column name.
+    """
+    return {
+        action.dest: action
+        for action in parser._actions  # pylint: disable=protected-access
+        if action.dest not in FLEET_RUN_OPTIONS
+    }
 
-        if test_activesync(options.activesync, options.username, options.password, options.verbose):
-            print_success("Activesync available")
-        else:
-            error = True
 
-    if options.fb:
-        if test_freebusy_authenticated(options.fb, options.username, options.password, options.verbose):
-            print_success("Authenticated Freebusy is available")
-        else:
-            error = True
+def option_value(action, value):
+    """
+        Convert a single value like the parser converts the option.
+    """
+    value = str(value).strip()
+    if action.type:
+        try:
+            value = action.type(value)
+        except (TypeError, ValueError, argparse.ArgumentTypeError):
+            raise ValueError(f"invalid {getattr(action.type, '__name__', 'value')} value {value!r}") from None
+    if action.choices and value not in action.choices:
+        raise ValueError(f"invalid choice {value!r}")
+    return value
 
-        # We rely on the activesync test to have generated the token for unauthenticated access.
-        if test_freebusy_unauthenticated(options.fb, options.username, options.password, options.verbose):
-            print_success("Unauthenticated Freebusy is available")
-        else:
-            error = True
 
-    if options.dns:
-        if test_dns(options.host, options.verbose):
-            print_success(f"DNS entries on {options.host} available")
-        else:
-            error = True
+def fleet_value(action, value):
+    """
+        Convert a fleet file column like the parser converts the option.
 
-        if test_dmarc_dns(options.host, options.verbose):
-            print_success(f"DMARC DNS entries on {options.host} available")
-        else:
-            error = True
+        CSV values are all strings, YAML may give numbers, booleans and lists.
+    """
+    if action.nargs == 0:
+        flag = str(value).strip().lower()
+        if flag in ('1', 'true', 'yes', 'on'):
+            return action.const
+        if flag in ('0', 'false', 'no', 'off'):
+            return action.default
+        raise ValueError(f"expected a boolean, got {value!r}")
 
-        if test_spf_dns(options.host, options.verbose):
-            print_success(f"SPF DNS entries on {options.host} available")
-        else:
-            error = True
+    if isinstance(action, argparse._AppendAction):  # pylint: disable=protected-access
+        # A column holds a single entry, YAML may give a list
+        return [option_value(action, entry) for entry in (value if isinstance(value, list) else [value])]
+    return option_value(action, value)
 
-        userhost = options.username.split('@')[1]
-        if test_email_dns(userhost, options.verbose):
-            print_success(f"User DNS entries on {userhost} available")
-        else:
-            error = True
 
-    if options.dkim:
-        if test_dkim_dns(options.host, options.dkim, options.verbose):
-            print_success(f"DKIM DNS entries on {options.host} available")
-        else:
-            error = True
+def load_fleet(path):
+    """
+        Read the tenants of a fleet run.
 
-    if options.mtasts:
-        if test_mta_sts(options.host, options.verbose):
-            print_success(f"MTA-STS on {options.host} available")
-        else:
-            error = True
+        The file is either a CSV file with a header line, or a YAML list of mappings.
+        Columns are named after the command line options (username, password, host, dav, imap, ...),
+        empty columns fall back to the value given on the command line.
+    """
+    if path.endswith(('.yaml', '.yml')):
+        import yaml  # pylint: disable=import-outside-toplevel
+        with open(path, encoding='utf-8') as f:
+            return yaml.safe_load(f) or []
 
-    if options.certificates:
-        if test_certificates(options.host, options.dav, options.imap, options.verbose):
-            print_success("All certificates are valid")
-        else:
-            error = True
+    import csv  # pylint: disable=import-outside-toplevel
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
 
-    if options.imap:
-        if test_imap(options.imap, options.username, options.password, options.verbose):
-            print_success("IMAP is available")
-        else:
-            error = True
 
-    if options.smtp:
-        if test_smtp(options.smtp, options.username, options.password, options.verbose, not options.nosmtps):
-            print_success("SMTP is available")
-        else:
-            error = True
+def tenant_options(options, row, columns):
+    """
+        The command line options, overridden by the columns of a fleet file row.
 
-    if options.meet:
-        if test_meet(options.meet, options.verbose):
-            print_success("Meet is available")
-        else:
-            error = True
+        `columns` are the parser actions of fleet_columns(). Raises ValueError
+        listing every problem of the row.
+    """
+    if not isinstance(row, dict):
+        raise ValueError(f"expected a mapping of columns, got {row!r}")
+
+    values = vars(options).copy()
+    errors = []
+    for name, value in row.items():
+        name = str(name).strip().replace('-', '_')
+        if value is None or value == '':
+            continue
+        if name in FLEET_RUN_OPTIONS:
+            errors.append(f"{name}: can only be given for the whole run")
+            continue
+        if name not in columns:
+            errors.append(f"{name}: unknown column")
+            continue
+        try:
+            values[name] = fleet_value(columns[name], value)
+        except ValueError as err:
+            errors.append(f"{name}: {err}")
 
-    # Push result to prometheus
+    tenant = argparse.Namespace(**values)
+    if not errors:
+        try:
+            apply_defaults(tenant)
+        except ValueError as err:
+            errors.append(str(err))
+    if errors:
+        raise ValueError("; ".join(errors))
+    return tenant
+
+
+def run_fleet(checks, options, store=None, invalid=None):
+    """
+        Run the checks of all tenants in one pool and print a row per tenant.
+        With --format ndjson the records are streamed instead and no table is printed.
+
+        `invalid` maps the tenants of fleet file rows that could not be read to
+        the error, they are reported as failed.
+
+        Returns True if a fatal check failed or a row was invalid.
+    """
+    tenants = {}
+    for name, message in (invalid or {}).items():
+        tenants[name] = {'checks': 0, 'failed': [f"invalid row: {message}"], 'slowest': 0}
+        if options.format == 'ndjson':
+            sys.stdout.write(json.dumps({"name": "Fleet row", "tenant": name, "status": "invalid", "error": message}) + "\n")
+            sys.stdout.flush()
+    for check in checks:
+        tenants.setdefault(check.tenant, {'checks': 0, 'failed': [], 'slowest': 0})
+
+    results = run_checks(checks, options.concurrency, options.timeout, options.per_host_concurrency)
+    for check in recorded(results, store, options):
+        if options.format == 'ndjson':
+            emit_record(check, options.verbose)
+
+        tenant = tenants[check.tenant]
+        tenant['checks'] += 1
+        tenant['slowest'] = max(tenant['slowest'], check.duration or 0)
+        if failed(check, options):
+            tenant['failed'].append(f"{check.name} (slow)" if check.success else check.name)
+            if options.verbose and options.format == 'text':
+                print(f"{check.tenant}:")
+                report_check(check, options.timeout)
+
+    failing = [name for name, tenant in tenants.items() if tenant['failed']]
+    if options.format == 'ndjson':
+        return bool(failing)
+
+    width = max([len("TENANT")] + [len(str(name)) for name in tenants])
+    print(f"{'TENANT':<{width}}  {'CHECKS':>6}  {'FAILED':>6}  {'SLOWEST':>8}  FAILED CHECKS")
+    for name, tenant in tenants.items():
+        line = (f"{name:<{width}}  {tenant['checks']:>6}  {len(tenant['failed']):>6}  "
+                f"{tenant['slowest']:>7.2f}s  {', '.join(tenant['failed'])}")
+        print((RED if tenant['failed'] else GREEN) + line + RESET)
+    print()
+
+    if not failing:
+        print_success(f"All {len(tenants)} tenants are available")
+    return bool(failing)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="Host")
+    parser.add_argument("--username", help="Username")
+    parser.add_argument("--password", help="User password")
+    parser.add_argument("--imap", help="IMAP URI")
+    parser.add_argument("--imap-idle", action='store_true', help="Measure the IMAP IDLE wake-up latency (appends and removes a message)")
+    parser.add_argument("--imap-compress", action='store_true', help="Enable COMPRESS=DEFLATE for the IMAP check")
+    parser.add_argument("--smtp", help="SMTP URI")
+    parser.add_argument("--nosmtps", action='store_true', help="Boolean to disable the smtps check")
+    parser.add_argument("--smtp-messages", type=int, default=0, metavar="N",
+                        help="Send N small messages to the user over one submission session to measure the throughput")
+    parser.add_argument("--dav", help="DAV URI")
+    parser.add_argument("--meet", help="MEET URI")
+    parser.add_argument("--meet-sessions", type=int, default=0, metavar="N",
+                        help="Load test: open N websocket signaling sessions and hold them (raise --timeout accordingly)")
+    parser.add_argument("--meet-hold", type=float, default=10, help="Seconds to hold the sessions after the last one was opened")
+    parser.add_argument("--meet-rate", type=float, default=0, help="Sessions to open per second (all at once by default)")
+    parser.add_argument("--autoconfig", help="Check autoconfig")
+    parser.add_argument("--dns", action='store_true', help="Check dns")
+    parser.add_argument("--dkim", help="Check DKIM dns record")
+    parser.add_argument("--mtasts", help="Check mta-sts")
+    parser.add_argument("--activesync", help="ActiveSync URI")
+    parser.add_argument("--certificates", action='store_true', help="Check Certificates")
+    parser.add_argument("--cert-hosts", action='append', help="Additional certificates to check, as comma separated host[:port][/starttls]")
+    parser.add_argument("--cert-warn-days", type=int, default=14, help="Fail the certificate check for certificates expiring within this many days")
+    parser.add_argument("--fb", help="Freebusy url as displayed in roundcube")
+    parser.add_argument("--fb-users", metavar="USERS", help="Comma separated users (or a file with a user per line) to request the freebusy of at once")
+    parser.add_argument("--fb-concurrency", type=int, default=16, help="Number of freebusy requests of --fb-users to run at the same time")
+    parser.add_argument("--verbose", action='store_true', help="Verbose output")
+    parser.add_argument("--default", action='store_true', help="Standard checks with only username and password")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of checks to run at the same time")
+    parser.add_argument("--connect-to", action='append', metavar="HOST:PORT:CONNECT-TO-HOST:CONNECT-TO-PORT",
+                        help="Connect to another address for an endpoint, like curl --connect-to (may be repeated)")
+    parser.add_argument("--nameserver", metavar="ADDRESS[:PORT]", help="Use this nameserver for the dns checks")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds after which a check is considered failed")
+    parser.add_argument("--listen", help="Keep running and serve prometheus metrics on ADDRESS:PORT (e.g. 127.0.0.1:9100)")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between runs of a check when running with --listen")
+    parser.add_argument("--check-interval", action='append', metavar="NAME=SECONDS", help="Interval for a single check, e.g. 'DNS=300'")
+    parser.add_argument("--fleet", help="CSV or YAML file with a tenant per row to check in one run")
+    parser.add_argument("--per-host-concurrency", type=int, default=4, help="Number of checks to run against the same host at the same time")
+    parser.add_argument("--store", help="Sqlite database to append the timings of every check to")
+    parser.add_argument("--stats", metavar="WINDOW", help="Print the latency percentiles per check over WINDOW (e.g. 24h, 7d) from --store and exit")
+    parser.add_argument("--baseline-window", default="7d", help="Window of the latency baseline a check is compared to")
+    parser.add_argument("--baseline-samples", type=int, default=20, help="Minimum number of probes in the baseline window to detect regressions")
+    parser.add_argument("--regression-factor", type=float, default=2.0, help="Flag a check taking longer than this multiple of its baseline median")
+    parser.add_argument("--fail-on-regression", action='store_true', help="Exit with an error if a latency regression was detected")
+    parser.add_argument("--store-retention", help="Drop raw probes older than this (e.g. 90d) from --store, percentiles are kept")
+    parser.add_argument("--format", choices=['text', 'ndjson'], default='text', help="Coloured text report, or a json record per check as soon as it finishes")
+    return parser
+
+
+def main():
+    parser = build_parser()
+    options = parser.parse_args()
+
+    error = False
+
+    store = ProbeStore(options.store) if options.store else None
+    if options.stats:
+        if not store:
+            parser.error("--stats requires --store")
+        print_stats(store, options.stats)
+        return
+
+    if store and options.store_retention:
+        store.expire(time.time() - parse_duration(options.store_retention))
+
+    try:
+        connect_to.update(parse_connect_to(options.connect_to))
+    except ValueError as err:
+        parser.error(str(err))
+    if options.nameserver:
+        address, _, port = options.nameserver.rpartition(':') if options.nameserver.count(':') == 1 else (options.nameserver, '', '')
+        resolver.resolver.nameservers = [address]
+        if port:
+            resolver.resolver.port = int(port)
+
+    # Don't let a hanging connection outlive the check it belongs to
+    socket.setdefaulttimeout(options.timeout)
+    sys.stdout = CheckOutput(sys.stdout)
+
+    invalid = {}
+    if options.fleet:
+        checks = []
+        columns = fleet_columns(parser)
+        for number, row in enumerate(load_fleet(options.fleet), 1):
+            try:
+                tenant = tenant_options(options, row, columns)
+            except ValueError as err:
+                name = row.get('username') if isinstance(row, dict) else None
+                invalid[name or f"row {number}"] = str(err)
+                continue
+            checks.extend(build_checks(tenant, tenant.username or tenant.host))
+    else:
+        try:
+            apply_defaults(options)
+        except ValueError as err:
+            parser.error(str(err))
+        checks = build_checks(options)
+
+    if options.listen:
+        for name, message in invalid.items():
+            print_error(f"Invalid fleet row {name}: {message}")
+        run_daemon(checks, options, store)
+
+    if options.fleet:
+        if run_fleet(checks, options, store, invalid):
+            if options.format == 'text':
+                print_error("At least one check failed")
+            sys.exit(1)
+        return
+
+    if options.format == 'ndjson':
+        results = run_checks(checks, options.concurrency, options.timeout, options.per_host_concurrency)
+        for check in recorded(results, store, options):
+            emit_record(check, options.verbose)
+            if failed(check, options):
+                error = True
+        sys.exit(1 if error else 0)
+
+    results = run_checks(checks, options.concurrency, options.timeout, options.per_host_concurrency)
+    for check in in_order(checks, recorded(results, store, options)):
+        report_check(check, options.timeout)
+
+        if failed(check, options):
+            error = True
 
     if error:
         print_error("At least one check failed")
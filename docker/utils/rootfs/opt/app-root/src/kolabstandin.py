@@ -0,0 +1,935 @@
+#!/bin/env python3
+
+"""
+kolabstandin.py
+    --domain example.org
+    --latency 20ms --latency imap=50ms --jitter 5ms --failure-rate smtp=0.1
+
+    Local stand-ins for the HTTPS, IMAP, SMTP and DNS services of a Kolab
+    deployment, to run kolabendpointtester.py, caldavcli.py and activesynccli.py
+    against on an isolated machine. The kolabendpointtester.py arguments to
+    reach them are printed on startup.
+
+    HTTPS serves the well-known redirects, autoconfig, autodiscover, ActiveSync
+    OPTIONS, DAV PROPFIND/REPORT, freebusy, MTA-STS and meet signaling (also
+    websocket sessions), IMAP
+    enough for LOGIN, LIST, SELECT, FETCH, APPEND and IDLE, SMTP submission with
+    STARTTLS, AUTH and PIPELINING, and DNS a zone for the domain plus the PTR
+    record of the listen address.
+
+    Latency, jitter and failure rate apply to every reply of a service, either
+    to all services or to one with SERVICE=VALUE (http, imap, smtp or dns).
+"""
+
+import argparse
+import base64
+import collections
+import hashlib
+import html
+import json
+import os
+import random
+import re
+import select
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import http.server
+import urllib.parse
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.reversename
+import dns.rrset
+import dns.zone
+
+
+SERVICES = ('http', 'imap', 'smtp', 'dns')
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class Faults:
+    """
+        Latency and failures injected into the replies of a stand-in service.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    def delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def fail(self):
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+
+def parse_latency(value):
+    """
+        Seconds from "20ms", "1.5s" or "0.02".
+    """
+    if value.endswith('ms'):
+        return float(value[:-2]) / 1000
+    return float(value.rstrip('s'))
+
+
+def parse_faults(latency=None, jitter=None, failure_rate=None):
+    """
+        Faults per service from [SERVICE=]VALUE entries, plain values apply to
+        all services, SERVICE=VALUE to that one only.
+    """
+    settings = {service: {} for service in SERVICES}
+    for option, values, parse in (
+        ('latency', latency, parse_latency),
+        ('jitter', jitter, parse_latency),
+        ('failure_rate', failure_rate, float),
+    ):
+        # Service specific values win over the ones for all services
+        for value in sorted(values or [], key=lambda value: '=' in value):
+            service, _, value = value.rpartition('=')
+            if service and service not in SERVICES:
+                raise ValueError(f"Unknown service {service}, expected one of {', '.join(SERVICES)}")
+            for name in [service] if service else SERVICES:
+                settings[name][option] = parse(value)
+    return {service: Faults(**values) for service, values in settings.items()}
+
+
+def self_signed_certificate(domain, directory):
+    """
+        Create a certificate for the domain and its subdomains with openssl.
+    """
+    certfile = os.path.join(directory, 'standin.crt')
+    keyfile = os.path.join(directory, 'standin.key')
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "365",
+            "-subj", f"/CN={domain}", "-addext", f"subjectAltName=DNS:{domain},DNS:*.{domain}",
+            "-keyout", keyfile, "-out", certfile,
+        ],
+        check=True,
+        capture_output=True
+    )
+    return certfile, keyfile
+
+
+ZONE = """
+$TTL 300
+@ IN SOA ns hostmaster 1 3600 600 86400 60
+@ IN NS ns
+@ IN A {address}
+@ IN MX 10 @
+@ IN TXT "v=spf1 mx -all"
+ns IN A {address}
+mta-sts IN A {address}
+autodiscover IN CNAME @
+_dmarc IN TXT "v=DMARC1; p=reject"
+_mta-sts IN TXT "v=STSv1; id=1"
+*._domainkey IN TXT "v=DKIM1; k=rsa; p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQC"
+_autodiscover._tcp IN SRV 0 0 443 @
+_caldav._tcp IN SRV 0 0 80 @
+_caldavs._tcp IN SRV 0 0 443 @
+_carddav._tcp IN SRV 0 0 80 @
+_carddavs._tcp IN SRV 0 0 443 @
+_imap._tcp IN SRV 0 0 143 @
+_imaps._tcp IN SRV 0 0 993 @
+_sieve._tcp IN SRV 0 0 4190 @
+_submission._tcp IN SRV 0 0 587 @
+_webdav._tcp IN SRV 0 0 80 @
+_webdavs._tcp IN SRV 0 0 443 @
+"""
+
+REVERSE_ZONE = """
+$TTL 300
+@ IN SOA ns.{domain}. hostmaster.{domain}. 1 3600 600 86400 60
+@ IN NS ns.{domain}.
+@ IN PTR {domain}.
+"""
+
+
+class StandInServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+        A TCP stand-in service, with implicit TLS if `tls` is set.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, standin, service, tls=False):
+        self.standin = standin
+        self.service = service
+        self.faults = standin.faults[service]
+        self.tls = tls
+        super().__init__(address, handler)
+
+    def get_request(self):
+        sock, address = super().get_request()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tls:
+            # The handshake happens on the first read, in the thread of the connection
+            sock = self.standin.tls_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+    def handle_error(self, request, client_address):
+        # Clients going away mid-session are expected
+        if not isinstance(sys.exc_info()[1], OSError):
+            super().handle_error(request, client_address)
+
+
+class StandInUDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, standin, service):
+        self.standin = standin
+        self.service = service
+        self.faults = standin.faults[service]
+        super().__init__(address, handler)
+
+
+def credentials(standin, username, password):
+    return bool(username) and (standin.password is None or password == standin.password)
+
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "kolabstandin"
+
+    ACTIVESYNC_HEADERS = {
+        'MS-Server-ActiveSync': '14.1',
+        'MS-ASProtocolVersions': '2.5,12.0,12.1,14.0,14.1',
+        'MS-ASProtocolCommands': (
+            'Sync,SendMail,SmartForward,SmartReply,GetAttachment,GetHierarchy,CreateCollection,'
+            'DeleteCollection,MoveCollection,FolderSync,FolderCreate,FolderDelete,FolderUpdate,'
+            'MoveItems,GetItemEstimate,MeetingResponse,Search,Settings,Ping,ItemOperations,'
+            'Provision,ResolveRecipients,ValidateCert'
+        ),
+    }
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        if self.server.standin.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, status, body="", content_type="text/plain; charset=utf-8", headers=None):
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def user(self):
+        """
+            The authenticated user, if any.
+        """
+        kind, _, value = self.headers.get('Authorization', '').partition(' ')
+        if kind.lower() != 'basic':
+            return None
+        try:
+            username, _, password = base64.b64decode(value).decode().partition(':')
+        except ValueError:
+            return None
+        return username if credentials(self.server.standin, username, password) else None
+
+    def dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode(errors='replace') if length else ""
+
+        standin = self.server.standin
+        standin.count('http', self.command)
+        self.server.faults.delay()
+        if self.server.faults.fail():
+            self.reply(503, "Injected failure", headers={'Retry-After': '1'})
+            return
+
+        # Clients may send the absolute form (https://host/path) as the request target
+        path = urllib.parse.urlsplit(self.path).path or '/'
+        lower = path.lower()
+        if lower in ('/.well-known/caldav', '/.well-known/carddav'):
+            self.reply(301, headers={'Location': '/dav/'})
+        elif lower in ('/.well-known/autoconfig/mail/config-v1.1.xml', '/mail/config-v1.1.xml'):
+            self.reply(200, standin.autoconfig(), "application/xml")
+        elif lower == '/.well-known/mta-sts.txt':
+            self.reply(200, f"version: STSv1\nmode: enforce\nmx: {standin.domain}\nmax_age: 86400\n")
+        elif lower.startswith('/meetmedia/signaling') and self.headers.get('Upgrade', '').lower() == 'websocket':
+            self.signaling()
+        elif lower == '/meetmedia/signaling':
+            self.reply(200, '{"code":0,"message":"Transport unknown"}', "application/json")
+        elif lower.endswith('.ifb'):
+            self.reply(200, standin.freebusy(os.path.basename(path)[:-4]), "text/calendar")
+        elif not self.user():
+            self.reply(401, "Unauthorized", headers={'WWW-Authenticate': 'Basic realm="kolabstandin"'})
+        elif lower == '/autodiscover/autodiscover.xml' and self.command == 'POST':
+            match = re.search(r"<EMailAddress>([^<]*)</EMailAddress>", body)
+            host = self.headers.get('Host', standin.domain)
+            self.reply(200, standin.autodiscover(match.group(1) if match else self.user(), host), "text/xml")
+        elif lower == '/microsoft-server-activesync':
+            if self.command == 'OPTIONS':
+                self.reply(200, headers=self.ACTIVESYNC_HEADERS)
+            else:
+                self.reply(501, "ActiveSync commands are not simulated")
+        elif self.command == 'PROPFIND':
+            self.reply(207, standin.propfind(path, self.headers.get('Depth', 'infinity')), "application/xml; charset=utf-8")
+        elif self.command == 'REPORT':
+            self.reply(207, standin.report(path), "application/xml; charset=utf-8")
+        else:
+            self.reply(404, "Not found")
+
+    do_GET = do_POST = do_OPTIONS = do_PROPFIND = do_REPORT = dispatch
+
+    def signaling(self):
+        """
+            Upgrade to a websocket, send the engine.io open packet and keep the
+            session until the client closes it.
+        """
+        key = self.headers.get('Sec-WebSocket-Key', '').encode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest()).decode())
+        self.end_headers()
+        self.close_connection = True
+
+        self.server.faults.delay()
+        packet = {'sid': uuid.uuid4().hex, 'upgrades': [], 'pingInterval': 25000, 'pingTimeout': 20000, 'maxPayload': 1000000}
+        self.send_frame(b"0" + json.dumps(packet).encode())
+        while True:
+            header = self.rfile.read(2)
+            if len(header) < 2:
+                return
+            length = header[1] & 0x7f
+            if length == 126:
+                length = int.from_bytes(self.rfile.read(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(self.rfile.read(8), 'big')
+            self.rfile.read(4 + length if header[1] & 0x80 else length)
+            if header[0] & 0x0f == 0x8:
+                self.send_frame((1000).to_bytes(2, 'big'), 0x8)
+                return
+
+    def send_frame(self, payload, opcode=0x1):
+        length = len(payload)
+        header = bytes((0x80 | opcode, length)) if length < 126 else bytes((0x80 | opcode, 126)) + length.to_bytes(2, 'big')
+        self.wfile.write(header + payload)
+
+
+# A quoted string, a literal placeholder or an atom in an IMAP command
+IMAP_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\([^)]*\)|\S+)')
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    CAPABILITIES = "IMAP4rev1 IDLE UIDPLUS ID ENABLE"
+
+    def write(self, *lines):
+        data = b"".join((line if isinstance(line, bytes) else line.encode()) + b"\r\n" for line in lines)
+        self.wfile.write(data)
+
+    def handle(self):
+        faults = self.server.faults
+        faults.delay()
+        if faults.fail():
+            self.write("* BYE Injected failure")
+            return
+        self.write(f"* OK [CAPABILITY {self.CAPABILITIES}] kolabstandin IMAP ready")
+
+        self.user = None
+        self.mailbox = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode(errors='replace').rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+
+            literal = None
+            match = re.search(r"\{(\d+)\}$", args)
+            if match:
+                self.write("+ Ready for literal data")
+                literal = self.rfile.read(int(match.group(1)))
+                self.rfile.readline()
+                args = args[:match.start()]
+
+            self.server.standin.count('imap', command)
+            faults.delay()
+            if command != 'LOGOUT' and faults.fail():
+                self.write(f"{tag} NO [UNAVAILABLE] Injected failure")
+                continue
+
+            handler = getattr(self, f"do_{command}", None)
+            if handler is None:
+                self.write(f"{tag} BAD Unknown command")
+            elif command not in ('CAPABILITY', 'LOGIN', 'LOGOUT', 'NOOP', 'ID') and not self.user:
+                self.write(f"{tag} NO Not authenticated")
+            elif handler(tag, args, literal) is False:
+                return
+
+    def arguments(self, args):
+        return [match.group(1) if match.group(1) is not None else match.group(2) for match in IMAP_TOKEN.finditer(args)]
+
+    def do_CAPABILITY(self, tag, _args, _literal):
+        self.write(f"* CAPABILITY {self.CAPABILITIES}", f"{tag} OK CAPABILITY completed")
+
+    def do_ID(self, tag, _args, _literal):
+        self.write('* ID ("name" "kolabstandin")', f"{tag} OK ID completed")
+
+    def do_NOOP(self, tag, _args, _literal):
+        self.write(f"{tag} OK NOOP completed")
+
+    def do_LOGIN(self, tag, args, _literal):
+        username, password = (self.arguments(args) + ["", ""])[:2]
+        if not credentials(self.server.standin, username, password):
+            self.write(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials")
+            return
+        self.user = username
+        self.write(f"{tag} OK [CAPABILITY {self.CAPABILITIES}] Logged in")
+
+    def do_LOGOUT(self, tag, _args, _literal):
+        self.write("* BYE Logging out", f"{tag} OK LOGOUT completed")
+        return False
+
+    def do_LIST(self, tag, _args, _literal):
+        lines = [f'* LIST (\\HasNoChildren) "/" "{folder}"' for folder in ('INBOX', 'Drafts', 'Sent', 'Trash', 'Calendar', 'Contacts')]
+        self.write(*lines, f"{tag} OK LIST completed")
+
+    def do_SELECT(self, tag, args, _literal, readonly=False):
+        self.mailbox = self.server.standin.mailbox(self.user)
+        with self.mailbox.changed:
+            messages = list(self.mailbox.messages)
+        uidnext = messages[-1][0] + 1 if messages else 1
+        self.write(
+            "* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)",
+            f"* {len(messages)} EXISTS",
+            "* 0 RECENT",
+            "* OK [UIDVALIDITY 1] UIDs valid",
+            f"* OK [UIDNEXT {uidnext}] Predicted next UID",
+            f"{tag} OK [{'READ-ONLY' if readonly else 'READ-WRITE'}] {'EXAMINE' if readonly else 'SELECT'} completed"
+        )
+
+    def do_EXAMINE(self, tag, args, literal):
+        self.do_SELECT(tag, args, literal, readonly=True)
+
+    def do_FETCH(self, tag, args, _literal, uid=False):
+        if self.mailbox is None:
+            self.write(f"{tag} BAD No mailbox selected")
+            return
+        sequence, _, items = args.partition(' ')
+        with self.mailbox.changed:
+            messages = list(self.mailbox.messages)
+
+        lines = []
+        for number, (message_uid, message) in enumerate(messages, 1):
+            if not self.matches(sequence, message_uid if uid else number, len(messages) and (messages[-1][0] if uid else len(messages))):
+                continue
+            response = f"* {number} FETCH (UID {message_uid} FLAGS (\\Seen) RFC822.SIZE {len(message)}".encode()
+            if 'BODY' in items.upper():
+                header = message.partition(b"\r\n\r\n")[0] + b"\r\n\r\n"
+                response += f" BODY[HEADER.FIELDS (DATE SUBJECT)] {{{len(header)}}}\r\n".encode() + header
+            lines.append(response + b")")
+        self.write(*lines, f"{tag} OK FETCH completed")
+
+    def matches(self, sequence, value, last):
+        for part in sequence.split(','):
+            start, _, end = part.partition(':')
+            start = last if start == '*' else int(start)
+            end = start if not end else last if end == '*' else int(end)
+            if min(start, end) <= value <= max(start, end):
+                return True
+        return False
+
+    def do_UID(self, tag, args, literal):
+        command, _, args = args.partition(' ')
+        command = command.upper()
+        if command == 'FETCH':
+            self.do_FETCH(tag, args, literal, uid=True)
+        elif command == 'EXPUNGE' and self.mailbox is not None:
+            uids = {uid for uid, _message in self.mailbox.messages if self.matches(args, uid, uid)}
+            with self.mailbox.changed:
+                self.mailbox.messages = [entry for entry in self.mailbox.messages if entry[0] not in uids]
+            self.write(f"{tag} OK UID EXPUNGE completed")
+        else:
+            self.write(f"{tag} BAD Unsupported UID command")
+
+    def do_APPEND(self, tag, _args, literal):
+        if literal is None:
+            self.write(f"{tag} BAD Missing message")
+            return
+        uid = self.server.standin.mailbox(self.user).append(literal)
+        self.write(f"{tag} OK [APPENDUID 1 {uid}] APPEND completed")
+
+    def do_IDLE(self, tag, _args, _literal):
+        if self.mailbox is None:
+            self.write(f"{tag} BAD No mailbox selected")
+            return
+        known = len(self.mailbox.messages)
+        self.write("+ idling")
+        while True:
+            with self.mailbox.changed:
+                self.mailbox.changed.wait(0.05)
+                count = len(self.mailbox.messages)
+            if count != known:
+                known = count
+                self.write(f"* {count} EXISTS")
+            pending = getattr(self.connection, 'pending', lambda: 0)()
+            if pending or select.select([self.connection], [], [], 0)[0]:
+                self.rfile.readline()
+                break
+        self.write(f"{tag} OK IDLE terminated")
+
+
+class Mailbox:
+    """
+        The INBOX of a stand-in user, shared by all sessions of the user.
+    """
+
+    def __init__(self, user, count):
+        self.changed = threading.Condition()
+        self.messages = []
+        for number in range(count):
+            self.append(
+                f"Date: {time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime())}\r\n"
+                f"From: {user}\r\nTo: {user}\r\nSubject: Stand-in message {number + 1}\r\n"
+                f"Message-ID: <{uuid.uuid4()}@kolabstandin>\r\n\r\nStand-in message\r\n".encode()
+            )
+
+    def append(self, message):
+        with self.changed:
+            uid = self.messages[-1][0] + 1 if self.messages else 1
+            self.messages.append((uid, message))
+            self.changed.notify_all()
+        return uid
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, *lines):
+        self.server.faults.delay()
+        self.wfile.write(b"".join(line.encode() + b"\r\n" for line in lines))
+
+    def handle(self):
+        standin = self.server.standin
+        faults = self.server.faults
+        if faults.fail():
+            self.reply("421 4.3.2 Injected failure")
+            return
+        self.reply(f"220 {standin.domain} ESMTP kolabstandin")
+
+        self.tls = self.server.tls
+        self.user = None
+        self.sender = None
+        self.recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, args = line.decode(errors='replace').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            standin.count('smtp', command)
+            if command != 'QUIT' and faults.fail():
+                self.reply("451 4.3.0 Injected failure")
+                continue
+            handler = getattr(self, f"do_{command}", None)
+            if handler is None:
+                self.reply("502 5.5.2 Command not recognized")
+            elif handler(args) is False:
+                return
+
+    def do_EHLO(self, _args):
+        extensions = ["PIPELINING", "SIZE 52428800", "8BITMIME", "ENHANCEDSTATUSCODES"]
+        if not self.tls:
+            extensions.append("STARTTLS")
+        extensions.append("AUTH PLAIN LOGIN")
+        lines = [f"250-{self.server.standin.domain}"] + [f"250-{extension}" for extension in extensions]
+        lines[-1] = lines[-1].replace('250-', '250 ', 1)
+        self.reply(*lines)
+
+    def do_HELO(self, _args):
+        self.reply(f"250 {self.server.standin.domain}")
+
+    def do_STARTTLS(self, _args):
+        if self.tls:
+            self.reply("503 5.5.1 TLS already active")
+            return
+        self.reply("220 2.0.0 Ready to start TLS")
+        self.connection = self.server.standin.tls_context.wrap_socket(self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb')
+        self.wfile = self.connection.makefile('wb', buffering=0)
+        self.tls = True
+        self.user = None
+
+    def do_AUTH(self, args):
+        mechanism, _, initial = args.partition(' ')
+        mechanism = mechanism.upper()
+        try:
+            if mechanism == 'PLAIN':
+                if not initial:
+                    self.reply("334 ")
+                    initial = self.rfile.readline().strip().decode()
+                _authzid, username, password = base64.b64decode(initial).decode().split('\0')
+            elif mechanism == 'LOGIN':
+                if not initial:
+                    self.reply("334 VXNlcm5hbWU6")
+                    initial = self.rfile.readline().strip().decode()
+                username = base64.b64decode(initial).decode()
+                self.reply("334 UGFzc3dvcmQ6")
+                password = base64.b64decode(self.rfile.readline().strip()).decode()
+            else:
+                self.reply("504 5.5.4 Unrecognized authentication type")
+                return
+        except ValueError:
+            self.reply("501 5.5.2 Cannot decode response")
+            return
+
+        if not credentials(self.server.standin, username, password):
+            self.reply("535 5.7.8 Authentication credentials invalid")
+            return
+        self.user = username
+        self.reply("235 2.7.0 Authentication successful")
+
+    def do_MAIL(self, args):
+        if not self.user:
+            self.reply("530 5.7.0 Authentication required")
+            return
+        self.sender = args
+        self.recipients = []
+        self.reply("250 2.1.0 Ok")
+
+    def do_RCPT(self, args):
+        if self.sender is None:
+            self.reply("503 5.5.1 Need MAIL command")
+            return
+        self.recipients.append(args)
+        self.reply("250 2.1.5 Ok")
+
+    def do_DATA(self, _args):
+        if not self.recipients:
+            self.reply("503 5.5.1 Need RCPT command")
+            return
+        self.reply("354 End data with <CR><LF>.<CR><LF>")
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b".\r\n":
+                break
+        self.server.standin.count('smtp', 'message')
+        self.sender = None
+        self.recipients = []
+        self.reply(f"250 2.0.0 Ok: queued as {uuid.uuid4().hex[:12].upper()}")
+
+    def do_RSET(self, _args):
+        self.sender = None
+        self.recipients = []
+        self.reply("250 2.0.0 Ok")
+
+    def do_NOOP(self, _args):
+        self.reply("250 2.0.0 Ok")
+
+    def do_QUIT(self, _args):
+        self.reply("221 2.0.0 Bye")
+        return False
+
+
+class DNSHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        try:
+            query = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return
+        self.server.standin.count('dns', dns.rdatatype.to_text(query.question[0].rdtype) if query.question else '')
+        self.server.faults.delay()
+        if self.server.faults.fail():
+            response = dns.message.make_response(query)
+            response.set_rcode(dns.rcode.SERVFAIL)
+        else:
+            response = self.server.standin.answer(query)
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class StandIn:
+    """
+        The stand-in services of a domain.
+
+        Ports of 0 pick a free port, see `ports` once started.
+    """
+
+    def __init__(self, domain, address='127.0.0.1', ports=None, faults=None, password=None,
+                 certfile=None, keyfile=None, zonefile=None, messages=10, verbose=False):
+        self.domain = domain
+        self.address = address
+        self.requested_ports = {'https': 8443, 'imaps': 9993, 'smtps': 9465, 'submission': 9587, 'dns': 5353, **(ports or {})}
+        self.faults = faults or parse_faults()
+        self.password = password
+        self.messages = messages
+        self.verbose = verbose
+        self.servers = {}
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.mailboxes = {}
+
+        self.directory = None
+        if not certfile:
+            self.directory = tempfile.mkdtemp(prefix='kolabstandin')
+            certfile, keyfile = self_signed_certificate(domain, self.directory)
+        self.certfile = certfile
+        self.tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.tls_context.load_cert_chain(certfile, keyfile)
+
+        if zonefile:
+            zone = dns.zone.from_file(zonefile, origin=domain, relativize=False)
+        else:
+            zone = dns.zone.from_text(ZONE.format(address=address), origin=domain, relativize=False)
+        reverse = dns.zone.from_text(REVERSE_ZONE.format(domain=domain), origin=dns.reversename.from_address(address),
+                                     relativize=False)
+        self.zones = [zone, reverse]
+
+    def start(self):
+        ports = self.requested_ports
+        self.servers = {
+            'https': StandInServer((self.address, ports['https']), HTTPHandler, self, 'http', tls=True),
+            'imaps': StandInServer((self.address, ports['imaps']), IMAPHandler, self, 'imap', tls=True),
+            'smtps': StandInServer((self.address, ports['smtps']), SMTPHandler, self, 'smtp', tls=True),
+            'submission': StandInServer((self.address, ports['submission']), SMTPHandler, self, 'smtp'),
+            'dns': StandInUDPServer((self.address, ports['dns']), DNSHandler, self, 'dns'),
+        }
+        for name, server in self.servers.items():
+            threading.Thread(target=server.serve_forever, name=f"standin-{name}", daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    @property
+    def ports(self):
+        return {name: server.server_address[1] for name, server in self.servers.items()}
+
+    def endpointtester_args(self):
+        """
+            The kolabendpointtester.py arguments to reach the stand-ins instead of
+            the real services of the domain.
+        """
+        ports = self.ports
+        return [
+            "--nameserver", f"{self.address}:{ports['dns']}",
+            "--connect-to", f":443:{self.address}:{ports['https']}",
+            "--connect-to", f":993:{self.address}:{ports['imaps']}",
+            "--connect-to", f":465:{self.address}:{ports['smtps']}",
+            "--connect-to", f":587:{self.address}:{ports['submission']}",
+        ]
+
+    def count(self, service, what):
+        with self.lock:
+            self.counts[(service, what)] += 1
+
+    def mailbox(self, user):
+        with self.lock:
+            if user not in self.mailboxes:
+                self.mailboxes[user] = Mailbox(user, self.messages)
+            return self.mailboxes[user]
+
+    def answer(self, query):
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        if not query.question:
+            response.set_rcode(dns.rcode.FORMERR)
+            return response
+        question = query.question[0]
+
+        zone = next((zone for zone in self.zones if question.name.is_subdomain(zone.origin)), None)
+        if zone is None:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+
+        node = zone.get_node(question.name)
+        if node is None and question.name != zone.origin:
+            node = zone.get_node(dns.name.Name(('*',) + question.name.labels[1:]))
+        if node is None:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            return response
+
+        rdataset = node.get_rdataset(zone.rdclass, question.rdtype)
+        if rdataset is None and question.rdtype != dns.rdatatype.CNAME:
+            rdataset = node.get_rdataset(zone.rdclass, dns.rdatatype.CNAME)
+        if rdataset is not None:
+            response.answer.append(dns.rrset.from_rdata_list(question.name, rdataset.ttl, rdataset))
+        return response
+
+    def autoconfig(self):
+        domain = html.escape(self.domain)
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<clientConfig version="1.1">
+  <emailProvider id="{domain}">
+    <domain>{domain}</domain>
+    <incomingServer type="imap">
+      <hostname>{domain}</hostname>
+      <port>993</port>
+      <socketType>SSL</socketType>
+      <username>%EMAILADDRESS%</username>
+      <authentication>password-cleartext</authentication>
+    </incomingServer>
+    <outgoingServer type="smtp">
+      <hostname>{domain}</hostname>
+      <port>587</port>
+      <socketType>STARTTLS</socketType>
+      <username>%EMAILADDRESS%</username>
+      <authentication>password-cleartext</authentication>
+    </outgoingServer>
+  </emailProvider>
+</clientConfig>
+"""
+
+    def autodiscover(self, email, host):
+        email = html.escape(email or '')
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<Autodiscover xmlns="http://schemas.microsoft.com/exchange/autodiscover/responseschema/2006">
+<Response xmlns="http://schemas.microsoft.com/exchange/autodiscover/mobilesync/responseschema/2006">
+  <User>
+    <DisplayName>{email}</DisplayName>
+    <EMailAddress>{email}</EMailAddress>
+  </User>
+  <Action>
+    <Settings>
+      <Server>
+        <Type>MobileSync</Type>
+        <Url>https://{host}/Microsoft-Server-ActiveSync</Url>
+        <Name>https://{host}/Microsoft-Server-ActiveSync</Name>
+      </Server>
+    </Settings>
+  </Action>
+</Response>
+</Autodiscover>
+"""
+
+    def freebusy(self, user):
+        now = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        return (
+            "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//kolabstandin//EN\r\nMETHOD:PUBLISH\r\n"
+            f"BEGIN:VFREEBUSY\r\nORGANIZER:mailto:{user}\r\nDTSTAMP:{now}\r\nDTSTART:{now}\r\n"
+            f"FREEBUSY:{now}/PT1H\r\nEND:VFREEBUSY\r\nEND:VCALENDAR\r\n"
+        )
+
+    def propfind(self, path, depth):
+        """
+            The path itself, with a couple of calendars below it unless Depth is 0.
+        """
+        resources = [(path, os.path.basename(path.rstrip('/')) or self.domain, '<d:collection/>')]
+        if depth != '0':
+            for name, kind in (('Calendar', 'calendar'), ('Tasks', 'calendar'), ('Contacts', 'addressbook')):
+                namespace = 'c' if kind == 'calendar' else 'a'
+                resources.append((f"{path.rstrip('/')}/{uuid.uuid5(uuid.NAMESPACE_URL, path + name)}/", name,
+                                  f"<d:collection/><{namespace}:{kind}/>"))
+        responses = "".join(
+            f"<d:response><d:href>{html.escape(href)}</d:href><d:propstat><d:prop>"
+            f"<d:resourcetype>{resourcetype}</d:resourcetype><d:displayname>{html.escape(name)}</d:displayname>"
+            f"<d:current-user-principal><d:href>/dav/principals/user/</d:href></d:current-user-principal>"
+            f"</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+            for href, name, resourcetype in resources
+        )
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav" xmlns:a="urn:ietf:params:xml:ns:carddav">'
+            f"{responses}</d:multistatus>"
+        )
+
+    def report(self, path):
+        now = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        event = (
+            "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//kolabstandin//EN\r\nBEGIN:VEVENT\r\n"
+            f"UID:{uuid.uuid5(uuid.NAMESPACE_URL, path)}\r\nDTSTAMP:{now}\r\nDTSTART:{now}\r\n"
+            "SUMMARY:Stand-in event\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+        )
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">'
+            f"<d:response><d:href>{html.escape(path.rstrip('/'))}/standin.ics</d:href><d:propstat><d:prop>"
+            f'<d:getetag>"1"</d:getetag><c:calendar-data>{html.escape(event)}</c:calendar-data>'
+            "</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response></d:multistatus>"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--domain", default="example.org", help="Domain to stand in for")
+    parser.add_argument("--listen", default="127.0.0.1", help="Address to listen on, also used in the dns records")
+    parser.add_argument("--password", help="Only accept this password (any is accepted by default)")
+    parser.add_argument("--https-port", type=int, default=8443, help="Port of the HTTPS stand-in (0 for any free port)")
+    parser.add_argument("--imaps-port", type=int, default=9993, help="Port of the IMAPS stand-in")
+    parser.add_argument("--smtps-port", type=int, default=9465, help="Port of the SMTPS stand-in")
+    parser.add_argument("--submission-port", type=int, default=9587, help="Port of the SMTP submission (STARTTLS) stand-in")
+    parser.add_argument("--dns-port", type=int, default=5353, help="Port of the DNS stand-in (UDP)")
+    parser.add_argument("--certfile", help="Certificate for the TLS services (a self-signed one is created by default)")
+    parser.add_argument("--keyfile", help="Private key of --certfile")
+    parser.add_argument("--zone", help="Zone file for the domain instead of the built-in records")
+    parser.add_argument("--messages", type=int, default=10, help="Number of messages in the INBOX of every user")
+    parser.add_argument("--latency", action='append', metavar="[SERVICE=]DURATION",
+                        help="Delay every reply, e.g. '20ms' or 'imap=0.1s' (may be repeated)")
+    parser.add_argument("--jitter", action='append', metavar="[SERVICE=]DURATION",
+                        help="Add up to this much random delay to every reply")
+    parser.add_argument("--failure-rate", action='append', metavar="[SERVICE=]RATE",
+                        help="Fail this fraction of the replies, e.g. 'smtp=0.1'")
+    parser.add_argument("--verbose", action='store_true', help="Log every HTTP request")
+
+    options = parser.parse_args()
+
+    try:
+        faults = parse_faults(options.latency, options.jitter, options.failure_rate)
+    except ValueError as err:
+        parser.error(str(err))
+
+    standin = StandIn(
+        options.domain,
+        options.listen,
+        ports={
+            'https': options.https_port,
+            'imaps': options.imaps_port,
+            'smtps': options.smtps_port,
+            'submission': options.submission_port,
+            'dns': options.dns_port,
+        },
+        faults=faults,
+        password=options.password,
+        certfile=options.certfile,
+        keyfile=options.keyfile,
+        zonefile=options.zone,
+        messages=options.messages,
+        verbose=options.verbose,
+    ).start()
+
+    for name, port in standin.ports.items():
+        print(f"{name:<12} {options.listen}:{port}")
+    print()
+    print(f"SSL_CERT_FILE={standin.certfile} kolabendpointtester.py --default --username user@{options.domain} "
+          f"--password {options.password or 'Secret'} " + " ".join(standin.endpointtester_args()))
+    sys.stdout.flush()
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.stop()
+        for (service, what), count in sorted(standin.counts.items()):
+            print(f"{service:<5} {what:<12} {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+kolabutils.py
+
+    Helpers shared by kolabendpointtester.py, activesynccli.py and
+    kolabbenchmark.py. Importing it is cheap, it must not load anything the
+    scripts only import on demand.
+"""
+
+import importlib
+import math
+
+
+class LazyModule:
+    """
+        A module that is only imported on first use, so a run only loads what it
+        needs. Submodules are imported on access as well (`dns.resolver`).
+
+        With a fallback, a module with the same interface is used if the first
+        one is not installed.
+    """
+
+    def __init__(self, name, fallback = None):
+        self._name = name
+        self._fallback = fallback
+        self._module = None
+
+    def _load(self):
+        try:
+            return importlib.import_module(self._name)
+        except ImportError:
+            if self._fallback is None:
+                raise
+            return importlib.import_module(self._fallback)
+
+    def __getattr__(self, attribute):
+        # Resolved once, a failed import of the first choice is not retried on every access
+        module = self._module
+        if module is None:
+            module = self._module = self._load()
+        try:
+            return getattr(module, attribute)
+        except AttributeError:
+            return importlib.import_module(f"{module.__name__}.{attribute}")
+
+
+def percentile(values, quantile):
+    """
+        The nearest-rank percentile of a list of values.
+    """
+    values = sorted(values)
+    return values[max(math.ceil(quantile * len(values)) - 1, 0)]
+
+
+def percentiles(values, quantiles):
+    """
+        Nearest-rank percentiles of a list of values.
+    """
+    values = sorted(values)
+    return [percentile(values, quantile) for quantile in quantiles]
+
+
+def raise_open_files_limit(needed):
+    """
+        Raise the soft limit of open files (up to the hard limit) for many sockets.
+    """
+    import resource  # pylint: disable=import-outside-toplevel
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = needed + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
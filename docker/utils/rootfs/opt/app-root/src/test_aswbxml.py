@@ -0,0 +1,143 @@
+#!/bin/env python3
+
+"""
+test_aswbxml.py
+
+    Encoding and decoding of aswbxml.py:
+
+    python3 -m unittest test_aswbxml
+"""
+
+import io
+import unittest
+import xml.etree.ElementTree as ET
+
+import aswbxml
+
+
+AIRSYNC = f"{{{aswbxml.NAMESPACE}airsync}}"
+AIRSYNCBASE = f"{{{aswbxml.NAMESPACE}airsyncbase}}"
+MAIL = f"{{{aswbxml.NAMESPACE}mail}}"
+
+# Not valid UTF-8, like a MIME body in another charset
+MIME = b"Subject: =?iso-8859-1?q?Gr=FC=DFe?=\r\n\r\nGr\xfc\xdfe " + bytes(range(256)) * 8
+
+
+def sync_response(changes):
+    root = ET.Element(f"{AIRSYNC}Sync")
+    collection = ET.SubElement(ET.SubElement(root, f"{AIRSYNC}Collections"), f"{AIRSYNC}Collection")
+    ET.SubElement(collection, f"{AIRSYNC}SyncKey").text = "2"
+    ET.SubElement(collection, f"{AIRSYNC}CollectionId").text = "38"
+    commands = ET.SubElement(collection, f"{AIRSYNC}Commands")
+    for number in range(changes):
+        add = ET.SubElement(commands, f"{AIRSYNC}Add")
+        ET.SubElement(add, f"{AIRSYNC}ServerId").text = f"38:{number}"
+        data = ET.SubElement(add, f"{AIRSYNC}ApplicationData")
+        ET.SubElement(data, f"{MAIL}Subject").text = f"Grüße <{number}> & more"
+        body = ET.SubElement(data, f"{AIRSYNCBASE}Body")
+        ET.SubElement(body, f"{AIRSYNCBASE}Type").text = "4"
+        ET.SubElement(body, f"{AIRSYNCBASE}Data").text = MIME
+    ET.SubElement(collection, f"{AIRSYNC}MoreAvailable")
+    return root
+
+
+class ChunkedReader(io.RawIOBase):
+    """
+        Hands out at most `size` bytes per read, like a socket.
+    """
+
+    def __init__(self, data, size):
+        super().__init__()
+        self.data = io.BytesIO(data)
+        self.size = size
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self.data.read(min(self.size, size) if size >= 0 else self.size)
+
+
+class RoundTripTest(unittest.TestCase):
+    def assertChanges(self, root, changes):
+        adds = root.findall(f".//{AIRSYNC}Add")
+        self.assertEqual(len(adds), changes)
+        for number, add in enumerate(adds):
+            self.assertEqual(add.findtext(f"{AIRSYNC}ServerId"), f"38:{number}")
+            self.assertEqual(add.findtext(f".//{MAIL}Subject"), f"Grüße <{number}> & more")
+            self.assertEqual(aswbxml.opaque(add.find(f".//{AIRSYNCBASE}Data")), MIME)
+        self.assertEqual(root.findtext(f".//{AIRSYNC}SyncKey"), "2")
+        self.assertIsNotNone(root.find(f".//{AIRSYNC}MoreAvailable"))
+
+    def test_round_trip(self):
+        data = aswbxml.encode(sync_response(3))
+
+        self.assertTrue(data.startswith(aswbxml.HEADER))
+        self.assertIn(bytes((aswbxml.OPAQUE,)) + aswbxml.mb_u_int32(len(MIME)) + MIME, data)
+        root = aswbxml.parse(data)
+        self.assertChanges(root, 3)
+        # Decoded OPAQUE data is encoded as OPAQUE again
+        self.assertEqual(aswbxml.encode(root), data)
+
+    def test_chunks(self):
+        data = aswbxml.encode(sync_response(3))
+
+        for size in (1, 7, 1000):
+            with self.subTest(size=size):
+                source = ChunkedReader(data, size)
+                parser = aswbxml.StreamParser(source, chunk_size=size)
+                self.assertChanges(parser.parse(), 3)
+                self.assertEqual(parser.bytes_read, len(data))
+                self.assertGreater(source.reads, 1)
+
+    def test_xml_namespaces(self):
+        xml = (
+            '<?xml version="1.0" encoding="utf-8"?><Ping xmlns="uri:Ping"><HeartbeatInterval>300</HeartbeatInterval>'
+            '<Folders><Folder><Id>38</Id><Class>Email</Class></Folder></Folders></Ping>'
+        )
+        root = aswbxml.parse(aswbxml.xml_to_wbxml(xml))
+
+        self.assertEqual(root.tag, f"{{{aswbxml.NAMESPACE}ping}}Ping")
+        self.assertEqual(root.findtext(f".//{{{aswbxml.NAMESPACE}ping}}Id"), "38")
+
+    def test_empty_document(self):
+        self.assertIsNone(aswbxml.parse(b""))
+        self.assertEqual(aswbxml.wbxml_to_xml(b""), "")
+
+    def test_truncated(self):
+        data = aswbxml.encode(sync_response(1))
+
+        for length in (len(data) - 1, len(data) // 2, 6):
+            with self.subTest(length=length), self.assertRaises(aswbxml.WBXMLError):
+                aswbxml.StreamParser(data[:length], chunk_size=16).parse()
+
+
+class IterChangesTest(unittest.TestCase):
+    def test_iterchanges(self):
+        parser = aswbxml.StreamParser(aswbxml.encode(sync_response(5)), chunk_size=64)
+
+        seen = []
+        for parent, element in parser.iterchanges():
+            # Complete, still attached, and the one before it is gone
+            self.assertEqual(element.tag, f"{AIRSYNC}Add")
+            self.assertEqual(list(parent), [element])
+            self.assertEqual(aswbxml.opaque(element.find(f".//{AIRSYNCBASE}Data")), MIME)
+            seen.append(element.findtext(f"{AIRSYNC}ServerId"))
+
+        self.assertEqual(seen, [f"38:{number}" for number in range(5)])
+        self.assertEqual(parser.root.findall(f".//{AIRSYNC}Add"), [])
+        self.assertEqual(parser.root.findtext(f".//{AIRSYNC}SyncKey"), "2")
+        self.assertIsNotNone(parser.root.find(f".//{AIRSYNC}MoreAvailable"))
+
+    def test_tags(self):
+        root = sync_response(2)
+        ET.SubElement(root.find(f".//{AIRSYNC}Commands"), f"{AIRSYNC}Delete").append(ET.Element(f"{AIRSYNC}ServerId"))
+        parser = aswbxml.StreamParser(aswbxml.encode(root))
+
+        tags = [element.tag for _parent, element in parser.iterchanges(("Delete",))]
+
+        self.assertEqual(tags, [f"{AIRSYNC}Delete"])
+        self.assertEqual(len(parser.root.findall(f".//{AIRSYNC}Add")), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,220 @@
+#!/bin/env python3
+
+"""
+test_kolabendpointtester.py
+
+    Checks of kolabendpointtester.py that need no server, or only a local one:
+
+    python3 -m unittest test_kolabendpointtester
+"""
+
+import http.server
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import kolabendpointtester
+
+
+class FleetRowTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = kolabendpointtester.build_parser()
+        self.columns = kolabendpointtester.fleet_columns(self.parser)
+
+    def tenant(self, content, *args):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "fleet.csv")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            [row] = kolabendpointtester.load_fleet(path)
+        options = self.parser.parse_args(["--host", "example.org", *args])
+        return kolabendpointtester.tenant_options(options, row, self.columns)
+
+    def test_cert_columns(self):
+        tenant = self.tenant('username,cert_hosts,cert_warn_days\nuser@a.org,"mail.a.org,dav.a.org:8443",30\n')
+
+        self.assertEqual(tenant.cert_hosts, ["mail.a.org,dav.a.org:8443"])
+        self.assertEqual(tenant.cert_warn_days, 30)
+        self.assertEqual(
+            kolabendpointtester.certificate_endpoints(tenant.host, None, None, tenant.cert_hosts),
+            [("example.org", 443, False), ("mail.a.org", 443, False), ("dav.a.org", 8443, False)]
+        )
+
+    def test_empty_cert_columns(self):
+        tenant = self.tenant('username,cert_hosts,cert_warn_days\nuser@a.org,,\n')
+
+        self.assertIsNone(tenant.cert_hosts)
+        self.assertEqual(tenant.cert_warn_days, 14)
+
+    def test_typed_columns(self):
+        tenant = self.tenant(
+            'username,fb_concurrency,smtp_messages,meet_sessions,meet_hold,meet_rate,dns,imap_idle\n'
+            'user@a.org,4,10,20,2.5,0.5,yes,false\n', "--imap-idle"
+        )
+
+        self.assertEqual(tenant.fb_concurrency, 4)
+        self.assertEqual(tenant.smtp_messages, 10)
+        self.assertEqual(tenant.meet_sessions, 20)
+        self.assertEqual(tenant.meet_hold, 2.5)
+        self.assertEqual(tenant.meet_rate, 0.5)
+        self.assertIs(tenant.dns, True)
+        self.assertIs(tenant.imap_idle, False)
+
+    def test_default_columns(self):
+        tenant = self.tenant('username,default\nuser@a.org,1\n')
+
+        self.assertEqual(tenant.host, "a.org")
+        self.assertEqual(tenant.imap, "a.org")
+        self.assertIs(tenant.certificates, True)
+
+    def test_invalid_row(self):
+        with self.assertRaises(ValueError) as raised:
+            self.tenant('username,password,smtp_messages,timeout,colour\n,Secret,many,5,red\n', "--default")
+
+        message = str(raised.exception)
+        self.assertIn("smtp_messages: invalid int value 'many'", message)
+        self.assertIn("timeout: can only be given for the whole run", message)
+        self.assertIn("colour: unknown column", message)
+
+    def test_default_without_username(self):
+        with self.assertRaisesRegex(ValueError, "username"):
+            self.tenant('password\nSecret\n', "--default")
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        body = b"pong"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Close the connection without announcing it, like an idle timeout of the server
+        self.close_connection = self.server.drop
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.connections = set()
+        self.server.drop = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/ping"
+
+        self.pool = kolabendpointtester.ConnectionPool()
+        patcher = mock.patch.object(kolabendpointtester, 'pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self):
+        response = kolabendpointtester.http_request(self.url, "GET", quiet=True)
+        self.assertEqual((response.status, response.data), (200, b"pong"))
+        return response.timings
+
+    def test_reuse(self):
+        connections = [self.get().connection for _ in range(3)]
+
+        self.assertEqual(connections, ["new", "reused", "reused"])
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(len(self.pool.idle[('http', "127.0.0.1", self.server.server_address[1])]), 1)
+
+    def test_retry_after_close(self):
+        self.server.drop = True
+        self.assertEqual(self.get().connection, "new")
+        self.assertEqual(len(self.pool.idle[('http', "127.0.0.1", self.server.server_address[1])]), 1)
+        # Give the server time to close its end
+        time.sleep(0.1)
+
+        # The idle connection is stale, the request is sent again on a new one
+        self.assertEqual(self.get().connection, "new")
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_max_idle(self):
+        timings = kolabendpointtester.PhaseTimings()
+        first = self.pool.get('http', "127.0.0.1", self.server.server_address[1], timings)
+        second = self.pool.get('http', "127.0.0.1", self.server.server_address[1], timings)
+        self.pool.put('http', "127.0.0.1", self.server.server_address[1], first, max_idle=1)
+        self.pool.put('http', "127.0.0.1", self.server.server_address[1], second, max_idle=1)
+
+        self.assertEqual(self.pool.idle[('http', "127.0.0.1", self.server.server_address[1])], [first])
+        self.assertIsNone(second.sock)
+
+
+class ProbeStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = kolabendpointtester.ProbeStore(os.path.join(directory.name, "probes.db"))
+        self.addCleanup(self.store.db.close)
+        self.now = time.time()
+
+    def add(self, name, duration, success=True, tenant="user@a.org", age=0):
+        check = kolabendpointtester.Check(name, None, "", tenant=tenant)
+        check.success = success
+        check.duration = duration
+        check.finished = self.now - age
+        self.store.add(check)
+
+    def test_buckets(self):
+        store = self.store
+        self.assertEqual(store.bucket(0), 0)
+        self.assertEqual(store.bucket(store.BUCKET_BASE), 0)
+        for duration in (0.0005, 0.01, 0.25, 3, 60):
+            value = store.bucket_value(store.bucket(duration))
+            self.assertLess(abs(value - duration) / duration, store.BUCKET_GROWTH - 1)
+        self.assertLess(store.bucket(0.01), store.bucket(0.0105))
+
+    def test_percentiles(self):
+        for number in range(1, 101):
+            self.add("IMAP", number / 1000)
+        # Neither failed checks nor other checks and tenants count
+        self.add("IMAP", 10, success=False)
+        self.add("SMTP", 10)
+        self.add("IMAP", 10, tenant="user@b.org")
+        self.store.commit()
+
+        count, (p50, p95, p99) = self.store.percentiles("user@a.org", "IMAP", self.now - 3600)
+        self.assertEqual(count, 100)
+        self.assertAlmostEqual(p50, 0.050, delta=0.050 * 0.05)
+        self.assertAlmostEqual(p95, 0.095, delta=0.095 * 0.05)
+        self.assertAlmostEqual(p99, 0.099, delta=0.099 * 0.05)
+
+        self.assertEqual(self.store.percentiles("user@a.org", "CalDAV", self.now - 3600), (0, [None, None, None]))
+
+    def test_window(self):
+        self.add("IMAP", 0.01)
+        self.add("IMAP", 1, age=3 * 86400)
+        self.store.commit()
+
+        self.assertEqual(self.store.percentiles("user@a.org", "IMAP", self.now - 86400, (1,))[0], 1)
+        self.assertEqual(self.store.percentiles("user@a.org", "IMAP", self.now - 7 * 86400, (1,))[0], 2)
+
+        # Raw probes expire, the histograms are kept
+        self.store.expire(self.now - 86400)
+        self.assertEqual(self.store.db.execute("SELECT COUNT(*) FROM probes").fetchone()[0], 1)
+        self.assertEqual(self.store.percentiles("user@a.org", "IMAP", self.now - 7 * 86400, (1,))[0], 2)
+
+    def test_report(self):
+        self.add("IMAP", 0.01)
+        self.add("SMTP", 0.02, tenant="user@b.org")
+        self.add("SMTP", 0.5, age=2 * 86400)
+        self.store.commit()
+
+        report = [(tenant, name, count) for tenant, name, count, _values in self.store.report(self.now - 86400)]
+        self.assertEqual(report, [("user@a.org", "IMAP", 1), ("user@b.org", "SMTP", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()